@@ -0,0 +1,496 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import psutil
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from bty_chtbt.embedding_cache import CachedEmbeddings
+from bty_chtbt.numpy_index import STORAGE_DTYPES
+from bty_chtbt.vector_backend import BACKENDS, document_id, get_backend
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+books_dir = os.path.join(current_dir, "books")
+db_dir = os.path.join(current_dir, "db")
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(db_dir, "embedding_cache"))
+embedding_model_name = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def make_embeddings():
+    # Cached, so query embeddings are computed once and the timings below measure the store itself
+    return CachedEmbeddings(
+        HuggingFaceEmbeddings(
+            model_name=embedding_model_name,
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={'normalize_embeddings': True}
+        ),
+        model_name=embedding_model_name,
+        cache_dir=embedding_cache_dir
+    )
+
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(np.asarray(samples) * 1000, q)) if samples else 0.0
+
+
+def load_queries(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def measure_backend(backend, path, queries, k):
+    """Load one store and time searches. Runs in a fresh process so RSS is not shared."""
+    embeddings = make_embeddings()
+    # Warm the query cache so only the search is timed
+    embeddings.embed_query(queries[0])
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    store = get_backend(backend, path, embeddings, embedding_model_name).load()
+    load_seconds = time.perf_counter() - start
+    rss_after_load = rss_mb()
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        store.search(query, k=k)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "backend": backend,
+        "rows": store.count(),
+        "load_ms": load_seconds * 1000,
+        "search_p50_ms": percentile_ms(latencies, 50),
+        "search_p95_ms": percentile_ms(latencies, 95),
+        "rss_load_mb": rss_after_load - rss_before,
+        "rss_total_mb": rss_mb(),
+        "disk_mb": store.disk_size() / (1024 * 1024),
+    }
+
+
+def print_table(results, columns):
+    header = " | ".join(f"{name:>14}" for name in columns)
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        cells = []
+        for name in columns:
+            value = result.get(name, "")
+            cells.append(f"{value:>14.2f}" if isinstance(value, float) else f"{value!s:>14}")
+        print(" | ".join(cells))
+
+
+def run_backends(args):
+    """Build every backend on the same corpus and compare load, search, memory and disk."""
+    from vector_n_embed import load_csvs_to_documents
+
+    documents = load_csvs_to_documents(args.books)
+    queries = [doc.metadata["question"] for doc in documents][:args.queries]
+    embeddings = make_embeddings()
+    # Embed corpus and queries once up front; builds and child processes then hit the cache
+    embeddings.embed_documents([doc.page_content for doc in documents])
+    for query in queries:
+        embeddings.embed_query(query)
+    embeddings.cache.flush()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="vector_bench_")
+    queries_path = os.path.join(work_dir, "queries.json")
+    os.makedirs(work_dir, exist_ok=True)
+    with open(queries_path, "w", encoding="utf-8") as f:
+        json.dump(queries, f, ensure_ascii=False)
+
+    results = []
+    for backend in args.backends:
+        path = os.path.join(work_dir, backend)
+        start = time.perf_counter()
+        get_backend(backend, path, embeddings, embedding_model_name).build(documents)
+        build_ms = (time.perf_counter() - start) * 1000
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "_measure",
+             "--backend", backend, "--path", path, "--queries-file", queries_path, "--k", str(args.k)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result["build_ms"] = build_ms
+        results.append(result)
+
+    print(f"\n{len(documents)} documents, {len(queries)} queries, k={args.k}, stores in {work_dir}\n")
+    print_table(results, ["backend", "rows", "build_ms", "load_ms", "search_p50_ms",
+                          "search_p95_ms", "rss_load_mb", "disk_mb"])
+
+
+def measure_vector_search(backend, path, queries_path, k, dtype=None):
+    """Load one store without an embedding model and time pure vector search."""
+    query_vectors = np.load(queries_path)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    options = {"dtype": dtype} if dtype else {}
+    store = get_backend(backend, path, None, **options).load()
+    load_seconds = time.perf_counter() - start
+    rss_after_load = rss_mb()
+
+    latencies = []
+    results = []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        docs = store.search_by_vector(vector.tolist(), k=k)
+        latencies.append(time.perf_counter() - start)
+        results.append([document_id(doc) for doc in docs])
+
+    result = {
+        "store": f"{backend}/{dtype}" if dtype else backend,
+        "rows": store.count(),
+        "load_ms": load_seconds * 1000,
+        "search_p50_ms": percentile_ms(latencies, 50),
+        "search_p95_ms": percentile_ms(latencies, 95),
+        "rss_load_mb": rss_after_load - rss_before,
+        "disk_mb": store.disk_size() / (1024 * 1024),
+        "results": results,
+    }
+    if backend == "numpy":
+        # One batched matrix multiply for all queries
+        start = time.perf_counter()
+        store.search_rows(query_vectors, k=k)
+        result["batch_ms_per_query"] = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    return result
+
+
+def run_numpy(args):
+    """Compare the NumPy engine (float32/float16/int8) with FAISS.load_local on the same vectors."""
+    from vector_n_embed import load_csvs_to_documents
+
+    documents = load_csvs_to_documents(args.books)
+    queries = [doc.metadata["question"] for doc in documents][:args.queries]
+    embeddings = make_embeddings()
+    embeddings.embed_documents([doc.page_content for doc in documents])
+    query_vectors = np.asarray([embeddings.embed_query(query) for query in queries], dtype=np.float32)
+    embeddings.cache.flush()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="numpy_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    queries_path = os.path.join(work_dir, "query_vectors.npy")
+    np.save(queries_path, query_vectors)
+
+    stores = [("faiss", None)] + [("numpy", dtype) for dtype in args.dtypes]
+    results = []
+    for backend, dtype in stores:
+        path = os.path.join(work_dir, f"{backend}_{dtype}" if dtype else backend)
+        options = {"dtype": dtype} if dtype else {}
+        get_backend(backend, path, embeddings, embedding_model_name, **options).build(documents)
+        command = [sys.executable, os.path.abspath(__file__), "_measure_vectors",
+                   "--backend", backend, "--path", path, "--queries-file", queries_path, "--k", str(args.k)]
+        if dtype:
+            command += ["--dtype", dtype]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    # Recall@k of every store against exact FAISS (IndexFlatL2 on normalized vectors)
+    reference = results[0]["results"]
+    for result in results:
+        overlaps = [len(set(found) & set(expected)) / max(len(expected), 1)
+                    for found, expected in zip(result.pop("results"), reference, strict=True)]
+        result["recall_at_k"] = float(np.mean(overlaps)) if overlaps else 0.0
+
+    print(f"\n{len(documents)} documents, {len(queries)} queries, k={args.k}, stores in {work_dir}\n")
+    print_table(results, ["store", "rows", "load_ms", "search_p50_ms", "search_p95_ms",
+                          "batch_ms_per_query", "rss_load_mb", "disk_mb", "recall_at_k"])
+
+
+def run_rerank(args):
+    """Dense top-k versus dense candidates + cross-encoder top-n: hit rate, context tokens, latency."""
+    import tiktoken
+
+    from bty_chtbt.reranker import CrossEncoderReranker
+    from vector_n_embed import load_csvs_to_documents
+
+    documents = load_csvs_to_documents(args.books)
+    queries = [(doc.metadata["question"], document_id(doc)) for doc in documents][:args.queries]
+    embeddings = make_embeddings()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rerank_bench_")
+    store = get_backend(args.backend, os.path.join(work_dir, args.backend), embeddings,
+                        embedding_model_name).build(documents)
+    # No time budget here: measure the full cost of scoring every candidate set
+    reranker = CrossEncoderReranker(runtime=args.runtime, budget_seconds=3600).wait_ready()
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    def context_tokens(docs):
+        context = "\n".join(f"Q: {doc.metadata['question']}\nA: {doc.page_content}" for doc in docs)
+        return len(tokenizer.encode(context))
+
+    dense = {"strategy": f"dense top-{args.k}", "latencies": [], "tokens": [], "hits": 0}
+    reranked = {"strategy": f"rerank {args.candidates}->{args.top_n}", "latencies": [], "tokens": [], "hits": 0}
+    for query, expected_id in queries:
+        start = time.perf_counter()
+        docs = store.search(query, k=args.k)
+        dense["latencies"].append(time.perf_counter() - start)
+        dense["tokens"].append(context_tokens(docs))
+        dense["hits"] += expected_id in [document_id(doc) for doc in docs]
+
+        start = time.perf_counter()
+        candidates = store.search(query, k=args.candidates)
+        docs = reranker.rerank(query, candidates, top_n=args.top_n)
+        reranked["latencies"].append(time.perf_counter() - start)
+        reranked["tokens"].append(context_tokens(docs))
+        reranked["hits"] += expected_id in [document_id(doc) for doc in docs]
+
+    if args.generate:
+        # End-to-end: build the real prompt and stream an answer from the configured LLM
+        from qa_lms_chatbot import generate_answer, generate_qa_prompt
+
+        for result, fetch in ((dense, lambda q: store.search(q, k=args.k)),
+                              (reranked, lambda q: reranker.rerank(q, store.search(q, k=args.candidates),
+                                                                   top_n=args.top_n))):
+            end_to_end = []
+            for query, _ in queries[:args.generate]:
+                start = time.perf_counter()
+                generate_answer(generate_qa_prompt(query, fetch(query)), channel="cli")
+                end_to_end.append(time.perf_counter() - start)
+            result["end_to_end_p50_ms"] = percentile_ms(end_to_end, 50)
+            result["end_to_end_p95_ms"] = percentile_ms(end_to_end, 95)
+
+    results = []
+    for result in (dense, reranked):
+        latencies = result.pop("latencies")
+        tokens = result.pop("tokens")
+        result["hit_rate"] = result.pop("hits") / max(len(queries), 1)
+        result["context_tokens"] = float(np.mean(tokens)) if tokens else 0.0
+        result["retrieve_p50_ms"] = percentile_ms(latencies, 50)
+        result["retrieve_p95_ms"] = percentile_ms(latencies, 95)
+        results.append(result)
+
+    print(f"\n{len(documents)} documents, {len(queries)} queries, reranker {reranker.model_name} "
+          f"({reranker.runtime})\n")
+    print_table(results, ["strategy", "hit_rate", "context_tokens", "retrieve_p50_ms", "retrieve_p95_ms",
+                          "end_to_end_p50_ms", "end_to_end_p95_ms"])
+
+
+def run_mmr(args):
+    """
+    Plain top-k versus MMR at several lambdas: latency overhead and how much distinct
+    content each prompt token carries.
+
+    coverage_per_token is the number of distinct character bigrams across the retrieved
+    Q&A pairs divided by their token count, so near-identical answers lower it;
+    redundancy is the mean highest cosine similarity between a result and another one.
+    """
+    import tiktoken
+
+    from bty_chtbt.dedup import shingles
+    from bty_chtbt.numpy_index import normalize_rows
+    from vector_n_embed import load_csvs_to_documents
+
+    documents = load_csvs_to_documents(args.books)
+    queries = [(doc.metadata["question"], document_id(doc)) for doc in documents][:args.queries]
+    embeddings = make_embeddings()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mmr_bench_")
+    store = get_backend(args.backend, os.path.join(work_dir, args.backend), embeddings,
+                        embedding_model_name).build(documents)
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+    # Warm the query cache so only retrieval is timed
+    for query, _ in queries:
+        embeddings.embed_query(query)
+
+    def describe(docs):
+        pairs = [f"Q: {doc.metadata['question']}\nA: {doc.page_content}" for doc in docs]
+        tokens = len(tokenizer.encode("\n".join(pairs)))
+        distinct = set().union(*(shingles(pair) for pair in pairs)) if pairs else set()
+        redundancy = 0.0
+        if len(docs) > 1:
+            vectors = normalize_rows(embeddings.embed_documents([doc.page_content for doc in docs]))
+            similarity = vectors @ vectors.T
+            np.fill_diagonal(similarity, -1.0)
+            redundancy = float(similarity.max(axis=1).mean())
+        return tokens, len(distinct) / max(tokens, 1), redundancy
+
+    strategies = [(f"top-{args.k}", lambda q: store.search(q, k=args.k))]
+    for lambda_mult in args.lambdas:
+        strategies.append((f"mmr lambda={lambda_mult}",
+                           lambda q, lambda_mult=lambda_mult: store.mmr_search(
+                               q, k=args.k, fetch_k=args.fetch_k, lambda_mult=lambda_mult)))
+
+    results = []
+    for name, retrieve in strategies:
+        latencies, tokens, coverage, redundancy, hits = [], [], [], [], 0
+        for query, expected_id in queries:
+            start = time.perf_counter()
+            docs = retrieve(query)
+            latencies.append(time.perf_counter() - start)
+            hits += expected_id in [document_id(doc) for doc in docs]
+            doc_tokens, doc_coverage, doc_redundancy = describe(docs)
+            tokens.append(doc_tokens)
+            coverage.append(doc_coverage)
+            redundancy.append(doc_redundancy)
+        results.append({
+            "strategy": name,
+            "retrieve_p50_ms": percentile_ms(latencies, 50),
+            "retrieve_p95_ms": percentile_ms(latencies, 95),
+            "hit_rate": hits / max(len(queries), 1),
+            "context_tokens": float(np.mean(tokens)) if tokens else 0.0,
+            "coverage_per_token": float(np.mean(coverage)) if coverage else 0.0,
+            "redundancy": float(np.mean(redundancy)) if redundancy else 0.0,
+        })
+    baseline = results[0]["retrieve_p50_ms"]
+    for result in results:
+        result["overhead_p50_ms"] = result["retrieve_p50_ms"] - baseline
+
+    print(f"\n{len(documents)} documents, {len(queries)} queries, k={args.k}, fetch_k={args.fetch_k}, "
+          f"backend {args.backend}\n")
+    print_table(results, ["strategy", "retrieve_p50_ms", "retrieve_p95_ms", "overhead_p50_ms", "hit_rate",
+                          "context_tokens", "coverage_per_token", "redundancy"])
+
+
+def run_replay(args):
+    """
+    Re-run recorded traffic (TRAFFIC_RECORD_DIR) through a pipeline profile and compare it
+    with a baseline: the recording itself, or a previous replay saved with --output.
+
+    Replaying the current build with --output and then the candidate with --baseline
+    compares both under the same conditions; the recording's own timings include
+    production concurrency. Exits with status 1 when a stage's p95 or the retrieval
+    overlap crosses its limit, so embedder, index or prompt changes can be gated on it.
+    """
+    from bty_chtbt.pipeline import build_pipeline, load_config
+    from bty_chtbt.traffic import (
+        compare_runs,
+        read_records,
+        regressions,
+        replay_records,
+        write_records,
+    )
+
+    records = read_records(args.recording)[:args.limit or None]
+    baseline = read_records(args.baseline) if args.baseline else records
+    config = load_config(args.profile)
+    if args.llm == "mock":
+        config["llm"] = {"provider": "mock", "latency_ms": args.mock_latency_ms}
+    pipeline = build_pipeline(args.profile, config=config)
+    candidate = replay_records(pipeline, records)
+    if args.output:
+        write_records(args.output, candidate)
+
+    report = compare_runs(baseline, candidate)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"\n{report['requests']} requests replayed through profile {args.profile} ({args.llm} LLM), "
+          f"baseline {args.baseline or args.recording}\n")
+    print_table(report["latency"], ["stage", "baseline_p50_ms", "candidate_p50_ms", "baseline_p95_ms",
+                                    "candidate_p95_ms", "p95_change"])
+    retrieval = report["retrieval"]
+    print(f"\nRetrieval: {retrieval['identical_rate']:.1%} identical, {retrieval['same_top1_rate']:.1%} same top-1, "
+          f"mean overlap {retrieval['mean_overlap']:.3f}, {retrieval['changed']} changed")
+    for example in retrieval["examples"]:
+        print(f"  {example['overlap']:.2f}  {example['query']}  -{example['removed']} +{example['added']}")
+    print(f"Tokens: {report['tokens']}")
+
+    # A mocked model says nothing about generation latency, and queue wait only exists in production
+    ignored = {"queue"} | ({"generate"} if args.llm == "mock" else set())
+    problems = regressions(report, max_p95_regression=args.max_p95_regression, min_overlap=args.min_overlap,
+                           min_delta_ms=args.min_delta_ms, ignore_stages=ignored)
+    for problem in problems:
+        print(f"REGRESSION: {problem}")
+    raise SystemExit(1 if problems else 0)
+
+
+def run_measure_vectors(args):
+    print(json.dumps(measure_vector_search(args.backend, args.path, args.queries_file, args.k, args.dtype)))
+
+
+def run_measure(args):
+    queries = load_queries(args.queries_file)
+    print(json.dumps(measure_backend(args.backend, args.path, queries, args.k)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval performance benchmarks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backends_parser = subparsers.add_parser("backends", help="Compare FAISS, Chroma and NumPy backends.")
+    backends_parser.add_argument("--books", default=books_dir, help="Directory of Q&A CSV files.")
+    backends_parser.add_argument("--backends", nargs="+", default=sorted(BACKENDS), choices=sorted(BACKENDS))
+    backends_parser.add_argument("--queries", type=int, default=200, help="Number of corpus questions to search.")
+    backends_parser.add_argument("--k", type=int, default=3)
+    backends_parser.add_argument("--work-dir", default=None, help="Where to build the stores (default: temp dir).")
+    backends_parser.set_defaults(func=run_backends)
+
+    numpy_parser = subparsers.add_parser("numpy", help="Compare the NumPy search engine with FAISS.load_local.")
+    numpy_parser.add_argument("--books", default=books_dir, help="Directory of Q&A CSV files.")
+    numpy_parser.add_argument("--dtypes", nargs="+", default=list(STORAGE_DTYPES), choices=STORAGE_DTYPES)
+    numpy_parser.add_argument("--queries", type=int, default=200, help="Number of corpus questions to search.")
+    numpy_parser.add_argument("--k", type=int, default=3)
+    numpy_parser.add_argument("--work-dir", default=None, help="Where to build the stores (default: temp dir).")
+    numpy_parser.set_defaults(func=run_numpy)
+
+    rerank_parser = subparsers.add_parser("rerank", help="Compare dense top-k with cross-encoder reranking.")
+    rerank_parser.add_argument("--books", default=books_dir, help="Directory of Q&A CSV files.")
+    rerank_parser.add_argument("--backend", default="faiss", choices=sorted(BACKENDS))
+    rerank_parser.add_argument("--runtime", default="onnx", choices=["onnx", "torch"])
+    rerank_parser.add_argument("--queries", type=int, default=200, help="Number of corpus questions to search.")
+    rerank_parser.add_argument("--k", type=int, default=3, help="Dense-only documents per prompt.")
+    rerank_parser.add_argument("--candidates", type=int, default=12, help="Dense candidates to rerank.")
+    rerank_parser.add_argument("--top-n", type=int, default=2, help="Documents kept after reranking.")
+    rerank_parser.add_argument("--generate", type=int, default=0,
+                               help="Also time N end-to-end answers through qa_lms_chatbot.")
+    rerank_parser.add_argument("--work-dir", default=None, help="Where to build the store (default: temp dir).")
+    rerank_parser.set_defaults(func=run_rerank)
+
+    mmr_parser = subparsers.add_parser("mmr", help="Compare plain top-k with MMR-diversified retrieval.")
+    mmr_parser.add_argument("--books", default=books_dir, help="Directory of Q&A CSV files.")
+    mmr_parser.add_argument("--backend", default="faiss", choices=sorted(BACKENDS))
+    mmr_parser.add_argument("--queries", type=int, default=200, help="Number of corpus questions to search.")
+    mmr_parser.add_argument("--k", type=int, default=3)
+    mmr_parser.add_argument("--fetch-k", type=int, default=20, help="Candidates MMR chooses from.")
+    mmr_parser.add_argument("--lambdas", type=float, nargs="+", default=[1.0, 0.7, 0.5, 0.3])
+    mmr_parser.add_argument("--work-dir", default=None, help="Where to build the store (default: temp dir).")
+    mmr_parser.set_defaults(func=run_mmr)
+
+    replay_parser = subparsers.add_parser("replay", help="Replay recorded traffic and report latency/retrieval changes.")
+    replay_parser.add_argument("recording", help="Recorded JSONL file or TRAFFIC_RECORD_DIR directory.")
+    replay_parser.add_argument("--profile", default="lms", help="Pipeline profile in pipelines.toml to replay through.")
+    replay_parser.add_argument("--llm", default="mock", choices=["mock", "real"],
+                               help="Mock the LLM (default) or call the profile's configured one.")
+    replay_parser.add_argument("--mock-latency-ms", type=float, default=0, help="Fixed latency of the mocked LLM.")
+    replay_parser.add_argument("--baseline", default=None,
+                               help="Previous replay output to compare against (default: the recording).")
+    replay_parser.add_argument("--output", default=None, help="Write this replay's records (a future --baseline).")
+    replay_parser.add_argument("--report", default=None, help="Write the comparison as JSON.")
+    replay_parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests.")
+    replay_parser.add_argument("--max-p95-regression", type=float, default=0.2,
+                               help="Fail when a stage's p95 grows by more than this fraction.")
+    replay_parser.add_argument("--min-delta-ms", type=float, default=5.0,
+                               help="Ignore p95 increases smaller than this many milliseconds.")
+    replay_parser.add_argument("--min-overlap", type=float, default=0.9,
+                               help="Fail when the mean retrieved-document overlap falls below this.")
+    replay_parser.set_defaults(func=run_replay)
+
+    # Internal: measure a single backend in a fresh process
+    measure_parser = subparsers.add_parser("_measure")
+    measure_parser.add_argument("--backend", required=True)
+    measure_parser.add_argument("--path", required=True)
+    measure_parser.add_argument("--queries-file", required=True)
+    measure_parser.add_argument("--k", type=int, default=3)
+    measure_parser.set_defaults(func=run_measure)
+
+    measure_vectors_parser = subparsers.add_parser("_measure_vectors")
+    measure_vectors_parser.add_argument("--backend", required=True)
+    measure_vectors_parser.add_argument("--path", required=True)
+    measure_vectors_parser.add_argument("--queries-file", required=True)
+    measure_vectors_parser.add_argument("--k", type=int, default=3)
+    measure_vectors_parser.add_argument("--dtype", default=None)
+    measure_vectors_parser.set_defaults(func=run_measure_vectors)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from bty_chtbt.embedding_cache import normalize_text
+
+# Lower value is served first. Line replies have a short reply-token lifetime, batch
+# jobs (replays, evaluations) can always wait.
+PRIORITIES = {"line": 0, "web": 1, "batch": 2}
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of being queued or run."""
+
+    def __init__(self, reason, retry_after=1.0):
+        super().__init__(f"Request shed: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """Consume one token. Returns 0.0 on success, else the seconds until one is available."""
+        now = time.monotonic() if now is None else now
+        # now may predate a bucket created after the caller read the clock
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token bucket per key (session id, client IP, ...).
+
+    Buckets unused for idle_seconds are dropped, and at most max_keys are kept (least
+    recently used first), so a scan over many IPs cannot grow memory without bound.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, idle_seconds=600):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def check(self, key):
+        """Returns 0.0 if the request may proceed, otherwise the Retry-After in seconds."""
+        now = time.monotonic()
+        with self._lock:
+            while self._buckets:
+                oldest_key, oldest = next(iter(self._buckets.items()))
+                if now - oldest.updated < self.idle_seconds and len(self._buckets) < self.max_keys:
+                    break
+                del self._buckets[oldest_key]
+            bucket = self._buckets.pop(key, None) or TokenBucket(self.rate, self.burst)
+            self._buckets[key] = bucket
+            retry_after = bucket.take(now)
+            if retry_after:
+                self.limited += 1
+            return retry_after
+
+    def stats(self):
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, "keys": len(self._buckets), "limited": self.limited}
+
+
+class _Waiter:
+    def __init__(self, priority, enqueued_at):
+        self.priority = priority
+        self.enqueued_at = enqueued_at
+        self.event = threading.Event()
+        self.granted = False
+        self.evicted = False
+
+
+class AdmissionController:
+    """
+    Bounded, prioritized admission for the chat path.
+
+    At most max_concurrent requests run at once; the rest wait in a priority queue of at
+    most max_queue entries (FIFO within a priority). A request is shed with Overloaded
+    instead of queued when:
+    - the queue is full and nothing of lower priority can be evicted to make room,
+    - the expected wait (requests ahead of it x recent service time / slots) already
+      exceeds target_queue_seconds, or
+    - it has waited target_queue_seconds without getting a slot.
+    Shedding early keeps the latency of admitted requests predictable under overload.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=32, target_queue_seconds=5.0, history_size=512):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.target_queue_seconds = target_queue_seconds
+        self._lock = threading.Lock()
+        self._queue = []  # heap of (priority, sequence, waiter)
+        self._sequence = itertools.count()
+        self._running = 0
+        # Exponentially weighted service time; seeds the expected-wait estimate
+        self._service_seconds = None
+        self._waits = deque(maxlen=history_size)
+        self.admitted = 0
+        self.completed = 0
+        self.shed = {"queue_full": 0, "expected_wait": 0, "queue_timeout": 0, "evicted": 0}
+
+    def _expected_wait(self, priority):
+        if self._service_seconds is None:
+            return 0.0
+        ahead = sum(1 for entry in self._queue if entry[0] <= priority)
+        return (ahead + 1) * self._service_seconds / self.max_concurrent
+
+    def _shed(self, reason, retry_after=None):
+        self.shed[reason] += 1
+        raise Overloaded(reason, retry_after or max(1.0, self._service_seconds or 1.0))
+
+    def _enqueue(self, priority):
+        if self._running < self.max_concurrent and not self._queue:
+            self._running += 1
+            return None
+        if self._expected_wait(priority) > self.target_queue_seconds:
+            self._shed("expected_wait")
+        if len(self._queue) >= self.max_queue:
+            # Make room by evicting the newest request of the lowest priority, if lower than ours
+            worst = max(self._queue, key=lambda entry: (entry[0], entry[1]))
+            if worst[0] <= priority:
+                self._shed("queue_full")
+            self._queue.remove(worst)
+            heapq.heapify(self._queue)
+            worst[2].evicted = True
+            worst[2].event.set()
+        waiter = _Waiter(priority, time.monotonic())
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        return waiter
+
+    def _release(self, seconds):
+        with self._lock:
+            self.completed += 1
+            if self._service_seconds is None:
+                self._service_seconds = seconds
+            else:
+                self._service_seconds = 0.8 * self._service_seconds + 0.2 * seconds
+            # Hand the slot straight to the next waiter so it cannot be taken out of order
+            if self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._running -= 1
+
+    def acquire(self, priority="web"):
+        """Wait for a slot (at most target_queue_seconds); raises Overloaded when shed."""
+        rank = PRIORITIES[priority]
+        with self._lock:
+            waiter = self._enqueue(rank)
+            if waiter is None:
+                self.admitted += 1
+                self._waits.append(0.0)
+                return 0.0
+        waiter.event.wait(self.target_queue_seconds)
+        with self._lock:
+            waited = time.monotonic() - waiter.enqueued_at
+            if waiter.granted:
+                self.admitted += 1
+                self._waits.append(waited)
+                return waited
+            if waiter.evicted:
+                self._shed("evicted")
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            self._shed("queue_timeout")
+
+    @contextmanager
+    def admit(self, priority="web"):
+        """Run the enclosed block in an admitted slot; yields the seconds spent queued."""
+        waited = self.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self._release(time.monotonic() - start)
+
+    def stats(self):
+        with self._lock:
+            by_priority = {name: sum(1 for entry in self._queue if entry[0] == rank)
+                           for name, rank in PRIORITIES.items()}
+            waits = np.array(self._waits) if self._waits else None
+            return {
+                "running": self._running,
+                "max_concurrent": self.max_concurrent,
+                "queue_depth": len(self._queue),
+                "queue_depth_by_priority": by_priority,
+                "max_queue": self.max_queue,
+                "target_queue_ms": round(self.target_queue_seconds * 1000),
+                "queue_wait_p50_ms": round(float(np.percentile(waits, 50)) * 1000, 1) if waits is not None else None,
+                "queue_wait_p95_ms": round(float(np.percentile(waits, 95)) * 1000, 1) if waits is not None else None,
+                "service_ms": round(self._service_seconds * 1000, 1) if self._service_seconds else None,
+                "admitted": self.admitted,
+                "completed": self.completed,
+                "shed": dict(self.shed),
+            }
+
+
+class RecentAnswers:
+    """Small TTL'd LRU of recent answers by normalized question, served when a request is shed."""
+
+    def __init__(self, max_entries=500, ttl=900):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._answers = OrderedDict()
+        self._lock = threading.Lock()
+        self.served = 0
+
+    @staticmethod
+    def _key(query):
+        return normalize_text(query).lower()
+
+    def put(self, query, answer):
+        with self._lock:
+            key = self._key(query)
+            self._answers.pop(key, None)
+            self._answers[key] = (time.monotonic(), answer)
+            while len(self._answers) > self.max_entries:
+                self._answers.popitem(last=False)
+
+    def get(self, query):
+        with self._lock:
+            entry = self._answers.get(self._key(query))
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                return None
+            self.served += 1
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._answers.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._answers), "served": self.served}
+
+
+def admission_from_env():
+    """
+    AdmissionController and per-session / per-IP RateLimiters configured from the environment.
+
+    ADMISSION_MAX_CONCURRENT (4), ADMISSION_MAX_QUEUE (32), ADMISSION_TARGET_QUEUE_MS (5000),
+    RATE_LIMIT_SESSION / RATE_LIMIT_SESSION_BURST (0.5/s, 5) and RATE_LIMIT_IP /
+    RATE_LIMIT_IP_BURST (2/s, 30). A rate of 0 disables that limiter (returned as None).
+    """
+    controller = AdmissionController(
+        max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "4")),
+        max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+        target_queue_seconds=float(os.getenv("ADMISSION_TARGET_QUEUE_MS", "5000")) / 1000,
+    )
+    limiters = {}
+    for name, rate, burst in (("session", "0.5", "5"), ("ip", "2", "30")):
+        rate = float(os.getenv(f"RATE_LIMIT_{name.upper()}", rate))
+        burst = float(os.getenv(f"RATE_LIMIT_{name.upper()}_BURST", burst))
+        limiters[name] = RateLimiter(rate, burst) if rate > 0 else None
+    return controller, limiters["session"], limiters["ip"]
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # zlib is always available; zstd is preferred for size and speed
+    zstandard = None
+
+# Single-file vector store: everything a loader needs in one object that can be
+# downloaded atomically (or in parallel byte ranges) and memory-mapped in place.
+#
+#   MAGIC (8 bytes) | header length (uint32 LE) | header JSON | padding | sections...
+#
+# The header holds the manifest (format version, embedding model, dtype, row count)
+# and, per section, its offset, length, codec and sha256. The vectors section is
+# stored uncompressed by default and aligned, so it can be mapped without a copy;
+# the docstore and ids are compressed and only decoded when first needed.
+MAGIC = b"BTYVEC\x00\x01"
+FORMAT_VERSION = 1
+SECTION_ALIGNMENT = 4096
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+
+
+def _compress(data, codec, level=9):
+    if codec == "none":
+        return data
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed; use codec='zlib'")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    raise ValueError(f"Unknown artifact codec '{codec}'")
+
+
+def _decompress(data, codec):
+    if codec == "none":
+        return data
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This artifact is zstd-compressed; install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown artifact codec '{codec}'")
+
+
+def _json_bytes(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _align(offset, alignment=SECTION_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def write_artifact(path, index, ids, documents, embedding_model, inverted_index=None,
+                   codec=DEFAULT_CODEC, compress_vectors=False):
+    """
+    Write a NumpyIndex plus its documents as one artifact file.
+
+    The file is written next to path and renamed into place, so readers never see a
+    partial artifact. compress_vectors trades the zero-copy mmap of the vectors for a
+    smaller download (the loader then decompresses them into memory).
+    """
+    vectors = np.ascontiguousarray(index.vectors)
+    vector_codec = codec if compress_vectors else "none"
+    payloads = [
+        ("vectors", vectors.tobytes(), vector_codec),
+        ("ids", _json_bytes(list(ids)), codec),
+        ("docstore", _json_bytes([{"page_content": doc.page_content, "metadata": doc.metadata}
+                                  for doc in documents]), codec),
+    ]
+    if index.scales is not None:
+        payloads.append(("scales", np.ascontiguousarray(index.scales, dtype=np.float32).tobytes(), "none"))
+    if inverted_index is not None:
+        payloads.append(("inverted_index", _json_bytes(inverted_index), codec))
+
+    sections = {}
+    blobs = []
+    offset = 0
+    for name, raw, section_codec in payloads:
+        stored = _compress(raw, section_codec)
+        sections[name] = {
+            "offset": offset,
+            "length": len(stored),
+            "raw_length": len(raw),
+            "codec": section_codec,
+            "sha256": hashlib.sha256(stored).hexdigest(),
+        }
+        blobs.append((offset, stored))
+        offset = _align(offset + len(stored))
+
+    header = _json_bytes({
+        "format_version": FORMAT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "embedding_model": embedding_model,
+        "dtype": index.dtype,
+        "count": len(ids),
+        "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "sections": sections,
+    })
+    # Section offsets are relative to the first aligned byte after the header
+    data_start = _align(len(MAGIC) + 4 + len(header))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for section_offset, stored in blobs:
+            f.seek(data_start + section_offset)
+            f.write(stored)
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return path
+
+
+class VectorArtifact:
+    """
+    Read-only view of an artifact file.
+
+    Opening it reads only the header. vectors() memory-maps the vector section; the
+    compressed sections are decoded (and checksummed) on first access and cached.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        self.verify = verify
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a vector store artifact")
+            (header_length,) = struct.unpack("<I", f.read(4))
+            self.manifest = json.loads(f.read(header_length).decode("utf-8"))
+        if self.manifest.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"{path} has artifact format {self.manifest.get('format_version')}, "
+                             f"this loader reads format {FORMAT_VERSION}")
+        self.data_start = _align(len(MAGIC) + 4 + header_length)
+        self._cache = {}
+
+    @property
+    def embedding_model(self):
+        return self.manifest.get("embedding_model", "")
+
+    def check_embedding_model(self, embedding_model_name):
+        """Reject an artifact built with a different embedding model."""
+        if embedding_model_name and self.embedding_model and self.embedding_model != embedding_model_name:
+            raise ValueError(f"{self.path} was built with {self.embedding_model}, "
+                             f"not {embedding_model_name}; rebuild the artifact with the serving model")
+
+    def has_section(self, name):
+        return name in self.manifest["sections"]
+
+    def _read(self, name):
+        section = self.manifest["sections"][name]
+        with open(self.path, "rb") as f:
+            f.seek(self.data_start + section["offset"])
+            stored = f.read(section["length"])
+        if self.verify and hashlib.sha256(stored).hexdigest() != section["sha256"]:
+            raise ValueError(f"Checksum mismatch in section '{name}' of {self.path}")
+        return _decompress(stored, section["codec"])
+
+    def _array(self, name, dtype, shape):
+        section = self.manifest["sections"][name]
+        if section["codec"] == "none" and not self.verify:
+            return np.memmap(self.path, dtype=dtype, mode="r",
+                             offset=self.data_start + section["offset"], shape=shape)
+        if section["codec"] == "none":
+            # Hash through the mapping so verification does not keep a second copy around
+            mapped = np.memmap(self.path, dtype=np.uint8, mode="r",
+                               offset=self.data_start + section["offset"], shape=(section["length"],))
+            if hashlib.sha256(mapped).hexdigest() != section["sha256"]:
+                raise ValueError(f"Checksum mismatch in section '{name}' of {self.path}")
+            return mapped.view(dtype).reshape(shape)
+        return np.frombuffer(self._read(name), dtype=dtype).reshape(shape)
+
+    def vectors(self):
+        count, dim = self.manifest["count"], self.manifest["dim"]
+        return self._array("vectors", np.dtype(self.manifest["dtype"]), (count, dim))
+
+    def scales(self):
+        if not self.has_section("scales"):
+            return None
+        return np.array(self._array("scales", np.float32, (self.manifest["count"],)))
+
+    def _json(self, name):
+        if name not in self._cache:
+            self._cache[name] = json.loads(self._read(name).decode("utf-8")) if self.has_section(name) else None
+        return self._cache[name]
+
+    def ids(self):
+        return self._json("ids")
+
+    def docstore(self):
+        return self._json("docstore")
+
+    def inverted_index(self):
+        return self._json("inverted_index")
@@ -0,0 +1,117 @@
+from langchain_core.documents import Document
+
+from bty_chtbt.vector_backend import document_id
+
+# Metadata added to chunks of long answers; the other schema fields are copied from the parent
+CHUNK_FIELDS = ("parent_id", "chunk_index", "chunk_count", "start_index")
+# Split on paragraph, line and Chinese/ASCII sentence boundaries before falling back to characters
+CHUNK_SEPARATORS = ["\n\n", "\n", "。", "！", "？", "；", "!", "?", ";", "，", ",", " ", ""]
+
+
+def make_splitter(chunk_tokens=256, overlap_tokens=32, encoding_name="cl100k_base"):
+    """Token-bounded splitter (same tokenizer as count_tokens) that records each chunk's offset."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=encoding_name,
+        chunk_size=chunk_tokens,
+        chunk_overlap=overlap_tokens,
+        separators=CHUNK_SEPARATORS,
+        keep_separator="end",
+        add_start_index=True,
+    )
+
+
+def split_long_answers(documents, splitter):
+    """
+    Replace documents whose answer exceeds the splitter's chunk size with overlapping chunks.
+
+    Each chunk keeps the parent's metadata plus parent_id (the parent's document id),
+    chunk_index, chunk_count and start_index (character offset in the parent answer),
+    which is enough to rebuild the parent from its chunks. Short answers pass through
+    unchanged, so stores without long answers are identical to unchunked ones.
+    """
+    chunked = []
+    for doc in documents:
+        pieces = splitter.create_documents([doc.page_content])
+        if len(pieces) <= 1:
+            chunked.append(doc)
+            continue
+        parent_id = document_id(doc)
+        for chunk_index, piece in enumerate(pieces):
+            metadata = dict(doc.metadata)
+            metadata.update({
+                "parent_id": parent_id,
+                "chunk_index": chunk_index,
+                "chunk_count": len(pieces),
+                "start_index": piece.metadata["start_index"],
+            })
+            chunked.append(Document(page_content=piece.page_content, metadata=metadata))
+    return chunked
+
+
+def chunk_ids(parent_id, chunk_count):
+    return [f"{parent_id}#{chunk_index}" for chunk_index in range(chunk_count)]
+
+
+def merge_chunks(chunks):
+    """Rebuild text from overlapping chunks using their start offsets; gaps are marked with "…"."""
+    text = ""
+    end = 0  # offset in the parent answer where text currently ends
+    for chunk in sorted(chunks, key=lambda doc: int(doc.metadata["start_index"])):
+        start = int(chunk.metadata["start_index"])
+        content = chunk.page_content
+        if text and start <= end:
+            text += content[end - start:]
+        else:
+            text += ("…" if text else "") + content
+        end = max(end, start + len(content))
+    return text
+
+
+def _parent_document(chunks, page_content):
+    metadata = {key: value for key, value in chunks[0].metadata.items() if key not in CHUNK_FIELDS}
+    return Document(page_content=page_content, metadata=metadata)
+
+
+def expand_to_parents(docs, vector_store, count_tokens, budget_tokens):
+    """
+    Turn retrieved chunks back into answers for the prompt.
+
+    Results are grouped by parent in rank order, so several matching chunks of one
+    answer take a single slot. A parent is expanded to its full answer while the total
+    stays within budget_tokens; otherwise only its matched chunks are kept (merged in
+    answer order). Unchunked documents are passed through unchanged.
+    """
+    groups = []
+    by_parent = {}
+    for doc in docs:
+        parent_id = doc.metadata.get("parent_id")
+        if not parent_id:
+            groups.append((None, [doc]))
+        elif parent_id in by_parent:
+            by_parent[parent_id].append(doc)
+        else:
+            by_parent[parent_id] = [doc]
+            groups.append((parent_id, by_parent[parent_id]))
+
+    results = []
+    used_tokens = 0
+    for parent_id, matched in groups:
+        if parent_id is None:
+            results.append(matched[0])
+            used_tokens += count_tokens(matched[0].page_content)
+            continue
+        siblings = vector_store.get(chunk_ids(parent_id, int(matched[0].metadata["chunk_count"])))
+        if len(siblings) == int(matched[0].metadata["chunk_count"]):
+            full_text = merge_chunks(siblings)
+            full_tokens = count_tokens(full_text)
+            if used_tokens + full_tokens <= budget_tokens:
+                results.append(_parent_document(matched, full_text))
+                used_tokens += full_tokens
+                continue
+        # Parent does not fit (or is incomplete): keep just the relevant part of the answer
+        partial = _parent_document(matched, merge_chunks(matched))
+        results.append(partial)
+        used_tokens += count_tokens(partial.page_content)
+    return results
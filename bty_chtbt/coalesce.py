@@ -0,0 +1,83 @@
+import hashlib
+import threading
+
+from bty_chtbt.embedding_cache import normalize_text
+from bty_chtbt.vector_backend import document_id
+
+
+def coalesce_key(query, retrieved_docs, history_context=""):
+    """
+    Key under which identical in-flight requests share one generation.
+
+    Two requests coalesce only if the normalized question, the retrieved documents
+    (in order) and the rendered history are all the same, i.e. they would send the
+    same prompt to the model.
+    """
+    parts = [normalize_text(query).lower()]
+    parts.extend(document_id(doc) for doc in retrieved_docs)
+    parts.append(normalize_text(history_context))
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time; concurrent callers with the same key wait
+    for that call and share its result (or its exception).
+
+    Nothing is kept once the call finishes, so this only deduplicates requests that
+    overlap in time and never serves a stale answer.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Return fn() for key, running it only if no identical call is in flight.
+
+        Followers wait up to timeout seconds and raise TimeoutError if the leader has
+        not finished by then (the leader keeps running).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError("Timed out waiting for an identical in-flight request")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        return {"in_flight": self.in_flight(), "leaders": self.leaders, "shared": self.shared}
@@ -0,0 +1,177 @@
+import csv
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from bty_chtbt.embedding_cache import normalize_text
+from bty_chtbt.vector_backend import document_id
+
+# Modulus of the MinHash permutations (a Mersenne prime above the 32-bit shingle hashes)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Punctuation and whitespace do not distinguish two phrasings of a question
+_NON_WORD = re.compile(r"[\W_]+")
+REPORT_COLUMNS = ["duplicate_id", "kept_id", "similarity", "action", "duplicate_question", "kept_question"]
+
+
+def shingles(text, k=2):
+    """Set of character k-grams of the normalized text (bigrams suit short CJK questions)."""
+    text = _NON_WORD.sub("", normalize_text(text).lower())
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+class MinHasher:
+    """Vectorized MinHash: num_perm universal hash permutations applied to all shingles at once."""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+    def signature(self, shingle_set):
+        if not shingle_set:
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingle_set),
+                             dtype=np.uint64, count=len(shingle_set))
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+class NearDuplicateIndex:
+    """
+    Streaming near-duplicate detection over question + answer text.
+
+    Each document's MinHash signature is split into bands for locality-sensitive hashing:
+    documents sharing any band are candidates, and a candidate counts as a duplicate when
+    the estimated Jaccard similarity of their character shingles is at least threshold.
+    Documents are checked against everything seen before them, so the first copy (in
+    file order) is always the one kept.
+    """
+
+    def __init__(self, threshold=0.7, num_perm=64, bands=16, shingle_size=2):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm)
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+        self._signatures = []
+        self._keys = []
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, key, text):
+        """Index text under key. Returns (kept_key, similarity) of its best earlier match, or None."""
+        signature = self.hasher.signature(shingles(text, self.shingle_size))
+        band_keys = self._band_keys(signature)
+        candidates = set()
+        for band, band_key in enumerate(band_keys):
+            candidates.update(self._buckets[band].get(band_key, ()))
+        match = None
+        if candidates:
+            positions = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarities = (np.stack([self._signatures[i] for i in positions]) == signature).mean(axis=1)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                match = (self._keys[positions[best]], float(similarities[best]))
+        if match is None:
+            # Only first copies are indexed, so a chain of near-duplicates keeps pointing at one document
+            position = len(self._keys)
+            self._keys.append(key)
+            self._signatures.append(signature)
+            for band, band_key in enumerate(band_keys):
+                self._buckets[band][band_key].append(position)
+        return match
+
+
+def collapse_duplicates(docs, k=None):
+    """
+    Keep the best-ranked document of each near-duplicate group in retrieval results.
+
+    A flagged row (duplicate_of set by Deduplicator) belongs to the group of the row it
+    duplicates, in whatever file or category it is. Chunks of one answer stay together;
+    expand_to_parents merges them. Returns at most k documents when k is given.
+    """
+    groups = {}
+    results = []
+    for doc in docs:
+        row_id = doc.metadata.get("parent_id") or document_id(doc)
+        rows = groups.setdefault(doc.metadata.get("duplicate_of") or row_id, {row_id})
+        if row_id not in rows:
+            continue
+        results.append(doc)
+        if k is not None and len(results) >= k:
+            break
+    return results
+
+
+class Deduplicator:
+    """
+    Build-time dedup stage for streamed Q&A Documents.
+
+    mode="flag" (default) keeps near-duplicates with duplicate_of/duplicate_similarity
+    metadata; the Retriever collapses each group to its best hit (collapse_duplicates). mode="merge" drops them (the
+    first copy's vector serves both phrasings), but only when both rows have the same
+    category and source_file: otherwise category filters and per-CSV shard rebuilds
+    would lose the row, so it is flagged instead. Every match is recorded for
+    write_report().
+    """
+
+    def __init__(self, mode="flag", threshold=0.7, **index_options):
+        if mode not in ("merge", "flag"):
+            raise ValueError(f"Unknown dedup mode {mode!r}; expected 'merge' or 'flag'")
+        self.mode = mode
+        self.index = NearDuplicateIndex(threshold=threshold, **index_options)
+        self.questions = {}
+        self.scopes = {}
+        self.matches = []
+        self.seen = 0
+
+    def filter(self, documents):
+        for doc in documents:
+            self.seen += 1
+            key = document_id(doc)
+            question = doc.metadata.get("question", "")
+            match = self.index.add(key, f"{question}\n{doc.page_content}")
+            scope = (doc.metadata.get("category", ""), doc.metadata.get("source_file", ""))
+            if match is None:
+                self.questions[key] = question
+                self.scopes[key] = scope
+                yield doc
+                continue
+            kept_key, similarity = match
+            drop = self.mode == "merge" and self.scopes.get(kept_key) == scope
+            self.matches.append({
+                "duplicate_id": key,
+                "kept_id": kept_key,
+                "similarity": round(similarity, 3),
+                "action": "dropped" if drop else "flagged",
+                "duplicate_question": question,
+                "kept_question": self.questions.get(kept_key, ""),
+            })
+            if not drop:
+                doc.metadata["duplicate_of"] = kept_key
+                doc.metadata["duplicate_similarity"] = round(similarity, 3)
+                yield doc
+
+    def write_report(self, path):
+        """Write one CSV row per near-duplicate, most similar first."""
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(sorted(self.matches, key=lambda match: -match["similarity"]))
+        return path
+
+    def __str__(self):
+        exact = sum(1 for match in self.matches if match["similarity"] >= 1.0)
+        dropped = sum(1 for match in self.matches if match["action"] == "dropped")
+        return (f"{len(self.matches)} near-duplicates of {self.seen} documents ({dropped} dropped, "
+                f"{len(self.matches) - dropped} flagged; {exact} exact, threshold {self.index.threshold})")
@@ -0,0 +1,347 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def normalize_text(text):
+    """Normalize text before hashing so trivial whitespace/width changes hit the same entry."""
+    text = unicodedata.normalize("NFKC", str(text))
+    return " ".join(text.split())
+
+
+def cache_key(model_name, text, kind="doc"):
+    """Content-addressed key: model name + embedding kind + normalized text hash."""
+    payload = f"{model_name}\0{kind}\0{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Fixed-capacity LRU cache of embeddings backed by a memory-mapped matrix.
+
+    Vectors live in `<name>.vectors` (one row per slot, float16 or float32), the SHA-1
+    of the key stored in each slot in `<name>.keys`, and the LRU order plus key -> slot
+    mapping in `<name>.index.json`. The matrices are created lazily once the embedding
+    dimension is known.
+
+    Every gunicorn worker maps the same files but keeps its own slot index, so two
+    workers may reuse the same slot. Reads therefore check the slot's stored key hash
+    (before and after copying the vector) and treat a mismatch as a miss: a slot that
+    was overwritten, or left half-written by a crash, never returns another text's
+    embedding. Writes and file creation hold an fcntl lock on `<name>.lock`.
+
+    The index is written by a background thread every flush_interval seconds (and at
+    exit), never on the request path; the JSON is serialized outside the lock that
+    get_many/put_many take. After a crash, entries added since the last flush are lost
+    but their slots are simply reused.
+
+    Pages of the mapped files that a worker has touched count towards its RSS; shrink()
+    (the memory governor's shrinker) forgets the older entries and re-maps the files.
+    """
+
+    FORMAT_VERSION = 2
+    KEY_BYTES = 20  # SHA-1 digest, see cache_key()
+
+    def __init__(self, cache_dir, model_name, capacity=50000, dtype="float16", flush_interval=30.0):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        self.flush_interval = flush_interval
+        safe_name = model_name.replace("/", "__")
+        self.vectors_path = os.path.join(cache_dir, f"{safe_name}.vectors")
+        self.keys_path = os.path.join(cache_dir, f"{safe_name}.keys")
+        self.index_path = os.path.join(cache_dir, f"{safe_name}.index.json")
+        self.lock_path = os.path.join(cache_dir, f"{safe_name}.lock")
+        self.dim = None
+        self.disabled = False
+        self._vectors = None
+        self._keys = None
+        self._slots = OrderedDict()  # key -> slot, least recently used first
+        self._free = []
+        self._hand = 0  # clock hand for when every slot is taken by other workers
+        self._dirty = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.shrinks = 0
+        self._load_index()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared by every process using this cache."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        if not (os.path.exists(self.index_path) and os.path.exists(self.vectors_path)
+                and os.path.exists(self.keys_path)):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable embedding cache index {self.index_path}: {e}")
+            return
+        if (index.get("format") != self.FORMAT_VERSION
+                or index.get("model_name") != self.model_name
+                or index.get("dtype") != self.dtype.name
+                or index.get("capacity") != self.capacity):
+            print(f"Embedding cache {self.index_path} was built with different settings. Starting fresh.")
+            return
+        if not self._open_vectors(int(index["dim"])):
+            return
+        # Entries whose slot was since reused by another worker (or never written) are dropped
+        self._slots = OrderedDict((key, int(slot)) for key, slot in index["entries"]
+                                  if self._slot_holds(int(slot), key))
+        used = set(self._slots.values())
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+
+    def _open_vectors(self, dim):
+        """
+        Map the vector and key files, creating them if needed. Existing files are only
+        ever opened with "r+", never truncated. Returns False (and disables the cache) if
+        they exist with a different shape.
+        """
+        shapes = ((self.vectors_path, self.dtype, (self.capacity, dim)),
+                  (self.keys_path, np.dtype(np.uint8), (self.capacity, self.KEY_BYTES)))
+        with self._file_lock():
+            for path, dtype, shape in shapes:
+                expected = dtype.itemsize * shape[0] * shape[1]
+                if not os.path.exists(path):
+                    # Sparse file of zeros; an all-zero key hash marks an empty slot
+                    with open(path, "wb") as f:
+                        f.truncate(expected)
+                elif os.path.getsize(path) != expected:
+                    print(f"Embedding cache {path} has a different shape (dimension changed?). "
+                          f"Caching disabled; delete {self.cache_dir} to rebuild it.")
+                    self.disabled = True
+                    return False
+            self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r+",
+                                      shape=(self.capacity, dim))
+            self._keys = np.memmap(self.keys_path, dtype=np.uint8, mode="r+",
+                                   shape=(self.capacity, self.KEY_BYTES))
+        self.dim = dim
+        return True
+
+    def _ensure_vectors(self, dim):
+        if self._vectors is not None:
+            if dim != self.dim:
+                raise ValueError(f"Embedding dimension changed from {self.dim} to {dim} for {self.model_name}")
+            return True
+        if self.disabled or not self._open_vectors(dim):
+            return False
+        self._slots.clear()
+        self._free = list(range(self.capacity - 1, -1, -1))
+        return True
+
+    def _allocate(self):
+        """
+        A free slot (skipping ones another worker has filled since), else the LRU entry's.
+        When other workers have filled every slot and this one holds none, slots are taken
+        round-robin; their owners see the changed key hash and treat it as a miss.
+        """
+        while self._free:
+            slot = self._free.pop()
+            if not self._keys[slot].any():
+                return slot
+        if self._slots:
+            _, slot = self._slots.popitem(last=False)
+            return slot
+        slot = self._hand
+        self._hand = (self._hand + 1) % self.capacity
+        return slot
+
+    def _slot_holds(self, slot, key):
+        return self._keys[slot].tobytes() == bytes.fromhex(key)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def get_many(self, keys):
+        """Return a list with a float32 vector for every cached key and None for misses."""
+        results = []
+        with self._lock:
+            for key in keys:
+                slot = self._slots.get(key)
+                vector = None
+                if slot is not None and self._slot_holds(slot, key):
+                    vector = np.array(self._vectors[slot], dtype=np.float32)
+                    # A writer clears the hash before replacing the vector, so a changed hash
+                    # after the copy means the vector may be torn
+                    if not self._slot_holds(slot, key):
+                        vector = None
+                if vector is None:
+                    if slot is not None:
+                        # Slot reused by another worker: forget it, but do not free it
+                        del self._slots[key]
+                        self.collisions += 1
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self._slots.move_to_end(key)
+                self.hits += 1
+                results.append(vector)
+        return results
+
+    def put_many(self, keys, vectors):
+        """Store vectors under keys, evicting the least recently used entries when full."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self._lock:
+            if not self._ensure_vectors(vectors.shape[1]):
+                return
+            with self._file_lock():
+                for key, vector in zip(keys, vectors, strict=True):
+                    slot = self._slots.get(key)
+                    if slot is None:
+                        slot = self._allocate()
+                    self._slots[key] = slot
+                    self._slots.move_to_end(key)
+                    # Invalidate, write the vector, then publish the key hash
+                    self._keys[slot] = 0
+                    self._vectors[slot] = vector
+                    self._keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+                    self._dirty += 1
+            self._start_flusher()
+
+    def _start_flusher(self):
+        if self._flusher is None and self.flush_interval:
+            self._flusher = threading.Thread(target=self._flush_loop, name="embedding-cache-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Persist the vectors and the LRU index to disk."""
+        with self._flush_lock:
+            # Only the snapshot holds the request lock; msync and the JSON write happen outside it
+            with self._lock:
+                if self._vectors is None or not self._dirty:
+                    return
+                vectors, keys, dirty = self._vectors, self._keys, self._dirty
+                index = {
+                    "format": self.FORMAT_VERSION,
+                    "model_name": self.model_name,
+                    "dim": self.dim,
+                    "dtype": self.dtype.name,
+                    "capacity": self.capacity,
+                    "entries": list(self._slots.items()),
+                }
+                self._dirty = 0
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            try:
+                # Vectors and key hashes reach the disk before an index that refers to them
+                vectors.flush()
+                keys.flush()
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(index, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                print(f"Could not write embedding cache index {self.index_path}: {e}")
+                with self._lock:
+                    self._dirty += dirty
+
+    def shrink(self, keep=0.5):
+        """
+        Release memory under pressure: forget all but the most recently used keep fraction
+        of the entries (their slots become free), re-map the files so the pages this process
+        has touched are dropped from its RSS, and flush the index. Returns the number of entries dropped.
+        """
+        with self._lock:
+            if self._vectors is None:
+                return 0
+            dropped = len(self._slots) - int(len(self._slots) * keep)
+            if dropped > 0:
+                with self._file_lock():
+                    for _ in range(dropped):
+                        key, slot = self._slots.popitem(last=False)
+                        # Clear the hash so the slot can be reused (unless another worker already has)
+                        if self._slot_holds(slot, key):
+                            self._keys[slot] = 0
+                        self._free.append(slot)
+                self._dirty += dropped
+            dim = self.dim
+            # Dropping the memmaps unmaps the files (shared mappings, so written rows stay in
+            # the page cache); reopening maps them with no pages resident
+            self._vectors = None
+            self._keys = None
+            if not self._open_vectors(dim):
+                self._slots.clear()
+                self._free = []
+            self.shrinks += 1
+        self.flush()
+        print(f"Embedding cache shrunk: dropped {dropped} entries, {len(self._slots)} left")
+        return dropped
+
+    def stats(self):
+        return {
+            "entries": len(self._slots),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "collisions": self.collisions,
+            "shrinks": self.shrinks,
+            "disabled": self.disabled,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embeddings wrapper that only runs the underlying model on text it has not seen.
+
+    Can be passed anywhere a HuggingFaceEmbeddings instance is used today
+    (FAISS.from_documents, FAISS.load_local, Chroma, ...).
+    """
+
+    def __init__(self, embeddings, model_name, cache_dir, capacity=50000, dtype="float16"):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = EmbeddingCache(cache_dir, model_name, capacity=capacity, dtype=dtype)
+
+    def _embed(self, texts, kind, embed_fn):
+        keys = [cache_key(self.model_name, text, kind) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Deduplicate within the batch so repeated text is only embedded once
+            unique = {}
+            for i in missing:
+                unique.setdefault(keys[i], texts[i])
+            new_vectors = embed_fn(list(unique.values()))
+            self.cache.put_many(list(unique.keys()), new_vectors)
+            by_key = dict(zip(unique.keys(), new_vectors, strict=True))
+            for i in missing:
+                vectors[i] = by_key[keys[i]]
+        return [np.asarray(vector, dtype=np.float32).tolist() for vector in vectors]
+
+    def embed_documents(self, texts):
+        return self._embed(list(texts), "doc", self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self._embed([text], "query", lambda batch: [self.embeddings.embed_query(batch[0])])[0]
@@ -0,0 +1,137 @@
+import json
+import os
+
+# Metadata fields that get an inverted index at ingestion time and can be filtered on
+FILTER_FIELDS = ("category", "source_file")
+INVERTED_INDEX_NAME = "inverted_index.json"
+
+
+def parse_filter(text):
+    """
+    Parse a filter expression string into a filter dict.
+
+    Syntax: "field=value1,value2;field2=value3". Values within a field are OR-ed,
+    fields are AND-ed, e.g. "category=雷射,皮秒;source_file=laser.csv".
+    """
+    search_filter = {}
+    for clause in str(text).split(";"):
+        if not clause.strip():
+            continue
+        if "=" not in clause:
+            raise ValueError(f"Invalid filter clause '{clause}'. Expected field=value[,value].")
+        field, values = clause.split("=", 1)
+        search_filter[field.strip()] = [value.strip() for value in values.split(",") if value.strip()]
+    return normalize_filter(search_filter)
+
+
+def normalize_filter(search_filter):
+    """
+    Return a filter as {field: [values]} or None for "no filter".
+
+    Accepts None, a filter dict whose values are a string or a list of strings, or a
+    filter expression string (see parse_filter).
+    """
+    if not search_filter:
+        return None
+    if isinstance(search_filter, str):
+        return parse_filter(search_filter)
+    normalized = {}
+    for field, values in search_filter.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Cannot filter on '{field}'. Filterable fields: {FILTER_FIELDS}.")
+        if isinstance(values, str):
+            values = [values]
+        values = [str(value) for value in values if value is not None and str(value) != ""]
+        if values:
+            normalized[field] = values
+    return normalized or None
+
+
+def matches(metadata, search_filter):
+    """True if a document's metadata satisfies a normalized filter."""
+    if not search_filter:
+        return True
+    return all(str(metadata.get(field, "")) in values for field, values in search_filter.items())
+
+
+def build_inverted_index(items):
+    """Build {field: {value: [doc_id, ...]}} from (doc_id, metadata) pairs."""
+    inverted_index = {field: {} for field in FILTER_FIELDS}
+    for doc_id, metadata in items:
+        for field in FILTER_FIELDS:
+            inverted_index[field].setdefault(str(metadata.get(field, "")), []).append(doc_id)
+    return inverted_index
+
+
+def save_inverted_index(path, inverted_index):
+    index_path = os.path.join(path, INVERTED_INDEX_NAME)
+    with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(inverted_index, f, ensure_ascii=False)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def load_inverted_index(path):
+    """Return the saved inverted index, or None if the store predates it."""
+    index_path = os.path.join(path, INVERTED_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def select_ids(inverted_index, search_filter):
+    """Document ids matching a normalized filter: union within a field, intersection across fields."""
+    selected = None
+    for field, values in search_filter.items():
+        postings = inverted_index.get(field, {})
+        field_ids = set()
+        for value in values:
+            field_ids.update(postings.get(value, ()))
+        selected = field_ids if selected is None else selected & field_ids
+        if not selected:
+            return set()
+    return selected or set()
+
+
+def load_filter_rules():
+    """
+    Load channel/page -> filter rules.
+
+    Rules come from the RETRIEVAL_FILTERS environment variable (JSON) or the JSON file
+    named by RETRIEVAL_FILTERS_FILE, shaped like:
+        {"channels": {"line": "category=雷射"}, "pages": {"/laser": {"category": ["雷射"]}}}
+    """
+    raw = os.getenv("RETRIEVAL_FILTERS")
+    rules_file = os.getenv("RETRIEVAL_FILTERS_FILE")
+    if not raw and rules_file and os.path.exists(rules_file):
+        with open(rules_file, "r", encoding="utf-8") as f:
+            raw = f.read()
+    if not raw:
+        return {"channels": {}, "pages": {}}
+    rules = json.loads(raw)
+    return {"channels": rules.get("channels", {}), "pages": rules.get("pages", {})}
+
+
+_filter_rules = None
+
+
+def infer_filter(channel=None, page=None, explicit=None):
+    """
+    Combine the filter configured for the channel, the web page and an explicit filter.
+
+    Later sources win per field: channel < page (longest matching path prefix) < explicit.
+    Returns a normalized filter or None.
+    """
+    global _filter_rules
+    if _filter_rules is None:
+        _filter_rules = load_filter_rules()
+
+    combined = {}
+    if channel:
+        combined.update(normalize_filter(_filter_rules["channels"].get(channel)) or {})
+    if page:
+        prefixes = [prefix for prefix in _filter_rules["pages"] if page.startswith(prefix)]
+        if prefixes:
+            combined.update(normalize_filter(_filter_rules["pages"][max(prefixes, key=len)]) or {})
+    combined.update(normalize_filter(explicit) or {})
+    return combined or None
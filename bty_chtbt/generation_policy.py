@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Per-channel output budgets. Line replies are read on a phone, so they get the tightest cap.
+DEFAULT_CHANNEL_MAX_TOKENS = {"line": 200, "web": 300, "cli": 500}
+# Total wall-clock budget per request (seconds), propagated to the provider timeout
+DEFAULT_CHANNEL_DEADLINES = {"line": 20.0, "web": 45.0, "cli": 60.0}
+# The prompt template ends with "Answer:"; stop if the model starts writing another turn
+DEFAULT_STOP_SEQUENCES = ["\nUser Question:", "\nPrevious Q:", "\nQ:"]
+
+# Sentence terminators: CJK full stops/marks anywhere, ASCII ones only when followed by whitespace
+SENTENCE_END = re.compile(r"[。！？]|[.!?](?=\s)")
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's time budget is used up before the provider call starts."""
+
+
+class Deadline:
+    """Absolute per-request deadline that is threaded through to the provider timeout."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, minimum=1.0):
+        """Timeout to hand to the provider; raises if there is no useful time left."""
+        remaining = self.remaining()
+        if remaining < minimum:
+            raise DeadlineExceeded(f"Only {remaining:.2f}s left of the {self.seconds:.1f}s request budget")
+        return remaining
+
+
+def truncate_sentences(text, max_sentences):
+    """Return text cut after the max_sentences-th sentence terminator (unchanged if shorter)."""
+    if not max_sentences:
+        return text
+    for count, match in enumerate(SENTENCE_END.finditer(text), start=1):
+        if count == max_sentences:
+            return text[:match.end()]
+    return text
+
+
+class SentenceLimiter:
+    """
+    Accumulates streamed text and reports when the sentence limit has been reached.
+
+    Usage:
+        limiter = SentenceLimiter(3)
+        for chunk in stream:
+            if limiter.feed(chunk):
+                break
+        answer = limiter.text
+    """
+
+    def __init__(self, max_sentences):
+        self.max_sentences = max_sentences
+        self.parts = []
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done or not chunk:
+            return self.done
+        self.parts.append(chunk)
+        if self.max_sentences:
+            text = "".join(self.parts)
+            if len(SENTENCE_END.findall(text)) >= self.max_sentences:
+                self.parts = [truncate_sentences(text, self.max_sentences)]
+                self.done = True
+        return self.done
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+def _parse_channel_values(raw, cast):
+    # "line=200,web=300" -> {"line": 200, "web": 300}
+    values = {}
+    for item in (raw or "").split(","):
+        if "=" in item:
+            channel, value = item.split("=", 1)
+            values[channel.strip()] = cast(value.strip())
+    return values
+
+
+class AnswerLengthStats:
+    """Rolling window of answer lengths (in tokens) per channel."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._lengths = {}
+        self._lock = threading.Lock()
+
+    def record(self, channel, tokens):
+        with self._lock:
+            self._lengths.setdefault(channel, deque(maxlen=self.window)).append(int(tokens))
+
+    def percentile(self, channel, q):
+        with self._lock:
+            lengths = list(self._lengths.get(channel, ()))
+        return float(np.percentile(lengths, q)) if lengths else None
+
+    def count(self, channel):
+        with self._lock:
+            return len(self._lengths.get(channel, ()))
+
+
+class GenerationPolicy:
+    """
+    Decides max_tokens, stop sequences, sentence limit and timeout for each generation.
+
+    - max_tokens starts at the channel budget and, once min_samples answers have been
+      seen, adapts to headroom * p95 of recent answer lengths (never above the budget).
+    - max_sentences is enforced while streaming so generation stops as soon as the
+      answer is complete, mirroring the "3 sentences" instruction in the system prompt.
+    - The provider timeout comes from the per-request Deadline.
+
+    Budgets can be overridden with GENERATION_MAX_TOKENS / GENERATION_DEADLINES,
+    e.g. "line=150,web=300".
+    """
+
+    def __init__(self, channel_max_tokens=None, channel_deadlines=None, stop_sequences=None,
+                 max_sentences=3, temperature=0.9, min_tokens=64, headroom=1.3, min_samples=20):
+        self.channel_max_tokens = dict(DEFAULT_CHANNEL_MAX_TOKENS)
+        self.channel_max_tokens.update(_parse_channel_values(os.getenv("GENERATION_MAX_TOKENS"), int))
+        self.channel_max_tokens.update(channel_max_tokens or {})
+        self.channel_deadlines = dict(DEFAULT_CHANNEL_DEADLINES)
+        self.channel_deadlines.update(_parse_channel_values(os.getenv("GENERATION_DEADLINES"), float))
+        self.channel_deadlines.update(channel_deadlines or {})
+        self.stop_sequences = list(DEFAULT_STOP_SEQUENCES if stop_sequences is None else stop_sequences)
+        self.max_sentences = max_sentences
+        self.temperature = temperature
+        self.min_tokens = min_tokens
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.stats = AnswerLengthStats()
+
+    def deadline(self, channel):
+        return Deadline(self.channel_deadlines.get(channel, self.channel_deadlines["web"]))
+
+    def max_tokens(self, channel):
+        budget = self.channel_max_tokens.get(channel, self.channel_max_tokens["web"])
+        if self.stats.count(channel) < self.min_samples:
+            return budget
+        adaptive = int(self.stats.percentile(channel, 95) * self.headroom)
+        return max(self.min_tokens, min(budget, adaptive))
+
+    def params(self, channel, deadline=None):
+        """Provider-agnostic generation parameters for one request."""
+        deadline = deadline or self.deadline(channel)
+        return {
+            "max_tokens": self.max_tokens(channel),
+            "stop": list(self.stop_sequences),
+            "temperature": self.temperature,
+            "timeout": deadline.timeout(),
+            "max_sentences": self.max_sentences,
+        }
+
+    def limiter(self):
+        return SentenceLimiter(self.max_sentences)
+
+    def record(self, channel, output_tokens):
+        """Feed the adaptive max_tokens estimate with the length of a finished answer."""
+        self.stats.record(channel, output_tokens)
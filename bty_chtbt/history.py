@@ -0,0 +1,141 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bty_chtbt.generation_policy import truncate_sentences
+
+# One background thread summarizes evicted turns for every conversation, off the request path
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+
+
+def extractive_summary(previous_summary, turns, answer_sentences=1):
+    """Cheap summary: each older turn becomes its question plus the first sentence of its answer."""
+    lines = [previous_summary] if previous_summary else []
+    for query, answer in turns:
+        lines.append(f"Q: {query} A: {truncate_sentences(answer.strip(), answer_sentences)}")
+    return "\n".join(lines)
+
+
+def llm_summarizer(openai_client, model, max_tokens=120):
+    """
+    Build a summarizer that asks a small OpenAI-compatible model for the running summary.
+
+    Falls back to the extractive summary if the call fails.
+    """
+    def summarize(previous_summary, turns):
+        transcript = "\n".join(f"使用者: {query}\n助理: {answer}" for query, answer in turns)
+        content = f"先前摘要:\n{previous_summary or '（無）'}\n\n新的對話:\n{transcript}"
+        try:
+            response = openai_client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "請用繁體中文將對話濃縮成一段簡短摘要，保留使用者詢問的療程、價格、需求與已提供的結論。"},
+                    {"role": "user", "content": content}
+                ],
+                max_tokens=max_tokens,
+                temperature=0,
+            )
+            summary = response.choices[0].message.content
+            if summary:
+                return summary.strip()
+        except Exception as e:
+            print(f"History summarization failed, using extractive summary: {e}")
+        return extractive_summary(previous_summary, turns)
+    return summarize
+
+
+class RollingHistory:
+    """
+    Conversation history with a constant token footprint.
+
+    The most recent keep_recent turns are kept verbatim; older turns are folded into a
+    running summary by summarize_fn on a background thread. render() always fits the
+    summary and the recent turns into a fixed token budget, however long the
+    conversation runs.
+
+    count_tokens / truncate are the caller's tokenizer helpers, with the same
+    signatures as count_tokens and truncate_content in the chatbot modules.
+    """
+
+    def __init__(self, count_tokens, truncate, keep_recent=1, summary_tokens=120,
+                 summarize_fn=None, background=True):
+        self.count_tokens = count_tokens
+        self.truncate = truncate
+        self.keep_recent = keep_recent
+        self.summary_tokens = summary_tokens
+        self.summarize_fn = summarize_fn or extractive_summary
+        self.background = background
+        self.turns = []
+        self.summary = ""
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.turns) + len(self._pending)
+
+    def add_turn(self, query, answer):
+        """Record a finished turn; turns that fall out of the verbatim window get summarized."""
+        with self._lock:
+            self.turns.append((query, answer))
+            evicted = self.turns[:-self.keep_recent] if self.keep_recent else list(self.turns)
+            if not evicted:
+                return
+            self.turns = self.turns[len(evicted):]
+            self._pending.extend(evicted)
+        if self.background:
+            _summary_executor.submit(self._summarize, evicted)
+        else:
+            self._summarize(evicted)
+
+    def _summarize(self, evicted):
+        with self._lock:
+            previous = self.summary
+        summary = self.summarize_fn(previous, evicted)
+        # Keep the most recent part of the summary if it outgrows its budget
+        summary = self.truncate(summary, self.summary_tokens, keep_start=False)
+        with self._lock:
+            self.summary = summary
+            self._pending = [turn for turn in self._pending if turn not in evicted]
+
+    def clear(self):
+        with self._lock:
+            self.turns = []
+            self.summary = ""
+            self._pending = []
+
+    def recent_queries(self):
+        """Queries of the verbatim turns, oldest first."""
+        with self._lock:
+            return [query for query, _ in self.turns]
+
+    def render(self, max_tokens):
+        """History text for the prompt, guaranteed to fit in max_tokens."""
+        with self._lock:
+            summary = self.summary
+            pending = list(self._pending)
+            turns = list(self.turns)
+        if pending:
+            # Summaries still being computed: include a cheap extractive version meanwhile
+            summary = self.truncate(extractive_summary(summary, pending), self.summary_tokens, keep_start=False)
+
+        summary_text = ""
+        if summary:
+            header = "Conversation summary:\n"
+            # One token for the newline after the body, as for the turns below
+            summary_budget = min(self.summary_tokens, max_tokens) - self.count_tokens(header) - 1
+            # Older parts of the summary are dropped first
+            body = self.truncate(summary, max(0, summary_budget), keep_start=False)
+            summary_text = f"{header}{body}\n" if body else ""
+
+        remaining = max_tokens - self.count_tokens(summary_text)
+        recent_parts = []
+        for query, answer in reversed(turns):
+            prefix = f"Previous Q: {query}\nPrevious A: "
+            answer_budget = remaining - self.count_tokens(prefix) - 1
+            if answer_budget <= 0:
+                break
+            # Answers lead with the key statement, so cut long ones at the end
+            part = f"{prefix}{self.truncate(answer, answer_budget, keep_start=True)}\n"
+            remaining -= self.count_tokens(part)
+            recent_parts.insert(0, part)
+        return summary_text + "".join(recent_parts)
@@ -0,0 +1,172 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueueFull(Exception):
+    """Raised when the job queue is at capacity and the event cannot be accepted."""
+
+
+class EventDeduplicator:
+    """
+    Remembers recently seen Line webhook event ids for ttl seconds.
+
+    Line redelivers an event when the webhook is not acknowledged in time; the
+    redelivery carries the same webhookEventId, so it can be dropped here.
+    """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, event_id):
+        """Return True if event_id was already seen, otherwise record it and return False."""
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.ttl and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest_id]
+            if event_id in self._seen:
+                return True
+            self._seen[event_id] = now
+            return False
+
+
+class InMemoryJobQueue:
+    """Bounded FIFO of jobs held in process memory. Jobs are lost on restart."""
+
+    def __init__(self, maxsize=100):
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull(f"Line job queue is full ({self._queue.maxsize} pending)") from None
+        return True
+
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, _job):
+        self._queue.task_done()
+
+    def depth(self):
+        return self._queue.qsize()
+
+
+class SQLiteJobQueue:
+    """
+    Bounded job queue persisted in SQLite.
+
+    Jobs survive a process restart (anything left "running" is requeued on start) and
+    the event id primary key doubles as a durable deduplication record.
+    """
+
+    def __init__(self, path, maxsize=100, keep_done_seconds=3600):
+        self.path = path
+        self.maxsize = maxsize
+        self.keep_done_seconds = keep_done_seconds
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " event_id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def put(self, job):
+        """Enqueue a job; returns False if the event id was already queued or processed."""
+        with self._available:
+            if self.depth_locked() >= self.maxsize:
+                raise QueueFull(f"Line job queue is full ({self.maxsize} pending)")
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (event_id, payload, created_at) VALUES (?, ?, ?)",
+                (job["event_id"], json.dumps(job, ensure_ascii=False), time.time())
+            )
+            if cursor.rowcount:
+                self._available.notify()
+            return bool(cursor.rowcount)
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._available:
+            while True:
+                row = self._conn.execute(
+                    "SELECT event_id, payload FROM jobs WHERE status = 'pending' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row:
+                    self._conn.execute("UPDATE jobs SET status = 'running' WHERE event_id = ?", (row[0],))
+                    return json.loads(row[1])
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._available.wait(remaining)
+
+    def done(self, job):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'done' WHERE event_id = ?", (job["event_id"],))
+            self._conn.execute("DELETE FROM jobs WHERE status = 'done' AND created_at < ?",
+                               (time.time() - self.keep_done_seconds,))
+
+    def depth_locked(self):
+        return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status != 'done'").fetchone()[0]
+
+    def depth(self):
+        with self._lock:
+            return self.depth_locked()
+
+
+class WorkerPool:
+    """Daemon threads that pull jobs from a queue and hand them to handler(job)."""
+
+    def __init__(self, job_queue, handler, workers=2, name="line-worker"):
+        self.job_queue = job_queue
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self._threads = []
+        self._stopping = threading.Event()
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self.job_queue.get(timeout=1.0)
+            if job is None:
+                continue
+            try:
+                self.handler(job)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error processing Line job {job.get('event_id')}: {e}")
+            finally:
+                self.job_queue.done(job)
@@ -0,0 +1,208 @@
+import copy
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class LocalGenerator:
+    """
+    CPU/MPS inference for a local causal LM (e.g. the Qwen model saved by hugging_face_download.py).
+
+    - prefix: fixed prompt text (instructions + template header). Its key/value cache is
+      computed once and copied into every single-request generation, so only the
+      variable part of each prompt is run through the model.
+    - On CPU the Linear layers are dynamically quantized to int8 (quantize=True).
+    - generate() calls from several threads are queued and run as one left-padded batch
+      of up to max_batch_size prompts (batches skip the prefix cache, whose rows would
+      not line up with the padding).
+    - stream() yields text as it is produced through a TextIteratorStreamer; closing the
+      stream stops the generation.
+    - Prompts longer than max_length lose their oldest tokens, never the question at the end.
+    - Answers are sliced from the output by input token length, not by string length.
+    """
+
+    def __init__(self, model_path, prefix="", device=None, quantize=True, max_batch_size=4,
+                 batch_wait=0.02, max_length=1024, max_new_tokens=300, generation_kwargs=None):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        if device is None:
+            device = "mps" if torch.backends.mps.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        self.generation_kwargs = {
+            "do_sample": True,
+            "temperature": 0.9,
+            "no_repeat_ngram_size": 2,
+        }
+        self.generation_kwargs.update(generation_kwargs or {})
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"  # Use left padding for generation
+        # Batched prompts over max_length keep their end (the question), as _single_inputs does
+        self.tokenizer.truncation_side = "left"
+
+        model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+        # Disable Sliding Window Attention to avoid SDPA warning
+        model.config.sliding_window = None
+        model.config.attention_dropout = 0.0
+        model.eval()
+        self.quantized = quantize and self.device.type == "cpu"
+        if self.quantized:
+            # int8 weights for every Linear layer; activations stay float, no calibration needed
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model.to(self.device)
+
+        self.prefix = prefix
+        self.prefix_ids = self._encode(prefix) if prefix else None
+        self.prefix_cache = self._build_prefix_cache() if prefix else None
+
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="local-llm-batcher", daemon=True)
+        self._worker.start()
+        self.batches = 0
+        self.batched_requests = 0
+
+    def _encode(self, text):
+        return self.tokenizer(text, return_tensors="pt", add_special_tokens=False)["input_ids"].to(self.device)
+
+    def _build_prefix_cache(self):
+        from transformers import DynamicCache
+
+        start = time.perf_counter()
+        with self.torch.inference_mode():
+            cache = self.model(input_ids=self.prefix_ids, past_key_values=DynamicCache(),
+                               use_cache=True).past_key_values
+        print(f"Cached {self.prefix_ids.shape[1]} prefix tokens in {time.perf_counter() - start:.2f}s")
+        return cache
+
+    def _single_inputs(self, suffix):
+        """Prefix + suffix token ids; tokenized separately so the cached prefix tokens match exactly."""
+        suffix_ids = self._encode(suffix)
+        if self.prefix_ids is not None:
+            input_ids = self.torch.cat([self.prefix_ids, suffix_ids], dim=1)
+        else:
+            input_ids = suffix_ids
+        # Keep the most recent tokens if the prompt is too long (the prefix cache is then unusable)
+        input_ids = input_ids[:, -(self.max_length - 1):]
+        return input_ids, self.torch.ones_like(input_ids)
+
+    def _budget(self, input_length, max_new_tokens):
+        return max(1, min(max_new_tokens or self.max_new_tokens, self.max_length - input_length))
+
+    def _prefix_kwargs(self, input_ids):
+        if self.prefix_cache is None or input_ids.shape[1] <= self.prefix_ids.shape[1]:
+            return {}
+        if not self.torch.equal(input_ids[:, :self.prefix_ids.shape[1]], self.prefix_ids):
+            return {}
+        # generate() extends the cache in place, so every request gets its own copy
+        return {"past_key_values": copy.deepcopy(self.prefix_cache)}
+
+    def _stopping_criteria(self, stop):
+        """Stopping criteria that end generation once the stop event is set (the stream was closed)."""
+        from transformers import StoppingCriteria, StoppingCriteriaList
+
+        torch = self.torch
+
+        class StopEvent(StoppingCriteria):
+            def __call__(self, input_ids, _scores, **_kwargs):
+                return torch.full((input_ids.shape[0],), stop.is_set(), dtype=torch.bool, device=input_ids.device)
+
+        return StoppingCriteriaList([StopEvent()])
+
+    def _generate_single(self, suffix, max_new_tokens=None, streamer=None, stop=None):
+        input_ids, attention_mask = self._single_inputs(suffix)
+        stop_kwargs = {"stopping_criteria": self._stopping_criteria(stop)} if stop is not None else {}
+        with self.torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=self._budget(input_ids.shape[1], max_new_tokens),
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=streamer,
+                **stop_kwargs,
+                **self._prefix_kwargs(input_ids),
+                **self.generation_kwargs,
+            )
+        return self.tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True).strip()
+
+    def _generate_batch(self, suffixes, max_new_tokens=None):
+        inputs = self.tokenizer(
+            [self.prefix + suffix for suffix in suffixes],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=self.max_length - 1,
+            return_attention_mask=True,
+        ).to(self.device)
+        input_length = inputs["input_ids"].shape[1]
+        with self.torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=self._budget(input_length, max_new_tokens),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self.generation_kwargs,
+            )
+        # With left padding every row's new tokens start at the padded input length
+        return [text.strip() for text in
+                self.tokenizer.batch_decode(outputs[:, input_length:], skip_special_tokens=True)]
+
+    def generate(self, suffix, max_new_tokens=None, timeout=None):
+        """Answer for prefix + suffix; concurrent callers are batched together."""
+        future = Future()
+        self._requests.put((suffix, max_new_tokens, future))
+        return future.result(timeout)
+
+    def stream(self, suffix, max_new_tokens=None, timeout=None):
+        """
+        Yield the answer text piece by piece as tokens are generated. Waiting longer than
+        timeout seconds for a piece raises queue.Empty; closing the generator stops generation.
+        """
+        from transformers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True,
+                                        timeout=timeout)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._generate_single, args=(suffix, max_new_tokens, streamer, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            stop.set()
+            thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            # Give concurrent requests a moment to join this batch
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                if len(batch) == 1:
+                    suffix, max_new_tokens, _ = batch[0]
+                    answers = [self._generate_single(suffix, max_new_tokens)]
+                else:
+                    max_new_tokens = max((item[1] or self.max_new_tokens) for item in batch)
+                    answers = self._generate_batch([item[0] for item in batch], max_new_tokens)
+                self.batches += 1
+                self.batched_requests += len(batch)
+                for (_, _, future), answer in zip(batch, answers, strict=True):
+                    future.set_result(answer)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
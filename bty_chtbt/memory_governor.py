@@ -0,0 +1,147 @@
+import gc
+import os
+import threading
+import time
+
+import psutil
+
+CGROUP_LIMIT_FILES = (
+    "/sys/fs/cgroup/memory.max",                    # cgroup v2 (Cloud Run, recent Docker)
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+)
+
+
+def container_memory_limit_mb():
+    """Memory limit of the container in MB, falling back to physical memory."""
+    for path in CGROUP_LIMIT_FILES:
+        try:
+            with open(path, "r") as f:
+                raw = f.read().strip()
+        except OSError:
+            continue
+        if raw.isdigit():
+            limit = int(raw)
+            # cgroup v1 reports a huge number when unlimited
+            if limit < psutil.virtual_memory().total:
+                return limit / (1024 * 1024)
+    return psutil.virtual_memory().total / (1024 * 1024)
+
+
+def _parse_thresholds(raw):
+    values = tuple(int(value) for value in raw.split(","))
+    if len(values) != 3:
+        raise ValueError(f"GC_THRESHOLDS must have three comma-separated values, got '{raw}'")
+    return values
+
+
+class MemoryGovernor:
+    """
+    Keeps RSS under control without a full gc.collect() on every request.
+
+    check() is cheap (one RSS read) and is meant to be called after each request:
+    - above the soft watermark a full collection runs,
+    - if RSS is still above the hard watermark the registered shrink callbacks run
+      (trim histories, drop caches) followed by another collection.
+    freeze_after_startup() moves everything allocated while loading models and indexes
+    into the permanent generation so later collections no longer traverse it.
+
+    Watermarks default to 80% / 90% of the container memory limit and can be set
+    with MEMORY_SOFT_LIMIT_MB / MEMORY_HARD_LIMIT_MB.
+    """
+
+    def __init__(self, soft_limit_mb=None, hard_limit_mb=None, min_check_interval=1.0, collect_cooldown=10.0):
+        limit_mb = container_memory_limit_mb()
+        self.limit_mb = limit_mb
+        self.soft_limit_mb = float(soft_limit_mb or os.getenv("MEMORY_SOFT_LIMIT_MB") or limit_mb * 0.8)
+        self.hard_limit_mb = float(hard_limit_mb or os.getenv("MEMORY_HARD_LIMIT_MB") or limit_mb * 0.9)
+        self.min_check_interval = min_check_interval
+        # Minimum time between watermark collections, so a heap that stays above the
+        # watermark does not turn into a full collection on every request again
+        self.collect_cooldown = collect_cooldown
+        self._last_collect = float("-inf")
+        self._process = psutil.Process()
+        self._shrinkers = {}
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self.peak_rss_mb = 0.0
+        self.collections = 0
+        self.shrinks = 0
+        self.frozen = False
+
+    def rss_mb(self):
+        rss = self._process.memory_info().rss / (1024 * 1024)
+        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+        return rss
+
+    def register_shrinker(self, name, callback):
+        """Register a callable that releases memory (e.g. trims a cache) under pressure."""
+        self._shrinkers[name] = callback
+
+    def freeze_after_startup(self, thresholds=None):
+        """Collect once, freeze the surviving startup heap and relax the gen0 threshold."""
+        gc.collect()
+        gc.freeze()
+        raw = os.getenv("GC_THRESHOLDS")
+        thresholds = thresholds or (_parse_thresholds(raw) if raw else (10000, 20, 20))
+        gc.set_threshold(*thresholds)
+        self.frozen = True
+        print(f"GC tuned after startup: froze {gc.get_freeze_count()} objects, thresholds {gc.get_threshold()}")
+
+    def check(self):
+        """Collect or shrink only when a watermark is crossed. Returns the current RSS in MB."""
+        now = time.monotonic()
+        if now - self._last_check < self.min_check_interval:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None  # another thread is already checking
+        try:
+            self._last_check = now
+            rss = self.rss_mb()
+            if rss < self.soft_limit_mb or now - self._last_collect < self.collect_cooldown:
+                return rss
+            self._last_collect = now
+            gc.collect()
+            self.collections += 1
+            rss = self.rss_mb()
+            if rss >= self.hard_limit_mb and self._shrinkers:
+                for name, callback in self._shrinkers.items():
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"Memory shrinker {name} failed: {e}")
+                gc.collect()
+                self.shrinks += 1
+                rss = self.rss_mb()
+                print(f"Memory above hard watermark: ran {len(self._shrinkers)} shrinkers, RSS now {rss:.0f} MB")
+            return rss
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            "rss_mb": round(self.rss_mb(), 1),
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+            "limit_mb": round(self.limit_mb, 1),
+            "soft_limit_mb": round(self.soft_limit_mb, 1),
+            "hard_limit_mb": round(self.hard_limit_mb, 1),
+            "watermark_collections": self.collections,
+            "shrinks": self.shrinks,
+            "gc_frozen": self.frozen,
+            "gc_freeze_count": gc.get_freeze_count(),
+            "gc_thresholds": gc.get_threshold(),
+            "gc_counts": gc.get_count(),
+            "shrinkers": sorted(self._shrinkers),
+        }
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """Process-wide MemoryGovernor instance."""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = MemoryGovernor()
+        return _governor
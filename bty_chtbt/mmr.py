@@ -0,0 +1,35 @@
+import numpy as np
+
+from bty_chtbt.numpy_index import normalize_rows
+
+
+def mmr_select(query_vector, candidate_vectors, k, lambda_mult=0.5):
+    """
+    Indices of k candidates chosen by maximal marginal relevance, in selection order.
+
+    Each step picks the candidate maximizing
+        lambda_mult * sim(query, c) - (1 - lambda_mult) * max(sim(c, s) for s already selected),
+    so lambda_mult=1 is plain top-k by similarity and lower values favour diversity.
+    All similarities come from one candidate x candidate matrix product, and the
+    "closest selected" column is updated in place after each pick, so a step is a
+    single vectorized pass over the pool.
+    """
+    candidates = normalize_rows(candidate_vectors)
+    if candidates.ndim != 2 or len(candidates) == 0:
+        return []
+    k = min(k, len(candidates))
+    relevance = candidates @ normalize_rows(query_vector)
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    closest = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * closest
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(closest, similarity[best], out=closest)
+    return selected
@@ -0,0 +1,285 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+BUNDLE_MANIFEST = "bundle.json"
+BUNDLE_FORMAT_VERSION = 1
+# Embedding models used by the chatbots and vector_n_embed.py
+DEFAULT_EMBEDDING_MODELS = (
+    "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    "sentence-transformers/all-MiniLM-L6-v2",
+)
+# Cross-encoder of the [reranker] section in pipelines.toml
+DEFAULT_RERANKER_MODELS = ("cross-encoder/mmarco-mMiniLMv2-L12-H384-v1",)
+# Models whose tokenizer alone is needed: the [tokenizer] the served LLM counts prompts with
+DEFAULT_TOKENIZER_MODELS = ("Qwen/Qwen2.5-7B-Instruct",)
+# Tokenizer files (and config.json, which AutoTokenizer reads for the model type); no weights
+TOKENIZER_PATTERNS = ["tokenizer*", "vocab*", "merges.txt", "special_tokens_map.json", "added_tokens.json",
+                      "config.json"]
+# cl100k_base for count_tokens and the chunk splitter, o200k_base for gpt-4o
+DEFAULT_TIKTOKEN_ENCODINGS = ("cl100k_base", "o200k_base")
+# Weights for other frameworks are never loaded here
+IGNORE_PATTERNS = ["*.h5", "*.msgpack", "*.ot", "openvino/*"]
+# Short and long Chinese inputs so the tokenizer and both padding shapes are exercised
+WARMUP_TEXTS = [
+    "皮秒雷射術後多久可以化妝？",
+    "玻尿酸注射後需要注意哪些事項？術後一週內避免按摩、三溫暖與劇烈運動，如有紅腫請回診。" * 4,
+]
+
+
+def _safe_name(name):
+    return name.replace("/", "__")
+
+
+def _sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_entries(root):
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        # huggingface_hub keeps download metadata in .cache; it is not part of the bundle
+        dirnames[:] = [name for name in dirnames if name != ".cache"]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relative = os.path.relpath(path, root)
+            if relative == BUNDLE_MANIFEST:
+                continue
+            entries[relative] = {"size": os.path.getsize(path), "sha256": _sha256(path)}
+    return entries
+
+
+def create_bundle(output_dir, models=DEFAULT_EMBEDDING_MODELS + DEFAULT_RERANKER_MODELS,
+                  encodings=DEFAULT_TIKTOKEN_ENCODINGS, version=None, tokenizers=DEFAULT_TOKENIZER_MODELS):
+    """
+    Snapshot Hugging Face models, the tokenizer files of the tokenizers models and tiktoken
+    encodings into output_dir/<version>.
+
+    Each model is pinned to the commit it resolved to at bundle time. The bundle is
+    written to a temporary directory and renamed into place, then output_dir/latest
+    is pointed at it, so a half-written bundle is never picked up.
+    """
+    import tiktoken
+    from huggingface_hub import HfApi, snapshot_download
+
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    bundle_dir = os.path.join(output_dir, version)
+    if os.path.exists(bundle_dir):
+        raise FileExistsError(f"Bundle {bundle_dir} already exists")
+    tmp_dir = f"{bundle_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "models": {},
+        "tiktoken_encodings": list(encodings),
+    }
+    api = HfApi()
+    snapshots = [(name, None) for name in models]
+    snapshots += [(name, TOKENIZER_PATTERNS) for name in tokenizers if name not in models]
+    for name, allow_patterns in snapshots:
+        revision = api.model_info(name).sha
+        relative = os.path.join("models", _safe_name(name))
+        print(f"Downloading {name}@{revision[:12]}{' (tokenizer only)' if allow_patterns else ''}...")
+        snapshot_download(repo_id=name, revision=revision, local_dir=os.path.join(tmp_dir, relative),
+                          allow_patterns=allow_patterns, ignore_patterns=IGNORE_PATTERNS)
+        shutil.rmtree(os.path.join(tmp_dir, relative, ".cache"), ignore_errors=True)
+        manifest["models"][name] = {"path": relative, "revision": revision}
+        if allow_patterns:
+            manifest["models"][name]["tokenizer_only"] = True
+
+    # tiktoken stores downloaded BPE files under TIKTOKEN_CACHE_DIR by URL hash, which is
+    # also where it looks for them at runtime once the bundle is activated
+    tiktoken_dir = os.path.join(tmp_dir, "tiktoken")
+    os.makedirs(tiktoken_dir, exist_ok=True)
+    previous_cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR")
+    os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_dir
+    try:
+        for encoding in encodings:
+            print(f"Downloading tiktoken encoding {encoding}...")
+            tiktoken.get_encoding(encoding)
+    finally:
+        if previous_cache_dir is None:
+            os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+        else:
+            os.environ["TIKTOKEN_CACHE_DIR"] = previous_cache_dir
+    if not os.listdir(tiktoken_dir):
+        raise RuntimeError("tiktoken wrote no encoding files; were the encodings already loaded in this process?")
+
+    manifest["files"] = _file_entries(tmp_dir)
+    with open(os.path.join(tmp_dir, BUNDLE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_dir, bundle_dir)
+
+    latest = os.path.join(output_dir, "latest")
+    tmp_link = f"{latest}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, latest)
+    size_mb = sum(entry["size"] for entry in manifest["files"].values()) / (1024 * 1024)
+    print(f"Bundle {version} written to {bundle_dir} ({size_mb:.1f} MB)")
+    return bundle_dir
+
+
+class ModelBundle:
+    """A bundle directory written by create_bundle (or the "latest" link to one)."""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        manifest_path = os.path.join(self.path, BUNDLE_MANIFEST)
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"No {BUNDLE_MANIFEST} in {path}; create one with python -m bty_chtbt.model_bundle create")
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported bundle format {self.manifest.get('format_version')} in {path}")
+        self.version = self.manifest["version"]
+        self.tiktoken_dir = os.path.join(self.path, "tiktoken")
+
+    def model_path(self, name):
+        """Local directory of a bundled model, or None if the bundle does not contain it."""
+        entry = self.manifest["models"].get(name)
+        if entry is None:
+            # Short names such as "all-MiniLM-L6-v2" resolve to sentence-transformers/<name>
+            entry = self.manifest["models"].get(f"sentence-transformers/{name}")
+        return None if entry is None else os.path.join(self.path, entry["path"])
+
+    def verify(self):
+        """Names of files that are missing or whose checksum does not match the manifest."""
+        problems = []
+        for relative, entry in self.manifest["files"].items():
+            path = os.path.join(self.path, relative)
+            if not os.path.exists(path):
+                problems.append(f"missing: {relative}")
+            elif os.path.getsize(path) != entry["size"] or _sha256(path) != entry["sha256"]:
+                problems.append(f"checksum mismatch: {relative}")
+        return problems
+
+    def activate(self):
+        """Point tiktoken at the bundled encodings and keep Hugging Face libraries offline."""
+        os.environ["TIKTOKEN_CACHE_DIR"] = self.tiktoken_dir
+        # Read when huggingface_hub/transformers are first imported; bundled models are
+        # loaded from local paths either way
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+        print(f"Using model bundle {self.version} from {self.path}")
+
+    def stats(self):
+        return {"version": self.version, "path": self.path, "models": sorted(self.manifest["models"])}
+
+
+_bundle = None
+_bundle_loaded = False
+_bundle_lock = threading.Lock()
+
+
+def get_bundle():
+    """Process-wide bundle from MODEL_BUNDLE_DIR (activated on first use), or None when unset."""
+    global _bundle, _bundle_loaded
+    with _bundle_lock:
+        if not _bundle_loaded:
+            path = os.getenv("MODEL_BUNDLE_DIR")
+            if path:
+                _bundle = ModelBundle(path)
+                _bundle.activate()
+            _bundle_loaded = True
+        return _bundle
+
+
+def resolve_model(name):
+    """Bundled local path for a model name, or the name itself (downloaded lazily) without a bundle."""
+    bundle = get_bundle()
+    path = bundle.model_path(name) if bundle is not None else None
+    if bundle is not None and path is None:
+        print(f"Model {name} is not in bundle {bundle.version}; loading it from the Hugging Face cache")
+    return path or name
+
+
+def warm_up(embeddings, vector_store=None, build_prompt=None, count_tokens=None, texts=None):
+    """
+    Run one of each hot-path step so the first user request does not pay for lazy loading:
+    tokenizer files, the first transformer forward passes, index pages and the BPE tables.
+
+    The wrapped model of a CachedEmbeddings is called directly, because cache hits from a
+    previous boot would otherwise skip the forward pass. Returns per-step timings; set
+    WARMUP=0 to skip.
+    """
+    if os.getenv("WARMUP", "1") == "0":
+        return {"skipped": True}
+    texts = texts or WARMUP_TEXTS
+    model = getattr(embeddings, "embeddings", embeddings)
+    timings = {}
+    total_start = time.perf_counter()
+
+    start = time.perf_counter()
+    model.embed_documents(texts)
+    model.embed_query(texts[0])
+    timings["embed"] = time.perf_counter() - start
+
+    docs = []
+    if vector_store is not None:
+        start = time.perf_counter()
+        docs = vector_store.search(texts[0], k=2)
+        timings["search"] = time.perf_counter() - start
+
+    if count_tokens is not None:
+        start = time.perf_counter()
+        for text in texts:
+            count_tokens(text)
+        timings["tokenize"] = time.perf_counter() - start
+
+    if build_prompt is not None:
+        start = time.perf_counter()
+        build_prompt(texts[0], docs)
+        timings["prompt"] = time.perf_counter() - start
+
+    timings["total"] = time.perf_counter() - total_start
+    timings = {step: round(seconds * 1000, 1) for step, seconds in timings.items()}
+    print(f"Warm-up finished (ms): {timings}")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline model/tokenizer bundles.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="Snapshot models and tiktoken encodings.")
+    create_parser.add_argument("--output", default="./model_bundle", help="Directory holding bundle versions.")
+    create_parser.add_argument("--model", action="append", dest="models",
+                               help="Hugging Face model to include (repeatable; default: the embedding and reranker models).")
+    create_parser.add_argument("--tokenizer", action="append", dest="tokenizers",
+                               help="Hugging Face model whose tokenizer files to include (repeatable; default: Qwen).")
+    create_parser.add_argument("--encoding", action="append", dest="encodings",
+                               help="tiktoken encoding to include (repeatable).")
+    create_parser.add_argument("--version", help="Bundle version (default: timestamp).")
+
+    verify_parser = subparsers.add_parser("verify", help="Check a bundle's files against its manifest.")
+    verify_parser.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "create":
+        create_bundle(args.output, models=args.models or DEFAULT_EMBEDDING_MODELS + DEFAULT_RERANKER_MODELS,
+                      encodings=args.encodings or DEFAULT_TIKTOKEN_ENCODINGS, version=args.version,
+                      tokenizers=args.tokenizers or DEFAULT_TOKENIZER_MODELS)
+    else:
+        bundle = ModelBundle(args.path)
+        problems = bundle.verify()
+        for problem in problems:
+            print(problem)
+        print(f"Bundle {bundle.version}: {'OK' if not problems else f'{len(problems)} problem(s)'}")
+        raise SystemExit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import json
+import os
+
+import numpy as np
+
+STORAGE_DTYPES = ("float32", "float16", "int8")
+INDEX_NAME = "numpy_index.json"
+VECTORS_NAME = "vectors.npy"
+SCALES_NAME = "scales.npy"
+
+
+def normalize_rows(vectors):
+    """L2-normalize a vector or a matrix of row vectors as float32."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(vectors, dtype):
+    """
+    Convert normalized float32 rows to the storage dtype.
+
+    int8 uses a per-row scale (max |x| / 127) so each row keeps its full dynamic range
+    and new rows can be appended without re-quantizing the rest of the matrix.
+    Returns (stored, scales); scales is None unless dtype is int8.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float32":
+        return np.ascontiguousarray(vectors), None
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        stored = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return stored, scales.astype(np.float32)
+    raise ValueError(f"Unsupported storage dtype '{dtype}'. Choose from {STORAGE_DTYPES}.")
+
+
+class NumpyIndex:
+    """
+    Exact inner-product search over one contiguous matrix of normalized embeddings.
+
+    The matrix is stored as float32, float16 or int8 (with per-row scales) and is
+    memory-mapped on load, so opening the index costs a page-table setup rather than
+    a full read. Scoring is done in row blocks to bound the float32 scratch memory.
+
+    append/replace/take return new indexes; extend/update change this one in place,
+    with rows written into a buffer that grows geometrically (for streamed builds).
+    """
+
+    def __init__(self, vectors, scales=None, block_size=16384):
+        self.vectors = vectors
+        self.scales = scales
+        self.block_size = block_size
+        # Owned, writable backing arrays; vectors/scales are views of their first len(self) rows
+        self._buffer = None
+        self._scales_buffer = None
+
+    @classmethod
+    def from_vectors(cls, vectors, dtype="float16"):
+        stored, scales = quantize(normalize_rows(vectors), dtype)
+        return cls(stored, scales)
+
+    @property
+    def dtype(self):
+        return self.vectors.dtype.name
+
+    def __len__(self):
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, VECTORS_NAME), self.vectors)
+        if self.scales is not None:
+            np.save(os.path.join(path, SCALES_NAME), self.scales)
+        with open(os.path.join(path, INDEX_NAME), "w", encoding="utf-8") as f:
+            json.dump({"dtype": self.dtype, "count": len(self), "dim": int(self.vectors.shape[1])}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = "r" if mmap else None
+        vectors = np.load(os.path.join(path, VECTORS_NAME), mmap_mode=mmap_mode)
+        scales_path = os.path.join(path, SCALES_NAME)
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        return cls(vectors, scales)
+
+    def append(self, vectors):
+        """Return a new index with rows appended (quantized with the same dtype)."""
+        stored, scales = quantize(normalize_rows(vectors), self.dtype)
+        merged = np.concatenate([np.asarray(self.vectors), stored])
+        merged_scales = None if scales is None else np.concatenate([self.scales, scales])
+        return NumpyIndex(merged, merged_scales, self.block_size)
+
+    def replace(self, rows, vectors):
+        """Return a new index with the given rows overwritten."""
+        stored, scales = quantize(normalize_rows(vectors), self.dtype)
+        matrix = np.array(self.vectors)
+        matrix[rows] = stored
+        merged_scales = None
+        if scales is not None:
+            merged_scales = np.array(self.scales)
+            merged_scales[rows] = scales
+        return NumpyIndex(matrix, merged_scales, self.block_size)
+
+    def _reserve(self, count):
+        """Make the backing buffer writable and large enough for count rows."""
+        if self._buffer is not None and count <= len(self._buffer):
+            return
+        rows = len(self)
+        capacity = max(count, 2 * rows, 1024)
+        buffer = np.empty((capacity,) + self.vectors.shape[1:], dtype=self.vectors.dtype)
+        buffer[:rows] = self.vectors
+        self._buffer = buffer
+        self.vectors = buffer[:rows]
+        if self.scales is not None:
+            scales_buffer = np.empty(capacity, dtype=np.float32)
+            scales_buffer[:rows] = self.scales
+            self._scales_buffer = scales_buffer
+            self.scales = scales_buffer[:rows]
+
+    def extend(self, vectors):
+        """Append rows in place (amortized O(rows added), no copy of the existing matrix)."""
+        stored, scales = quantize(normalize_rows(vectors), self.dtype)
+        start = len(self)
+        stop = start + len(stored)
+        self._reserve(stop)
+        self._buffer[start:stop] = stored
+        self.vectors = self._buffer[:stop]
+        if scales is not None:
+            self._scales_buffer[start:stop] = scales
+            self.scales = self._scales_buffer[:stop]
+
+    def update(self, rows, vectors):
+        """Overwrite the given rows in place."""
+        stored, scales = quantize(normalize_rows(vectors), self.dtype)
+        self._reserve(len(self))
+        self.vectors[rows] = stored
+        if scales is not None:
+            self.scales[rows] = scales
+
+    def take(self, rows):
+        """Return a new index containing only the given rows, in order."""
+        scales = None if self.scales is None else np.asarray(self.scales)[rows]
+        return NumpyIndex(np.asarray(self.vectors)[rows], scales, self.block_size)
+
+    def reconstruct(self, rows):
+        """Stored rows as float32 (int8 rows rescaled), e.g. to re-score search results."""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def _score_block(self, start, stop, queries, rows=None):
+        if rows is None:
+            block = self.vectors[start:stop]
+            scales = None if self.scales is None else self.scales[start:stop]
+        else:
+            block = self.vectors[rows[start:stop]]
+            scales = None if self.scales is None else self.scales[rows[start:stop]]
+        scores = queries @ block.astype(np.float32, copy=False).T
+        if scales is not None:
+            scores *= scales[None, :]
+        return scores
+
+    def search(self, queries, k=3, rows=None):
+        """
+        Top-k search for one query vector or a batch of query vectors.
+
+        rows optionally restricts the search to a precomputed array of row indices
+        (e.g. all rows of one category). Returns (scores, row_ids), each of shape
+        (n_queries, k') with k' = min(k, candidates), best first.
+        """
+        queries = normalize_rows(queries)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        total = len(self) if rows is None else len(rows)
+        k = min(k, total)
+        if k <= 0:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+
+        best_scores = None
+        best_rows = None
+        for start in range(0, total, self.block_size):
+            stop = min(start + self.block_size, total)
+            scores = self._score_block(start, stop, queries, rows)
+            block_k = min(k, stop - start)
+            top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            positions = top + start
+            top_rows = positions if rows is None else np.asarray(rows)[positions]
+            if best_scores is None:
+                best_scores, best_rows = top_scores, top_rows
+            else:
+                # Merge this block's candidates with the running top-k
+                merged_scores = np.concatenate([best_scores, top_scores], axis=1)
+                merged_rows = np.concatenate([best_rows, top_rows], axis=1)
+                keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+                best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
@@ -0,0 +1,14 @@
+from bty_chtbt.pipeline.config import load_config
+from bty_chtbt.pipeline.core import Pipeline, build_pipeline
+from bty_chtbt.pipeline.llm import EMPTY_ANSWER, ERROR_ANSWER, SLOW_ANSWER
+from bty_chtbt.pipeline.timing import StageTimer
+
+__all__ = [
+    "EMPTY_ANSWER",
+    "ERROR_ANSWER",
+    "SLOW_ANSWER",
+    "Pipeline",
+    "StageTimer",
+    "build_pipeline",
+    "load_config",
+]
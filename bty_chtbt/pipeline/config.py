@@ -0,0 +1,80 @@
+import copy
+import os
+import tomllib
+
+# pipelines.toml at the repository root, next to the chatbot scripts
+DEFAULT_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "pipelines.toml"
+)
+
+
+def _flag(raw):
+    return raw.lower() in ("1", "on", "true")
+
+
+# Environment variables that predate the config file, with their type. They still override
+# it, so existing .env files and Cloud Run settings keep working unchanged.
+ENV_OVERRIDES = {
+    "VECTOR_BACKEND": ("retriever", "backend", str),
+    "EMBEDDING_CACHE_DIR": ("embedder", "cache_dir", str),
+    "RETRIEVAL_MODE": ("retriever", "mode", str),
+    "MMR_FETCH_K": ("retriever", "fetch_k", int),
+    "MMR_LAMBDA": ("retriever", "mmr_lambda", float),
+    "PARENT_CONTEXT_TOKENS": ("retriever", "parent_context_tokens", int),
+    "COLLAPSE_DUPLICATES": ("retriever", "collapse_duplicates", _flag),
+    "SHARD_WORKERS": ("retriever", "shard_workers", int),
+    "SHARD_RELOAD_SECONDS": ("retriever", "shard_reload_seconds", float),
+    "RERANK": ("reranker", "enabled", _flag),
+    "RERANK_MODEL": ("reranker", "model", str),
+    "RERANK_RUNTIME": ("reranker", "runtime", str),
+    "RERANK_BUDGET_MS": ("reranker", "budget_ms", float),
+    "RERANK_CANDIDATES": ("reranker", "candidates", int),
+    "RERANK_TOP_N": ("reranker", "top_n", int),
+    "MAX_PROMPT_TOKENS": ("prompt", "max_prompt_tokens", int),
+    "CONTEXT_WINDOW": ("llm", "context_window", int),
+    "STREAM_USAGE": ("llm", "stream_usage", _flag),
+    "LOCAL_LLM_PATH": ("llm", "model_path", str),
+    "LOCAL_LLM_QUANTIZE": ("llm", "quantize", _flag),
+    "LOCAL_LLM_BATCH_SIZE": ("llm", "batch_size", int),
+}
+
+
+def _merge(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def load_config(profile, path=None):
+    """
+    Settings of one pipeline profile: [defaults] merged with [profiles.<profile>].
+
+    The file is PIPELINE_CONFIG if set, else pipelines.toml at the repository root.
+    Variables in ENV_OVERRIDES win over the file. The result also carries "name" and
+    "base_dir" (the file's directory, against which relative paths are resolved).
+    """
+    path = path or os.getenv("PIPELINE_CONFIG", DEFAULT_CONFIG_PATH)
+    with open(path, "rb") as f:
+        raw = tomllib.load(f)
+    profiles = raw.get("profiles", {})
+    if profile not in profiles:
+        raise KeyError(f"Unknown pipeline profile {profile!r} in {path}; available: {', '.join(sorted(profiles))}")
+    config = _merge(raw.get("defaults", {}), profiles[profile])
+    for variable, (section, key, parse) in ENV_OVERRIDES.items():
+        raw_value = os.getenv(variable)
+        if raw_value is not None:
+            config.setdefault(section, {})[key] = parse(raw_value)
+    config["name"] = profile
+    config["base_dir"] = os.path.dirname(os.path.abspath(path))
+    return config
+
+
+def resolve_path(config, path):
+    """Absolute form of a path from the config (relative paths are relative to the config file)."""
+    if not path or os.path.isabs(path):
+        return path
+    return os.path.join(config["base_dir"], path)
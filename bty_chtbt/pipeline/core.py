@@ -0,0 +1,140 @@
+from bty_chtbt.embedding_cache import CachedEmbeddings
+from bty_chtbt.generation_policy import GenerationPolicy
+from bty_chtbt.memory_governor import get_governor
+from bty_chtbt.model_bundle import get_bundle, warm_up
+from bty_chtbt.pipeline.config import load_config
+from bty_chtbt.pipeline.llm import build_llm
+from bty_chtbt.pipeline.stages import (
+    HistoryStore,
+    PromptBuilder,
+    build_embeddings,
+    build_retriever,
+    prompt_budget,
+)
+from bty_chtbt.pipeline.timing import StageTimer
+from bty_chtbt.token_counting import build_token_counter
+
+
+class Pipeline:
+    """
+    The QA chain shared by every chatbot: embed -> search -> (rerank) -> expand -> prompt -> generate.
+
+    Each step runs inside a StageTimer stage, so stats() has p50/p95 per stage for the
+    health endpoints, and callers can pass a dict as `timings` to get one request's
+    breakdown in milliseconds.
+    """
+
+    def __init__(self, name, config, tokens, embeddings, retriever, prompt, llm, history, policy):
+        self.name = name
+        self.config = config
+        self.tokens = tokens
+        self.embeddings = embeddings
+        self.retriever = retriever
+        self.prompt = prompt
+        self.llm = llm
+        self.history = history
+        self.policy = policy
+        self.timer = StageTimer()
+
+    @property
+    def vector_store(self):
+        return self.retriever.vector_store
+
+    def retrieve(self, query, k=None, filter=None, deadline=None, timings=None):
+        if self.retriever.vector_store is None:
+            raise RuntimeError(f"Vector store of pipeline {self.name!r} is not loaded yet.")
+        k = k or self.retriever.k
+        with self.timer.stage("retrieve", timings):
+            if isinstance(self.embeddings, CachedEmbeddings):
+                # Embedding on its own first puts the vector in the cache, so the search below
+                # only does the index work and the two show up as separate stages
+                with self.timer.stage("embed", timings):
+                    self.embeddings.embed_query(query)
+            with self.timer.stage("search", timings):
+                results = self.retriever.search(query, k, filter=filter)
+            if self.retriever.reranker is not None:
+                with self.timer.stage("rerank", timings):
+                    results = self.retriever.rerank(query, results, k, deadline=deadline)
+            with self.timer.stage("expand", timings):
+                return self.retriever.expand(results)
+
+    def build_prompt(self, query, docs, history=None, timings=None):
+        with self.timer.stage("prompt", timings):
+            return self.prompt.build(query, docs, self.history.render(history))
+
+    def generate(self, prompt, channel="web", deadline=None, timings=None):
+        with self.timer.stage("generate", timings):
+            return self.llm.generate(prompt, channel=channel, deadline=deadline)
+
+    def answer(self, query, history=None, channel="web", filter=None, deadline=None, k=None, timings=None):
+        """Retrieve, build the prompt and generate under one deadline; the turn is added to history."""
+        deadline = deadline or self.policy.deadline(channel)
+        docs = self.retrieve(query, k=k, filter=filter, deadline=deadline, timings=timings)
+        prompt = self.build_prompt(query, docs, history, timings=timings)
+        answer = self.generate(prompt, channel=channel, deadline=deadline, timings=timings)
+        if history is not None:
+            history.add_turn(query, answer)
+        return answer
+
+    def warm_up(self):
+        """Exercise embedding, search, tokenizer and prompt building once (see model_bundle.warm_up)."""
+        return warm_up(
+            self.embeddings,
+            self.retriever.vector_store,
+            lambda query, docs: self.prompt.build(query, docs),
+            self.tokens.count
+        )
+
+    def stats(self):
+        return {
+            "profile": self.name,
+            "llm": self.llm.stats(),
+            "retrieval_mode": self.retriever.mode,
+            "stages": self.timer.stats(),
+            "history": self.history.stats(),
+            "tokens": dict(self.tokens.stats(), max_prompt_tokens=self.prompt.max_prompt_tokens),
+        }
+
+
+def build_pipeline(profile, load_store=True, connect=True, config=None):
+    """
+    Build the pipeline of a profile in pipelines.toml.
+
+    load_store=False leaves the vector store to be attached later (Retriever.attach) and
+    connect=False defers creating the LLM client (pipeline.llm.connect()), for
+    deployments that download the store or read credentials on first use.
+    """
+    config = config or load_config(profile)
+    # The offline bundle (MODEL_BUNDLE_DIR) must point tiktoken and Hugging Face at its
+    # files before any tokenizer or model is loaded
+    get_bundle()
+    # Counted with the served model's tokenizer (or a calibrated estimate of it)
+    tokens = build_token_counter(config.get("tokenizer", {}), config["llm"])
+    embeddings = build_embeddings(config, config["embedder"])
+    retriever = build_retriever(config, embeddings, tokens, load_store=load_store)
+
+    # Per-channel token budgets, sentence limit, adaptive max_tokens and request deadlines
+    policy = GenerationPolicy()
+    prompt_config = config["prompt"]
+    prompt = PromptBuilder(
+        prompt_config["system_message"],
+        tokens,
+        # What the context window leaves next to the longest answer any channel may get
+        max_prompt_tokens=prompt_budget(config["llm"], prompt_config, max(policy.channel_max_tokens.values())),
+        warn_prompt_tokens=prompt_config.get("warn_prompt_tokens"),
+    )
+    history_config = config.get("history", {})
+    history = HistoryStore(
+        tokens,
+        budget_tokens=history_config.get("budget_tokens", 200),
+        max_sessions_under_pressure=history_config.get("max_sessions_under_pressure", 200),
+    )
+    llm = build_llm(config["llm"], prompt.prefix, policy, tokens)
+    if connect:
+        llm.connect()
+
+    governor = get_governor()
+    if isinstance(embeddings, CachedEmbeddings):
+        governor.register_shrinker("embedding_cache", embeddings.cache.shrink)
+    governor.register_shrinker("chat_histories", history.trim)
+    return Pipeline(profile, config, tokens, embeddings, retriever, prompt, llm, history, policy)
@@ -0,0 +1,250 @@
+import os
+import queue
+import time
+import traceback
+
+from bty_chtbt.generation_policy import DeadlineExceeded
+from bty_chtbt.prompt_cache import PromptCacheStats, anthropic_system, openai_messages
+
+EMPTY_ANSWER = "無法取得回應內容。"
+SLOW_ANSWER = "抱歉，目前回應較慢，請稍後再試。"
+ERROR_ANSWER = "抱歉，無法生成回答，請稍後再試。"
+
+
+class LLM:
+    """
+    Base class of the generation stage.
+
+    generate() applies the GenerationPolicy (token budget, stop sequences, sentence limit,
+    deadline), records prompt-cache usage and answer length, and turns provider errors
+    into the fallback answers. Subclasses create their client in connect() and stream
+    text into the sentence limiter in _complete(), returning the provider's usage, whose
+    input token count is fed back to the TokenCounter to check (or calibrate) its counts.
+    """
+
+    provider = None
+
+    def __init__(self, section, prefix, policy, tokens):
+        self.section = section
+        self.model = section.get("model")
+        self.prefix = prefix
+        self.policy = policy
+        self.tokens = tokens
+        self.client = None
+        self.prompt_cache_stats = PromptCacheStats(self.provider)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def _complete(self, prompt, params, limiter):
+        raise NotImplementedError
+
+    def _explain(self, error):
+        """Extra hint printed for a failed request (e.g. which setting to check)."""
+
+    def generate(self, prompt, channel="web", deadline=None):
+        try:
+            params = self.policy.params(channel, deadline)
+            limiter = self.policy.limiter()
+            usage = self._complete(prompt, params, limiter)
+            reported = self.prompt_cache_stats.record(usage)
+            if reported is not None:
+                self.tokens.observe((self.prefix, prompt), reported["input_tokens"])
+
+            answer = limiter.text.strip()
+            if not answer:
+                print("Error: Response has no content")
+                return EMPTY_ANSWER
+            self.policy.record(channel, self.tokens.count(answer))
+            return answer
+        except DeadlineExceeded as e:
+            print(f"Skipping generation: {e}")
+            return SLOW_ANSWER
+        except Exception as e:
+            print(f"Error generating answer: {e}")
+            self._explain(e)
+            traceback.print_exc()
+            return ERROR_ANSWER
+
+    def stats(self):
+        return {"provider": self.provider, "model": self.model}
+
+
+class AnthropicLLM(LLM):
+    """Claude through the Messages API, with the prefix as a cached system prompt."""
+
+    provider = "anthropic"
+
+    def connect(self):
+        from anthropic import Anthropic
+
+        key_env = self.section.get("api_key_env", "ANTHROPIC_API_KEY")
+        api_key = os.getenv(key_env)
+        if not api_key:
+            raise ValueError(f"{key_env} is not set in environment variables. Please set it in your .env file or environment.")
+        self.client = Anthropic(api_key=api_key)
+
+    def _complete(self, prompt, params, limiter):
+        with self.client.messages.stream(
+            model=self.model,
+            max_tokens=params["max_tokens"],
+            temperature=params["temperature"],
+            stop_sequences=params["stop"],
+            timeout=params["timeout"],
+            system=anthropic_system(self.prefix),
+            messages=[{"role": "user", "content": prompt}]
+        ) as stream:
+            for text in stream.text_stream:
+                if limiter.feed(text):
+                    break
+            # Input usage (including cache reads/writes) arrives with the first event
+            return stream.current_message_snapshot.usage
+
+    def _explain(self, error):
+        message = str(error).lower()
+        if "401" in message or "authentication" in message or "api-key" in message:
+            print(f"Authentication error detected. Please check your {self.section.get('api_key_env', 'ANTHROPIC_API_KEY')} environment variable.")
+
+
+class OpenAICompatibleLLM(LLM):
+    """OpenAI or an OpenAI-compatible server (LM Studio), streamed so the sentence limit can stop it early."""
+
+    def __init__(self, section, prefix, policy, tokens):
+        self.provider = section.get("provider", "openai")
+        super().__init__(section, prefix, policy, tokens)
+
+    def connect(self):
+        from openai import OpenAI
+
+        key_env = self.section.get("api_key_env")
+        self.client = OpenAI(
+            base_url=self.section.get("base_url") or None,
+            # LM Studio does not check the key
+            api_key=os.getenv(key_env) if key_env else "not-needed",
+            timeout=self.section.get("timeout", 60),
+        )
+
+    def _complete(self, prompt, params, limiter):
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=openai_messages(self.prefix, prompt),
+            max_tokens=params["max_tokens"],
+            temperature=params["temperature"],
+            stop=params["stop"],
+            timeout=params["timeout"],
+            stream=True,
+            # Final chunk carries usage, including prompt_tokens_details.cached_tokens
+            **({"stream_options": {"include_usage": True}} if self.section.get("stream_usage", True) else {})
+        )
+        usage = None
+        try:
+            for chunk in stream:
+                # Usage arrives in a last chunk without choices (not sent if we stop early)
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                if chunk.choices and limiter.feed(chunk.choices[0].delta.content):
+                    break
+        finally:
+            # Closing the stream early tells the server to stop generating
+            stream.close()
+        return usage
+
+
+class LocalLLM(LLM):
+    """In-process transformers model (bty_chtbt/local_inference.py) with the prefix's KV cache precomputed."""
+
+    provider = "local"
+
+    def connect(self):
+        from bty_chtbt.local_inference import LocalGenerator
+
+        self.model = self.section["model_path"]
+        self.client = LocalGenerator(
+            self.model,
+            prefix=self.prefix,
+            quantize=self.section.get("quantize", True),
+            max_batch_size=self.section.get("batch_size", 4),
+            max_length=self.section.get("max_length", 1024),
+            max_new_tokens=self.section.get("max_new_tokens", 300),
+        )
+
+    def _complete(self, prompt, params, limiter):
+        # Concurrent requests are batched by the generator; the limiter trims to the sentence limit
+        limiter.feed(self.client.generate(prompt, max_new_tokens=params["max_tokens"], timeout=params["timeout"]))
+        return None
+
+    def stream(self, prompt, channel="web", deadline=None):
+        """
+        Yield the answer text as it is generated (interactive use), under the same policy as
+        generate(): generation stops at max_tokens, the sentence limit or the deadline.
+        """
+        deadline = deadline or self.policy.deadline(channel)
+        try:
+            params = self.policy.params(channel, deadline)
+        except DeadlineExceeded as e:
+            print(f"Skipping generation: {e}")
+            yield SLOW_ANSWER
+            return
+        limiter = self.policy.limiter()
+        pieces = self.client.stream(prompt, max_new_tokens=params["max_tokens"], timeout=params["timeout"])
+        sent = 0
+        fallback = EMPTY_ANSWER
+        try:
+            for piece in pieces:
+                done = limiter.feed(piece)
+                # The limiter cuts the text after the last allowed sentence; emit only what is new
+                text = limiter.text
+                if len(text) > sent:
+                    yield text[sent:]
+                    sent = len(text)
+                if done:
+                    break
+                if deadline.expired():
+                    print(f"Stopped generation at the {deadline.seconds:.1f}s request deadline")
+                    break
+        except queue.Empty:
+            print(f"Stopped generation: no tokens within the {params['timeout']:.1f}s left of the deadline")
+            fallback = SLOW_ANSWER
+        finally:
+            # Stops the generation thread when we break early
+            pieces.close()
+        if not sent:
+            print("Error: Response has no content")
+            yield fallback
+            return
+        self.policy.record(channel, self.tokens.count(limiter.text))
+
+
+class MockLLM(LLM):
+    """
+    Canned answer after an optional fixed latency (latency_ms), for replays and load tests
+    that measure everything except the model.
+    """
+
+    provider = "mock"
+
+    def connect(self):
+        self.client = self
+
+    def _complete(self, _prompt, params, limiter):
+        latency = self.section.get("latency_ms", 0) / 1000
+        if latency:
+            time.sleep(min(latency, params["timeout"]))
+        limiter.feed(self.section.get("answer", "這是模擬回答。"))
+        return None
+
+
+PROVIDERS = {
+    "anthropic": AnthropicLLM,
+    "openai": OpenAICompatibleLLM,
+    "lmstudio": OpenAICompatibleLLM,
+    "local": LocalLLM,
+    "mock": MockLLM,
+}
+
+
+def build_llm(section, prefix, policy, tokens):
+    provider = section.get("provider")
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider {provider!r}; expected one of {', '.join(PROVIDERS)}")
+    return PROVIDERS[provider](section, prefix, policy, tokens)
@@ -0,0 +1,243 @@
+import os
+import threading
+from collections import OrderedDict
+
+from bty_chtbt.chunking import expand_to_parents
+from bty_chtbt.dedup import collapse_duplicates
+from bty_chtbt.embedding_cache import CachedEmbeddings
+from bty_chtbt.history import RollingHistory
+from bty_chtbt.model_bundle import resolve_model
+from bty_chtbt.pipeline.config import resolve_path
+from bty_chtbt.prompt_cache import cacheable_prefix
+from bty_chtbt.reranker import CrossEncoderReranker
+from bty_chtbt.vector_backend import DEFAULT_STORE_NAMES, load_backend
+
+
+def build_embeddings(config, embedder):
+    """HuggingFace embeddings for the embedder section, wrapped in the embedding cache unless cache_dir is empty."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    model_name = embedder["model"]
+    model_kwargs = {"device": embedder["device"]} if embedder.get("device") else {}
+    encode_kwargs = {"normalize_embeddings": True} if embedder.get("normalize") else {}
+    # Loaded from the offline bundle when MODEL_BUNDLE_DIR is set (python -m bty_chtbt.model_bundle create)
+    model = HuggingFaceEmbeddings(model_name=resolve_model(model_name), model_kwargs=model_kwargs,
+                                  encode_kwargs=encode_kwargs)
+    if not embedder.get("cache_dir"):
+        return model
+    # Content-addressed cache so repeated queries skip the transformer forward pass
+    return CachedEmbeddings(model, model_name=model_name, cache_dir=resolve_path(config, embedder["cache_dir"]))
+
+
+def store_path(config, retriever):
+    """Configured store path, or <store_dir>/<default store name of the backend>."""
+    path = retriever.get("path") or os.path.join(retriever.get("store_dir", "db"), DEFAULT_STORE_NAMES[retriever["backend"]])
+    return resolve_path(config, path)
+
+
+def build_reranker(section):
+    if not section.get("enabled"):
+        return None
+    return CrossEncoderReranker(
+        model_name=resolve_model(section["model"]),
+        runtime=section.get("runtime", "onnx"),
+        budget_seconds=section.get("budget_ms", 150) / 1000,
+    )
+
+
+class Retriever:
+    """
+    Dense retrieval with optional reranking or MMR, followed by parent expansion.
+
+    - With a reranker, candidates dense hits are fetched and the best top_n kept
+      (falling back to the dense order when scoring misses its latency budget).
+    - mode="mmr" picks a diversified top-k from fetch_k candidates by re-scoring their
+      stored vectors, so diversity costs no extra embedding.
+    - With collapse_duplicates, rows flagged as near-duplicates at build time (see
+      bty_chtbt/dedup.py) take one slot per group; twice k hits are fetched to refill it.
+    - Matched chunks of long answers are widened to the whole answer while the result
+      fits parent_context_tokens (see bty_chtbt/chunking.py).
+
+    vector_store may be None and attached later, e.g. after a download on first use.
+    """
+
+    def __init__(self, vector_store, count_tokens, k=3, mode="similarity", fetch_k=20, mmr_lambda=0.5,
+                 parent_context_tokens=500, reranker=None, rerank_candidates=12, rerank_top_n=2,
+                 collapse_duplicates=True):
+        if mode not in ("similarity", "mmr"):
+            raise ValueError(f"Unknown retrieval mode {mode!r}; expected 'similarity' or 'mmr'")
+        self.vector_store = vector_store
+        self.count_tokens = count_tokens
+        self.k = k
+        self.mode = mode
+        self.fetch_k = fetch_k
+        self.mmr_lambda = mmr_lambda
+        self.parent_context_tokens = parent_context_tokens
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.rerank_top_n = rerank_top_n
+        self.collapse_duplicates = collapse_duplicates
+
+    def attach(self, vector_store):
+        self.vector_store = vector_store
+
+    def search(self, query, k, filter=None):
+        # filter (e.g. {"category": "雷射"}) is applied inside the index via the precomputed inverted lists
+        if self.reranker is not None:
+            results = self.vector_store.search(query, k=max(k, self.rerank_candidates), filter=filter)
+            return collapse_duplicates(results) if self.collapse_duplicates else results
+        fetch = 2 * k if self.collapse_duplicates else k
+        if self.mode == "mmr":
+            results = self.vector_store.mmr_search(query, k=fetch, fetch_k=max(self.fetch_k, fetch),
+                                                   lambda_mult=self.mmr_lambda, filter=filter)
+        else:
+            results = self.vector_store.search(query, k=fetch, filter=filter)
+        return collapse_duplicates(results, k) if self.collapse_duplicates else results
+
+    def rerank(self, query, candidates, k, deadline=None):
+        return self.reranker.rerank(query, candidates, top_n=min(k, self.rerank_top_n), deadline=deadline)
+
+    def expand(self, results):
+        return expand_to_parents(results, self.vector_store, self.count_tokens, self.parent_context_tokens)
+
+
+def build_retriever(config, embeddings, tokens, load_store=True):
+    section = config["retriever"]
+    vector_store = None
+    if load_store:
+        options = {}
+        if section["backend"] == "sharded":
+            # Shard type and key come from the store's manifest; only the serving knobs are set here
+            options = {"workers": section.get("shard_workers"), "reload_seconds": section.get("shard_reload_seconds")}
+        vector_store = load_backend(section["backend"], store_path(config, section), embeddings,
+                                    embedding_model_name=config["embedder"]["model"], **options)
+    rerank = config.get("reranker", {})
+    return Retriever(
+        vector_store,
+        tokens.count,
+        k=section.get("k", 3),
+        mode=section.get("mode", "similarity"),
+        fetch_k=section.get("fetch_k", 20),
+        mmr_lambda=section.get("mmr_lambda", 0.5),
+        parent_context_tokens=section.get("parent_context_tokens", 500),
+        reranker=build_reranker(rerank),
+        rerank_candidates=rerank.get("candidates", 12),
+        rerank_top_n=rerank.get("top_n", 2),
+        collapse_duplicates=section.get("collapse_duplicates", True),
+    )
+
+
+def prompt_budget(llm, prompt, output_tokens):
+    """
+    Prompt tokens (prefix included) that fit the model's context window next to an answer
+    of output_tokens: context_window minus the answer and reserve_tokens (chat template
+    and message framing), lowered to prompt.max_prompt_tokens when that is set.
+    """
+    # The local generator's max_length bounds prompt + answer, whatever the model supports
+    context_window = llm.get("max_length") or llm.get("context_window")
+    if not context_window:
+        raise ValueError(f"No context_window set for LLM {llm.get('model')!r}")
+    if llm.get("max_new_tokens"):
+        output_tokens = min(output_tokens, llm["max_new_tokens"])
+    budget = context_window - output_tokens - prompt.get("reserve_tokens", 64)
+    if prompt.get("max_prompt_tokens"):
+        budget = min(budget, prompt["max_prompt_tokens"])
+    if budget <= 0:
+        raise ValueError(f"Context window of {context_window} tokens leaves no room for the prompt")
+    return budget
+
+
+class PromptBuilder:
+    """
+    QA prompts in two parts: a fixed prefix (system message + template instructions) that
+    providers can cache, and the per-request part built here.
+
+    The whole prompt (prefix included) is kept within max_prompt_tokens, counted in the
+    model's tokens (see prompt_budget): history is already bounded by its own budget, so
+    the retrieved context is truncated to the rest.
+    """
+
+    TEMPLATE = "Context:\n{context}\n\nChat History:\n{history_context}\n\nUser Question: {query}\n\nAnswer: "
+
+    def __init__(self, system_message, tokens, max_prompt_tokens, warn_prompt_tokens=None):
+        self.system_message = system_message
+        self.tokens = tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.warn_prompt_tokens = warn_prompt_tokens or max_prompt_tokens
+        self.prefix = cacheable_prefix(system_message)
+        self.empty_prompt = self.TEMPLATE.format(context="", history_context="", query="")
+
+    # Counted on use (from the token cache) so they follow a calibrated estimate
+    @property
+    def prefix_tokens(self):
+        return self.tokens.count(self.prefix)
+
+    @property
+    def template_tokens(self):
+        return self.tokens.count(self.empty_prompt)
+
+    @staticmethod
+    def format_context(docs):
+        return "\n".join([f"Q: {doc.metadata['question']}\nA: {doc.page_content}" for doc in docs])
+
+    def build(self, query, docs, history_context=""):
+        context = self.format_context(docs)
+        base_tokens = self.prefix_tokens + self.template_tokens
+        max_content_tokens = self.max_prompt_tokens - base_tokens - self.tokens.count(query)
+        target_context_tokens = max(0, max_content_tokens - self.tokens.count(history_context))
+        if self.tokens.count(context) > target_context_tokens:
+            context = self.tokens.truncate(context, target_context_tokens, keep_start=True)
+
+        prompt = self.TEMPLATE.format(context=context, history_context=history_context, query=query)
+        prompt_tokens = self.prefix_tokens + self.tokens.count(prompt)
+        print(f"QA Prompt token count: {prompt_tokens}")
+        if prompt_tokens > self.warn_prompt_tokens:
+            print(f"Warning: Prompt still exceeds {self.warn_prompt_tokens} tokens after truncation.")
+        return prompt
+
+
+class HistoryStore:
+    """
+    Conversation histories with a constant token footprint (summary of older turns +
+    latest turn, see bty_chtbt/history.py): a factory for single-user scripts and a
+    per-session map for the web APIs.
+    """
+
+    def __init__(self, tokens, budget_tokens=200, max_sessions_under_pressure=200):
+        self.tokens = tokens
+        self.budget_tokens = budget_tokens
+        self.max_sessions_under_pressure = max_sessions_under_pressure
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new(self):
+        return RollingHistory(self.tokens.count, self.tokens.truncate)
+
+    def render(self, history):
+        return history.render(self.budget_tokens) if history is not None else ""
+
+    def get(self, session_id):
+        """History of one session, created on first use."""
+        with self._lock:
+            # An empty RollingHistory is falsy (len 0), so test for None explicitly
+            history = self._sessions.pop(session_id, None)
+            if history is None:
+                history = self.new()
+            self._sessions[session_id] = history
+            return history
+
+    def clear(self, session_id):
+        with self._lock:
+            history = self._sessions.get(session_id)
+        if history is not None:
+            history.clear()
+
+    def trim(self):
+        """Memory-governor shrinker: histories are constant-size, so drop the least recent sessions instead."""
+        with self._lock:
+            while len(self._sessions) > self.max_sessions_under_pressure:
+                self._sessions.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "budget_tokens": self.budget_tokens}
@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    Latency of each pipeline stage (embed, search, rerank, expand, prompt, generate, ...).
+
+    stage() records every run into a window of recent samples for p50/p95 and, when the
+    caller passes a dict, also writes the stage's milliseconds into it so one request's
+    breakdown can be logged or returned.
+    """
+
+    def __init__(self, history_size=512):
+        self._samples = defaultdict(lambda: deque(maxlen=history_size))
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._counts[name] += 1
+
+    @contextmanager
+    def stage(self, name, timings=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.record(name, seconds)
+            if timings is not None:
+                timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 1)
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for name, samples in self._samples.items():
+                values = np.array(samples) * 1000
+                stats[name] = {
+                    "count": self._counts[name],
+                    "p50_ms": round(float(np.percentile(values, 50)), 1),
+                    "p95_ms": round(float(np.percentile(values, 95)), 1),
+                }
+            return stats
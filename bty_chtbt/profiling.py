@@ -0,0 +1,314 @@
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+# Not available on Windows
+SIGUSR2 = getattr(signal, "SIGUSR2", None)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    # ";" separates frames in the collapsed format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _stack(frame):
+    """Frames of a thread's current stack, root first."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
+
+
+def write_collapsed(path, stacks):
+    """Brendan Gregg's collapsed format ("a;b;c count"), readable by flamegraph.pl and speedscope."""
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{';'.join(stack)} {count}\n")
+
+
+def write_speedscope(path, stacks, interval_ms, name):
+    """Speedscope "sampled" profile with one weighted sample per distinct stack."""
+    frames, frame_ids, samples, weights = [], {}, [], []
+    for stack, count in stacks.most_common():
+        sample = []
+        for label in stack:
+            if label not in frame_ids:
+                frame_ids[label] = len(frames)
+                frames.append({"name": label})
+            sample.append(frame_ids[label])
+        samples.append(sample)
+        weights.append(count * interval_ms)
+    profile = {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "name": name,
+        "exporter": "bty_chtbt.profiling",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profile, f)
+
+
+class SamplingProfiler:
+    """
+    Low-overhead wall-clock sampling profiler for the chat hot path.
+
+    A fraction (sample_rate) of requests entering request() is marked for profiling.
+    While any marked request is running, a background thread samples the stacks of
+    those request threads every interval seconds with sys._current_frames(), so
+    unsampled requests pay only for one random() call. Every window_seconds the
+    aggregated stacks are written to output_dir as a collapsed-stack file and a
+    speedscope JSON file; with tracemalloc_frames > 0 an allocation snapshot diff
+    against the previous window is written alongside.
+
+    Configured from PROFILE_SAMPLE_RATE (0 disables), PROFILE_INTERVAL_MS,
+    PROFILE_WINDOW_SECONDS, PROFILE_TRACEMALLOC_FRAMES and PROFILE_DIR, and changed at
+    runtime with configure() (admin endpoint) or toggle() (SIGUSR2, applied by the next
+    request or sampler tick).
+    """
+
+    def __init__(self, output_dir=None, sample_rate=None, interval=None, window_seconds=None,
+                 tracemalloc_frames=None):
+        self.output_dir = output_dir or os.getenv("PROFILE_DIR", "/tmp/profiles")
+        self.sample_rate = 0.0
+        self.interval = float(interval or float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000)
+        self.window_seconds = float(window_seconds or os.getenv("PROFILE_WINDOW_SECONDS", "60"))
+        self.tracemalloc_frames = 0
+        self._stacks = Counter()
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._window_started = time.time()
+        self._last_snapshot = None
+        self._toggled_rate = 1.0
+        # Set by the SIGUSR2 handler, applied by _apply_pending_toggle()
+        self._toggle_pending = False
+        self._toggle_lock = threading.Lock()
+        self.sampled_requests = 0
+        self.samples = 0
+        self.dumps = []
+        self._window_number = 0
+        self.configure(
+            sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")) if sample_rate is None else sample_rate,
+            tracemalloc_frames=(int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "0"))
+                                if tracemalloc_frames is None else tracemalloc_frames),
+        )
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def configure(self, sample_rate=None, interval=None, window_seconds=None, tracemalloc_frames=None):
+        """Change settings at runtime; disabling flushes the current window."""
+        was_enabled = self.enabled
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        if interval is not None:
+            self.interval = float(interval)
+        if window_seconds is not None:
+            self.window_seconds = float(window_seconds)
+        if tracemalloc_frames is not None:
+            self.tracemalloc_frames = int(tracemalloc_frames)
+            if self.tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self.tracemalloc_frames)
+                self._last_snapshot = None
+            elif self.tracemalloc_frames == 0 and tracemalloc.is_tracing():
+                tracemalloc.stop()
+                self._last_snapshot = None
+        if self.enabled and not was_enabled:
+            self._window_started = time.time()
+        if was_enabled and not self.enabled:
+            self.dump()
+        return self.status()
+
+    def toggle(self):
+        """Switch profiling on (at the last used rate, or every request) or off."""
+        if self.enabled:
+            self._toggled_rate = self.sample_rate
+            return self.configure(sample_rate=0)
+        return self.configure(sample_rate=self._toggled_rate)
+
+    def install_signal_handler(self, signum=SIGUSR2):
+        """
+        Toggle profiling with `kill -USR2 <pid>`. Only possible from the main thread.
+
+        The handler only sets a flag: it can interrupt the main thread while that holds
+        self._lock (begin/end), so taking the lock or writing files there would deadlock.
+        The toggle happens at the next begin() or sampler tick.
+        """
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+
+        def request_toggle(*_):
+            self._toggle_pending = True
+
+        signal.signal(signum, request_toggle)
+        return True
+
+    def _apply_pending_toggle(self):
+        # Non-blocking, so a request thread and the sampler never both toggle (or wait)
+        if not self._toggle_pending or not self._toggle_lock.acquire(blocking=False):
+            return
+        try:
+            if self._toggle_pending:
+                self._toggle_pending = False
+                print(f"Profiling toggled: {self.toggle()}")
+        finally:
+            self._toggle_lock.release()
+
+    def begin(self, name="request"):
+        """Start profiling the calling thread if this request is sampled. Returns whether it is."""
+        self._apply_pending_toggle()
+        if not self.enabled or random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            self._active[threading.get_ident()] = name
+            self.sampled_requests += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+                self._thread.start()
+        return True
+
+    def end(self):
+        """Stop profiling the calling thread (no-op if it was not sampled)."""
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    @contextmanager
+    def request(self, name="request"):
+        """Profile the enclosed block if this request is sampled."""
+        sampled = self.begin(name)
+        try:
+            yield sampled
+        finally:
+            if sampled:
+                self.end()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._apply_pending_toggle()
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                # Idle: keep the window open until it is due, then write it and stop sampling
+                if time.time() - self._window_started < self.window_seconds:
+                    continue
+                self.dump()
+                with self._lock:
+                    if not self._active:
+                        self._thread = None
+                        return
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, name in active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._stacks[(name,) + _stack(frame)] += 1
+                        self.samples += 1
+            if time.time() - self._window_started >= self.window_seconds:
+                self.dump()
+
+    def dump(self):
+        """Write the current window's profile files and start a new window. Returns the paths."""
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+            window_started, self._window_started = self._window_started, time.time()
+        paths = []
+        if not stacks and not tracemalloc.is_tracing():
+            return paths
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(window_started))
+        self._window_number += 1
+        prefix = os.path.join(self.output_dir, f"profile-{os.getpid()}-{stamp}-{self._window_number:04d}")
+        if stacks:
+            write_collapsed(f"{prefix}.collapsed.txt", stacks)
+            write_speedscope(f"{prefix}.speedscope.json", stacks, self.interval * 1000, os.path.basename(prefix))
+            paths += [f"{prefix}.collapsed.txt", f"{prefix}.speedscope.json"]
+        if tracemalloc.is_tracing():
+            paths.append(self._dump_tracemalloc(f"{prefix}.tracemalloc.txt"))
+        self.dumps = (self.dumps + paths)[-20:]
+        print(f"Profile window written: {', '.join(paths)}")
+        return paths
+
+    def _dump_tracemalloc(self, path, limit=30):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"traced current={current / 1024 / 1024:.1f} MB peak={peak / 1024 / 1024:.1f} MB\n\n")
+            if self._last_snapshot is not None:
+                f.write(f"Top {limit} allocation changes since the previous window:\n")
+                for stat in snapshot.compare_to(self._last_snapshot, "lineno")[:limit]:
+                    f.write(f"{stat}\n")
+                f.write("\n")
+            f.write(f"Top {limit} live allocations:\n")
+            for stat in snapshot.statistics("lineno")[:limit]:
+                f.write(f"{stat}\n")
+        self._last_snapshot = snapshot
+        return path
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "interval_ms": round(self.interval * 1000, 2),
+            "window_seconds": self.window_seconds,
+            "tracemalloc_frames": self.tracemalloc_frames,
+            "output_dir": self.output_dir,
+            "sampled_requests": self.sampled_requests,
+            "samples": self.samples,
+            "recent_dumps": list(self.dumps),
+        }
+
+
+def apply_admin_settings(profiler, settings):
+    """
+    Apply settings posted to an admin endpoint, e.g.
+    {"sample_rate": 0.1, "window_seconds": 30, "interval_ms": 5, "tracemalloc_frames": 10, "dump": true}.
+    """
+    interval_ms = settings.get("interval_ms")
+    status = profiler.configure(
+        sample_rate=settings.get("sample_rate"),
+        interval=None if interval_ms is None else float(interval_ms) / 1000,
+        window_seconds=settings.get("window_seconds"),
+        tracemalloc_frames=settings.get("tracemalloc_frames"),
+    )
+    if settings.get("dump"):
+        status["written"] = profiler.dump()
+    return status
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    """Process-wide SamplingProfiler instance."""
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = SamplingProfiler()
+        return _profiler
@@ -0,0 +1,99 @@
+import threading
+
+# Instructions that used to open every QA prompt template. They are identical for every
+# request, so they now go into the system prompt where providers can cache them.
+QA_TEMPLATE_INSTRUCTIONS = "你是一個繁體中文問答聊天機器人。請根據以下上下文、對話歷史或你的知識回答使用者的問題。如果上下文和歷史無相關資訊，根據你的知識提供答案；若仍不知道，說不知道。"
+# Layout of the variable part; described once in the prefix so the model knows the sections
+QA_TEMPLATE_LAYOUT = "每則使用者訊息依序包含 Context、Chat History 與 User Question 三個部分，請在 Answer 後作答。"
+
+
+def cacheable_prefix(system_message, *sections):
+    """System message followed by the template instructions: the part of every prompt that never changes."""
+    return "\n\n".join([system_message, QA_TEMPLATE_INSTRUCTIONS, QA_TEMPLATE_LAYOUT] + list(sections))
+
+
+def anthropic_system(prefix):
+    """
+    System blocks for the Anthropic Messages API with a cache breakpoint after the prefix.
+
+    Anthropic only caches prefixes above a model-specific minimum (1024 tokens for
+    Sonnet); below it the breakpoint is accepted but nothing is cached, which shows up
+    as zero cached tokens in PromptCacheStats.
+    """
+    return [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}]
+
+
+def openai_messages(prefix, prompt):
+    """
+    Chat messages with the stable prefix first.
+
+    OpenAI caches identical prompt prefixes automatically (from 1024 tokens), and LM
+    Studio reuses the KV cache of a matching prefix, so the prefix must not contain
+    anything that changes per request.
+    """
+    return [
+        {"role": "system", "content": prefix},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _usage_value(obj, name):
+    if obj is None:
+        return 0
+    value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    return value or 0
+
+
+def usage_counts(usage):
+    """
+    Normalize provider usage to (input_tokens, cached_tokens, cache_write_tokens).
+
+    Anthropic reports uncached input, cache reads and cache writes separately;
+    OpenAI-compatible servers report total prompt tokens and, when available,
+    prompt_tokens_details.cached_tokens.
+    """
+    if _usage_value(usage, "prompt_tokens"):
+        details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+        return _usage_value(usage, "prompt_tokens"), _usage_value(details, "cached_tokens"), 0
+    cached = _usage_value(usage, "cache_read_input_tokens")
+    written = _usage_value(usage, "cache_creation_input_tokens")
+    return _usage_value(usage, "input_tokens") + cached + written, cached, written
+
+
+class PromptCacheStats:
+    """Per-request logging and running totals of prompt tokens served from the provider cache."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reported = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+
+    def record(self, usage):
+        """Record one request's usage (None if the provider did not report it)."""
+        with self._lock:
+            self.requests += 1
+            if usage is None:
+                return None
+            input_tokens, cached, written = usage_counts(usage)
+            self.reported += 1
+            self.input_tokens += input_tokens
+            self.cached_tokens += cached
+            self.cache_write_tokens += written
+        print(f"Prompt cache ({self.provider}): {cached}/{input_tokens} input tokens cached, {written} written")
+        return {"input_tokens": input_tokens, "cached_tokens": cached, "cache_write_tokens": written}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "provider": self.provider,
+                "requests": self.requests,
+                "reported": self.reported,
+                "input_tokens": self.input_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cache_write_tokens": self.cache_write_tokens,
+                "cached_ratio": round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else 0.0,
+            }
@@ -0,0 +1,196 @@
+import os
+import re
+import threading
+import time
+import weakref
+
+# Openers that mark a question as continuing the previous one ("那價格呢？", "還有其他療程嗎？")
+FOLLOW_UP_PREFIXES = ("那麼", "那", "還有", "另外", "然後", "所以", "and ", "what about ", "how about ")
+# Pronouns that refer back to the previous topic
+FOLLOW_UP_REFERENCES = ("它們", "它", "這個", "那個", "這種", "該療程", "這項")
+# The topic of a question is what comes before its first question word
+QUESTION_MARKERS = re.compile(
+    r"(有什麼|有哪些|是什麼|是多少|多少|怎麼|如何|為什麼|可以|能不能|會不會|要不要|需要|適合|要多久|嗎|呢|\?|？)"
+)
+# Question words that open a question whose subject was left out ("多少錢？", "要多久？");
+# a question that merely is short ("玻尿酸價格") still names its topic
+ELLIPSIS_OPENERS = ("有什麼", "有哪些", "是什麼", "是多少", "多少", "怎麼", "如何", "為什麼", "能不能",
+                    "會不會", "要不要", "要多久", "需要多久")
+POLITE_PREFIXES = ("請問一下", "請問", "想問", "我想問")
+TRAILING_PARTICLE = re.compile(r"呢(?=[?？]?$)")
+
+
+def _strip_punctuation(text):
+    return re.sub(r"[\s?？!！。,，、]", "", text)
+
+
+def is_follow_up(query):
+    """
+    Heuristic: does this question depend on the previous turn to make sense? Only
+    anaphora (它, 這個, ...) and ellipsis (a continuing opener, a missing subject or a
+    trailing 呢) count; length alone does not.
+    """
+    stripped = query.strip()
+    lowered = stripped.lower()
+    if any(lowered.startswith(prefix) for prefix in FOLLOW_UP_PREFIXES):
+        return True
+    if _strip_punctuation(stripped).startswith(ELLIPSIS_OPENERS):
+        return True
+    if any(reference in stripped for reference in FOLLOW_UP_REFERENCES):
+        return True
+    return bool(re.search(r"呢[?？]?$", stripped))
+
+
+def extract_topic(query):
+    """Subject of a standalone question, e.g. "皮秒雷射有什麼效果？" -> "皮秒雷射"."""
+    topic = query.strip()
+    for prefix in POLITE_PREFIXES:
+        if topic.startswith(prefix):
+            topic = topic[len(prefix):]
+            break
+    match = QUESTION_MARKERS.search(topic)
+    if match and match.start() >= 2:
+        topic = topic[:match.start()]
+    return topic.strip(" ，,、的")
+
+
+def rule_rewrite(query, topic):
+    """Rewrite a follow-up by attaching the conversation topic (see extract_topic)."""
+    if not topic:
+        return query
+    body = query.strip()
+    for reference in FOLLOW_UP_REFERENCES:
+        if reference in body:
+            return body.replace(reference, topic, 1)
+    for prefix in FOLLOW_UP_PREFIXES:
+        if body.lower().startswith(prefix):
+            body = body[len(prefix):].lstrip(" ，,")
+            break
+    body = TRAILING_PARTICLE.sub("", body)
+    if topic in body:
+        return body
+    return f"{topic}{body}"
+
+
+def llm_rewriter(openai_client, model, max_tokens=48):
+    """
+    Build a rewrite function that asks a small OpenAI-compatible model for the standalone query.
+
+    The returned function takes (query, previous_query, summary, timeout) and returns None
+    on failure so the caller can fall back to the rules.
+    """
+    def rewrite(query, previous_query, summary, timeout):
+        content = (
+            f"對話摘要:\n{summary or '（無）'}\n\n"
+            f"上一個問題: {previous_query}\n"
+            f"追問: {query}\n\n"
+            "請將追問改寫成一個不需要上下文也能理解的完整問題，只輸出改寫後的問題。"
+        )
+        try:
+            # No client retries: a retry would not fit the budget, the rules are the fallback
+            client = openai_client.with_options(max_retries=0, timeout=timeout)
+            response = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": content}],
+                max_tokens=max_tokens,
+                temperature=0,
+            )
+            rewritten = response.choices[0].message.content
+            return rewritten.strip().splitlines()[0] if rewritten and rewritten.strip() else None
+        except Exception as e:
+            print(f"Query rewrite failed, using rules: {e}")
+            return None
+    return rewrite
+
+
+class QueryRewriter:
+    """
+    Condenses follow-up questions into standalone retrieval queries.
+
+    - Standalone questions pass through untouched (no model call).
+    - Follow-ups are rewritten against the previous standalone query of the same
+      conversation: by rewrite_fn (e.g. llm_rewriter) within budget_seconds, otherwise
+      by rule_rewrite.
+    - Rewrites are cached per conversation on (previous standalone query, query). The
+      cache is keyed on the history object, so it disappears together with its session.
+
+    mode comes from QUERY_REWRITE ("off" by default, "rules" or "llm") and the budget
+    from QUERY_REWRITE_BUDGET_MS.
+    """
+
+    def __init__(self, rewrite_fn=None, mode=None, budget_seconds=None, cache_size=32):
+        self.mode = mode or os.getenv("QUERY_REWRITE", "off")
+        self.rewrite_fn = rewrite_fn if self.mode == "llm" else None
+        if budget_seconds is None:
+            budget_seconds = float(os.getenv("QUERY_REWRITE_BUDGET_MS", "300")) / 1000
+        self.budget_seconds = budget_seconds
+        self.cache_size = cache_size
+        self._sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.rewrites = 0
+        self.cache_hits = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _session(self, history):
+        with self._lock:
+            state = self._sessions.get(history)
+            if state is None:
+                state = self._sessions[history] = {"last": None, "topic": "", "cache": {}}
+            return state
+
+    def _remember(self, state, key, standalone):
+        with self._lock:
+            state["last"] = (key[1], standalone)
+            cache = state["cache"]
+            cache[key] = standalone
+            while len(cache) > self.cache_size:
+                del cache[next(iter(cache))]
+
+    def rewrite(self, query, history):
+        """Standalone version of query given the conversation history (a RollingHistory)."""
+        if not self.enabled or history is None:
+            return query
+        state = self._session(history)
+        recent = history.recent_queries()
+        previous = recent[-1] if recent else ""
+        # The previous question may itself have been a follow-up; use its rewrite
+        if previous and state["last"] and state["last"][0] == previous:
+            previous = state["last"][1]
+        key = (previous, query)
+        if key in state["cache"]:
+            self.cache_hits += 1
+            standalone = state["cache"][key]
+            self._remember(state, key, standalone)
+            return standalone
+
+        if not previous or not is_follow_up(query):
+            # A standalone question sets the topic that later follow-ups refer to
+            state["topic"] = extract_topic(query)
+            self._remember(state, key, query)
+            return query
+
+        started = time.monotonic()
+        standalone = None
+        if self.rewrite_fn is not None:
+            standalone = self.rewrite_fn(query, previous, history.summary, self.budget_seconds)
+            if standalone is None or time.monotonic() - started > self.budget_seconds:
+                self.fallbacks += 1
+                standalone = None
+        if not standalone:
+            standalone = rule_rewrite(query, state["topic"] or extract_topic(previous))
+        self.rewrites += 1
+        self._remember(state, key, standalone)
+        return standalone
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "budget_ms": round(self.budget_seconds * 1000),
+            "rewrites": self.rewrites,
+            "cache_hits": self.cache_hits,
+            "fallbacks": self.fallbacks,
+        }
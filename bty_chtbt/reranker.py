@@ -0,0 +1,153 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# Small multilingual cross-encoder (MiniLM, ~118M params) trained on mMARCO, handles Chinese
+DEFAULT_RERANK_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+def _document_text(doc):
+    question = doc.metadata.get("question", "")
+    return f"{question}\n{doc.page_content}" if question else doc.page_content
+
+
+class CrossEncoderReranker:
+    """
+    Reorders dense-retrieval candidates with a cross-encoder scored in one batched pass.
+
+    The model runs on CPU through ONNX Runtime (optimum, int8 dynamic quantization) when
+    available, otherwise through PyTorch with dynamic int8 quantization of the Linear layers.
+    It is loaded on a background thread at construction, so startup is not blocked.
+
+    rerank() never blocks for longer than budget_seconds: when scoring is too slow, the
+    model is still loading or a previous scoring pass is still running, the candidates are
+    returned in their dense order instead.
+    """
+
+    def __init__(self, model_name=DEFAULT_RERANK_MODEL, runtime="onnx", budget_seconds=0.15,
+                 max_length=256, quantize=True):
+        self.model_name = model_name
+        self.runtime = runtime
+        self.budget_seconds = budget_seconds
+        self.max_length = max_length
+        self.quantize = quantize
+        self.tokenizer = None
+        self.model = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+        self._pending = None
+        self._lock = threading.Lock()
+        self.reranked = 0
+        self.fallbacks = 0
+        self._loading = self._executor.submit(self._load)
+
+    def _load(self):
+        from transformers import AutoTokenizer
+
+        start = time.perf_counter()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = None
+        if self.runtime == "onnx":
+            try:
+                model = self._load_onnx()
+            except ImportError:
+                print("optimum[onnxruntime] is not installed, reranking with PyTorch instead")
+                self.runtime = "torch"
+        if model is None:
+            model = self._load_torch()
+        self.model = model
+        print(f"Loaded reranker {self.model_name} ({self.runtime}) in {time.perf_counter() - start:.1f}s")
+
+    def _load_onnx(self):
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+
+        model = ORTModelForSequenceClassification.from_pretrained(self.model_name, export=True)
+        if not self.quantize:
+            return model
+        from tempfile import mkdtemp
+
+        from optimum.onnxruntime import ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        # Dynamic int8 quantization of the exported graph; roughly 2-3x faster on CPU
+        quantized_dir = mkdtemp(prefix="reranker_int8_")
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(save_dir=quantized_dir,
+                           quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+        return ORTModelForSequenceClassification.from_pretrained(quantized_dir)
+
+    def _load_torch(self):
+        import torch
+        from transformers import AutoModelForSequenceClassification
+
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        model.eval()
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    def wait_ready(self, timeout=None):
+        """Block until the model is loaded (re-raises a load failure)."""
+        self._loading.result(timeout)
+        return self
+
+    def score(self, query, docs):
+        """Cross-encoder relevance of each document to query, one forward pass for the batch."""
+        features = self.tokenizer(
+            [query] * len(docs),
+            [_document_text(doc) for doc in docs],
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="pt",
+        )
+        if self.runtime == "onnx":
+            logits = self.model(**features).logits
+        else:
+            import torch
+
+            with torch.inference_mode():
+                logits = self.model(**features).logits
+        return logits.reshape(-1).tolist()
+
+    def rerank(self, query, docs, top_n=2, deadline=None):
+        """Best top_n of docs by cross-encoder score, or the dense top_n if over budget."""
+        if len(docs) <= 1:
+            return docs[:top_n]
+        budget = self.budget_seconds
+        if deadline is not None:
+            budget = min(budget, deadline.remaining())
+        with self._lock:
+            busy = self._pending is not None and not self._pending.done()
+            if not self.ready or busy or budget <= 0:
+                self.fallbacks += 1
+                return docs[:top_n]
+            self._pending = self._executor.submit(self.score, query, docs)
+            pending = self._pending
+        try:
+            scores = pending.result(timeout=budget)
+        except FutureTimeoutError:
+            self.fallbacks += 1
+            print(f"Reranking exceeded {budget * 1000:.0f} ms, keeping dense order")
+            return docs[:top_n]
+        except Exception as e:
+            self.fallbacks += 1
+            print(f"Reranking failed, keeping dense order: {e}")
+            return docs[:top_n]
+        self.reranked += 1
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [docs[i] for i in order[:top_n]]
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "runtime": self.runtime,
+            "ready": self.ready,
+            "budget_ms": round(self.budget_seconds * 1000),
+            "reranked": self.reranked,
+            "fallbacks": self.fallbacks,
+        }
@@ -0,0 +1,146 @@
+import functools
+import math
+import threading
+
+import tiktoken
+
+from bty_chtbt.model_bundle import resolve_model
+
+
+class TiktokenTokenizer:
+    """tiktoken encoding by name, or the encoding of an OpenAI model (exact for that model)."""
+
+    def __init__(self, encoding="cl100k_base", model=None):
+        self.name = model or encoding
+        self.encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(encoding)
+
+    def encode(self, text):
+        return self.encoding.encode(text)
+
+    def decode(self, tokens):
+        return self.encoding.decode(tokens)
+
+
+class HFTokenizer:
+    """Fast (Rust) Hugging Face tokenizer of an open model, e.g. the Qwen model LM Studio serves."""
+
+    def __init__(self, model):
+        from transformers import AutoTokenizer
+
+        self.name = model
+        self.tokenizer = AutoTokenizer.from_pretrained(resolve_model(model), use_fast=True)
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens)
+
+
+class TokenCounter:
+    """
+    Token counting and truncation in the served model's tokens, shared by prompt
+    building, history and context expansion.
+
+    Counts of recently seen strings (the prefix, retrieved answers, history) come from an
+    LRU cache of cache_size entries. For models without a public tokenizer the count of
+    a stand-in tokenizer is scaled by ratio; with calibrate=True, observe() moves ratio
+    towards the input tokens the provider reports, so the estimate converges on the
+    model's real tokenizer (once min_observations requests have reported usage). Exact
+    tokenizers only track that ratio for stats().
+    """
+
+    def __init__(self, tokenizer, ratio=1.0, calibrate=False, cache_size=4096, alpha=0.1,
+                 min_observations=5, min_ratio=0.5, max_ratio=3.0, fallback_from=None):
+        self.tokenizer = tokenizer
+        # Configured tokenizer this counter stands in for, when that one could not be loaded
+        self.fallback_from = fallback_from
+        self.ratio = ratio
+        self.calibrate = calibrate
+        self.alpha = alpha
+        self.min_observations = min_observations
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.observed_ratio = None
+        self.observations = 0
+        self._lock = threading.Lock()
+        self._base_count = functools.lru_cache(maxsize=cache_size)(self._encode_length)
+
+    def _encode_length(self, text):
+        return len(self.tokenizer.encode(text))
+
+    def count(self, text):
+        tokens = self._base_count(text)
+        return tokens if self.ratio == 1.0 else math.ceil(tokens * self.ratio)
+
+    def truncate(self, content, max_tokens, keep_start=True):
+        limit = max(0, int(max_tokens / self.ratio))
+        tokens = self.tokenizer.encode(content)
+        if len(tokens) <= limit:
+            return content
+        if keep_start:
+            return self.tokenizer.decode(tokens[:limit])
+        return self.tokenizer.decode(tokens[-limit:]) if limit else ""
+
+    def observe(self, texts, actual_tokens):
+        """Compare the counted tokens of the texts sent (prefix and prompt) with the provider's input tokens."""
+        counted = sum(self._base_count(text) for text in texts)
+        if not counted or not actual_tokens:
+            return
+        sample = actual_tokens / counted
+        with self._lock:
+            self.observations += 1
+            if self.observed_ratio is None:
+                self.observed_ratio = sample
+            else:
+                self.observed_ratio += self.alpha * (sample - self.observed_ratio)
+            if self.calibrate and self.observations >= self.min_observations:
+                self.ratio = min(self.max_ratio, max(self.min_ratio, self.observed_ratio))
+
+    def stats(self):
+        cache = self._base_count.cache_info()
+        return {
+            "tokenizer": self.tokenizer.name,
+            "fallback_from": self.fallback_from,
+            "ratio": round(self.ratio, 3),
+            "calibrate": self.calibrate,
+            "observed_ratio": round(self.observed_ratio, 3) if self.observed_ratio is not None else None,
+            "observations": self.observations,
+            "cache_hits": cache.hits,
+            "cache_misses": cache.misses,
+            "cache_size": cache.currsize,
+        }
+
+
+def build_token_counter(section, llm_section=None):
+    """
+    TokenCounter for a [tokenizer] config section:
+    - kind = "hf": the model's own fast tokenizer (model, or the LLM's model_path when empty)
+    - kind = "tiktoken": encoding, or the encoding of model (OpenAI models)
+    - kind = "estimate": encoding's count times ratio, calibrated from reported usage
+    An hf tokenizer that cannot be loaded (e.g. offline, or missing from the model bundle)
+    falls back to the tiktoken estimate with a warning; stats() then names it in fallback_from.
+    """
+    kind = section.get("kind", "tiktoken")
+    encoding = section.get("encoding", "cl100k_base")
+    cache_size = section.get("cache_size", 4096)
+    fallback_from = None
+    if kind == "hf":
+        model = section.get("model") or (llm_section or {}).get("model_path")
+        try:
+            return TokenCounter(HFTokenizer(model), cache_size=cache_size)
+        except (ImportError, OSError, ValueError) as e:
+            print("=" * 72)
+            print(f"WARNING: could not load the {model} tokenizer ({e})")
+            print(f"WARNING: prompt token budgets are ESTIMATED with tiktoken {encoding} and calibrated")
+            print("WARNING: from reported usage; add the tokenizer to the model bundle to count exactly:")
+            print(f"WARNING:   python -m bty_chtbt.model_bundle create --tokenizer {model}")
+            print("=" * 72)
+            kind = "estimate"
+            fallback_from = model
+    if kind == "estimate":
+        return TokenCounter(TiktokenTokenizer(encoding), ratio=section.get("ratio", 1.0), calibrate=True,
+                            cache_size=cache_size, fallback_from=fallback_from)
+    if kind == "tiktoken":
+        return TokenCounter(TiktokenTokenizer(encoding, section.get("model")), cache_size=cache_size)
+    raise ValueError(f"Unknown tokenizer kind {kind!r}; expected hf, tiktoken or estimate")
@@ -0,0 +1,296 @@
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from bty_chtbt.vector_backend import document_id
+
+# Personal data masked before a query is written. Runs of 7+ digits, optionally joined by
+# dashes (phone, account and member numbers), are masked. Prices and dosages are shorter,
+# space-separated numbers ("3000 5000") are not joined, and ISO dates (2026-10-19) are skipped.
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_TW_NATIONAL_ID = re.compile(r"\b[A-Z][12]\d{8}\b")
+_LONG_NUMBER = re.compile(r"(?<!\d)(?!\d{4}-\d{2}-\d{2}(?!\d))\+?\d[\d-]{5,}\d")
+_URL = re.compile(r"https?://\S+")
+
+
+def anonymize(text):
+    """Mask e-mail addresses, URLs, national ID numbers and phone-like digit runs."""
+    if not text:
+        return text
+    text = _EMAIL.sub("<email>", text)
+    text = _URL.sub("<url>", text)
+    text = _TW_NATIONAL_ID.sub("<id>", text)
+    return _LONG_NUMBER.sub(lambda match: "<number>" if sum(c.isdigit() for c in match.group()) >= 7
+                            else match.group(), text)
+
+
+class TrafficRecorder:
+    """
+    Appends one anonymized JSON line per answered request for later replay.
+
+    Each record holds the masked query (and the rewritten search query), the retrieval
+    filter and k, the retrieved document ids, per-stage timings and token counts. Session
+    and user ids are replaced by a salted hash, answers are not stored.
+
+    Every process writes its own traffic-<pid>.jsonl (gunicorn workers never interleave
+    lines); once it reaches max_bytes it is renamed with a timestamp and only the newest
+    `backups` rotated files of the directory are kept.
+    """
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, backups=10, sample_rate=1.0, salt=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        # A per-process random salt keeps session hashes unlinkable across restarts
+        self.salt = salt or uuid.uuid4().hex
+        self.path = os.path.join(directory, f"traffic-{os.getpid()}.jsonl")
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.rotations = 0
+        self.errors = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def hash_id(self, value):
+        if not value:
+            return None
+        return hashlib.sha256(f"{self.salt}:{value}".encode("utf-8")).hexdigest()[:16]
+
+    def _rotate(self):
+        self.rotations += 1
+        rotated = os.path.join(self.directory,
+                               f"traffic-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self.rotations}.jsonl")
+        os.replace(self.path, rotated)
+        old = sorted(glob.glob(os.path.join(self.directory, "traffic-*-*.jsonl")), key=os.path.getmtime)
+        for path in old[:-self.backups] if self.backups else old:
+            os.remove(path)
+
+    def record(self, channel, query, docs, timings, prompt_tokens=None, answer_tokens=None, session=None,
+               search_query=None, filter=None, k=None, profile=None):
+        """Write one request (sampled at sample_rate). Never raises: recording must not fail a request."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        entry = {
+            "id": uuid.uuid4().hex,
+            "ts": round(time.time(), 3),
+            "channel": channel,
+            "profile": profile,
+            "session": self.hash_id(session),
+            "query": anonymize(query),
+            "search_query": anonymize(search_query) if search_query and search_query != query else None,
+            "filter": filter,
+            "k": k,
+            "doc_ids": [document_id(doc) for doc in docs],
+            "timings_ms": dict(timings or {}),
+            "prompt_tokens": prompt_tokens,
+            "answer_tokens": answer_tokens,
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        try:
+            with self._lock:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self.recorded += 1
+        except OSError as e:
+            self.errors += 1
+            print(f"Traffic recording failed: {e}")
+            return None
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {"path": self.path, "recorded": self.recorded, "rotations": self.rotations,
+                    "errors": self.errors, "sample_rate": self.sample_rate}
+
+
+_recorder = None
+_recorder_loaded = False
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """
+    Process-wide TrafficRecorder, or None unless TRAFFIC_RECORD_DIR is set (opt-in).
+
+    TRAFFIC_RECORD_SAMPLE (1.0), TRAFFIC_RECORD_MAX_MB (50) and TRAFFIC_RECORD_BACKUPS (10)
+    tune it; TRAFFIC_RECORD_SALT fixes the session hash salt across restarts.
+    """
+    global _recorder, _recorder_loaded
+    with _recorder_lock:
+        if not _recorder_loaded:
+            directory = os.getenv("TRAFFIC_RECORD_DIR")
+            if directory:
+                _recorder = TrafficRecorder(
+                    directory,
+                    max_bytes=int(float(os.getenv("TRAFFIC_RECORD_MAX_MB", "50")) * 1024 * 1024),
+                    backups=int(os.getenv("TRAFFIC_RECORD_BACKUPS", "10")),
+                    sample_rate=float(os.getenv("TRAFFIC_RECORD_SAMPLE", "1.0")),
+                    salt=os.getenv("TRAFFIC_RECORD_SALT"),
+                )
+                print(f"Recording traffic to {_recorder.path}")
+            _recorder_loaded = True
+        return _recorder
+
+
+def read_records(path):
+    """Records of a JSONL file, or of every traffic-*.jsonl in a directory (oldest file first)."""
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "*.jsonl")), key=os.path.getmtime)
+    records = []
+    for file_path in paths:
+        with open(file_path, "r", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def replay_records(pipeline, records, channel=None):
+    """
+    Re-run recorded requests through a pipeline, one at a time, without history.
+
+    Returns records in the recorder's format (same ids) with the candidate's document
+    ids, stage timings and token counts, ready for compare_runs().
+    """
+    results = []
+    for record in records:
+        query = record["query"]
+        request_channel = channel or record.get("channel") or "web"
+        deadline = pipeline.policy.deadline(request_channel)
+        timings = {}
+        docs = pipeline.retrieve(record.get("search_query") or query, k=record.get("k"),
+                                 filter=record.get("filter"), deadline=deadline, timings=timings)
+        prompt = pipeline.build_prompt(query, docs, timings=timings)
+        answer = pipeline.generate(prompt, channel=request_channel, deadline=deadline, timings=timings)
+        results.append({
+            "id": record["id"],
+            "ts": round(time.time(), 3),
+            "channel": request_channel,
+            "profile": pipeline.name,
+            "llm": pipeline.llm.provider,
+            "query": query,
+            "search_query": record.get("search_query"),
+            "filter": record.get("filter"),
+            "k": record.get("k"),
+            "doc_ids": [document_id(doc) for doc in docs],
+            "timings_ms": timings,
+            "prompt_tokens": pipeline.prompt.prefix_tokens + pipeline.tokens.count(prompt),
+            "answer_tokens": pipeline.tokens.count(answer),
+        })
+    return results
+
+
+def write_records(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return path
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 1) if values else None
+
+
+def _mean(values):
+    return round(float(np.mean(values)), 1) if values else None
+
+
+def compare_runs(baseline, candidate, max_examples=10):
+    """
+    Side-by-side report of two runs over the same requests (matched by record id).
+
+    - latency: p50/p95 per stage in each run and the relative change of p95
+    - retrieval: how often the candidate returned the same ordered ids and the same
+      top document, the mean overlap (|A and B| / |A or B|) and the most changed queries
+    - tokens: mean prompt and answer tokens
+    """
+    by_id = {record["id"]: record for record in baseline}
+    pairs = [(by_id[record["id"]], record) for record in candidate if record["id"] in by_id]
+
+    stages = []
+    for base, cand in pairs:
+        for stage in list(base.get("timings_ms", {})) + list(cand.get("timings_ms", {})):
+            if stage not in stages:
+                stages.append(stage)
+    latency = []
+    for stage in stages:
+        base_values = [base["timings_ms"][stage] for base, _ in pairs if stage in base.get("timings_ms", {})]
+        cand_values = [cand["timings_ms"][stage] for _, cand in pairs if stage in cand.get("timings_ms", {})]
+        row = {
+            "stage": stage,
+            "baseline_p50_ms": _percentile(base_values, 50),
+            "candidate_p50_ms": _percentile(cand_values, 50),
+            "baseline_p95_ms": _percentile(base_values, 95),
+            "candidate_p95_ms": _percentile(cand_values, 95),
+            "p95_change": None,
+        }
+        if row["baseline_p95_ms"] and row["candidate_p95_ms"] is not None:
+            row["p95_change"] = round(row["candidate_p95_ms"] / row["baseline_p95_ms"] - 1, 3)
+        latency.append(row)
+
+    identical, same_top, overlaps, changed = 0, 0, [], []
+    for base, cand in pairs:
+        base_ids, cand_ids = base.get("doc_ids", []), cand.get("doc_ids", [])
+        union = set(base_ids) | set(cand_ids)
+        overlap = len(set(base_ids) & set(cand_ids)) / len(union) if union else 1.0
+        overlaps.append(overlap)
+        identical += base_ids == cand_ids
+        same_top += base_ids[:1] == cand_ids[:1]
+        if base_ids != cand_ids:
+            changed.append({
+                "query": cand.get("query"),
+                "overlap": round(overlap, 3),
+                "removed": [doc_id for doc_id in base_ids if doc_id not in cand_ids],
+                "added": [doc_id for doc_id in cand_ids if doc_id not in base_ids],
+            })
+    changed.sort(key=lambda example: example["overlap"])
+    count = max(len(pairs), 1)
+
+    return {
+        "requests": len(pairs),
+        "unmatched": len(candidate) - len(pairs),
+        "latency": latency,
+        "retrieval": {
+            "identical_rate": round(identical / count, 3),
+            "same_top1_rate": round(same_top / count, 3),
+            "mean_overlap": round(float(np.mean(overlaps)), 3) if overlaps else 1.0,
+            "changed": len(changed),
+            "examples": changed[:max_examples],
+        },
+        "tokens": {
+            "baseline_prompt_tokens": _mean([base["prompt_tokens"] for base, _ in pairs if base.get("prompt_tokens")]),
+            "candidate_prompt_tokens": _mean([cand["prompt_tokens"] for _, cand in pairs if cand.get("prompt_tokens")]),
+            "baseline_answer_tokens": _mean([base["answer_tokens"] for base, _ in pairs if base.get("answer_tokens")]),
+            "candidate_answer_tokens": _mean([cand["answer_tokens"] for _, cand in pairs
+                                              if cand.get("answer_tokens")]),
+        },
+    }
+
+
+def regressions(report, max_p95_regression=0.2, min_overlap=0.9, min_delta_ms=5.0, ignore_stages=()):
+    """
+    Reasons a candidate should not ship: stages whose p95 grew by more than
+    max_p95_regression (and by at least min_delta_ms, so sub-millisecond stages do not
+    fail on noise), or retrieval that drifted below min_overlap.
+    """
+    problems = []
+    for row in report["latency"]:
+        if row["stage"] in ignore_stages or row["p95_change"] is None:
+            continue
+        if (row["p95_change"] > max_p95_regression
+                and row["candidate_p95_ms"] - row["baseline_p95_ms"] >= min_delta_ms):
+            problems.append(f"{row['stage']} p95 {row['baseline_p95_ms']} -> {row['candidate_p95_ms']} ms "
+                            f"(+{row['p95_change']:.0%}, limit +{max_p95_regression:.0%})")
+    overlap = report["retrieval"]["mean_overlap"]
+    if overlap < min_overlap:
+        problems.append(f"retrieval overlap {overlap:.3f} below {min_overlap}")
+    return problems
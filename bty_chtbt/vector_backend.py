@@ -0,0 +1,1038 @@
+import heapq
+import itertools
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.documents import Document
+
+from bty_chtbt.artifact import VectorArtifact, write_artifact
+from bty_chtbt.filters import (
+    build_inverted_index,
+    load_inverted_index,
+    normalize_filter,
+    save_inverted_index,
+    select_ids,
+)
+from bty_chtbt.mmr import mmr_select
+from bty_chtbt.numpy_index import NumpyIndex, normalize_rows
+
+# Shared metadata schema written by every backend. page_content always holds the answer
+# (that is what gets embedded); the question lives in metadata alongside the row identity.
+SCHEMA_VERSION = 1
+METADATA_FIELDS = ("index", "question", "category", "source_file")
+MANIFEST_NAME = "backend.json"
+
+# Default store directory name per backend under db/
+DEFAULT_STORE_NAMES = {
+    "faiss": "hugging_face_FAISS_with_metadata",
+    "chroma": "hugging_face_chroma_with_metadata",
+    "numpy": "hugging_face_numpy_with_metadata",
+    "sharded": "hugging_face_sharded_with_metadata",
+}
+
+
+def _as_text(value):
+    # None and pandas NaN (which is not equal to itself) become empty strings
+    if value is None or value != value:
+        return ""
+    return str(value)
+
+
+def normalize_metadata(metadata):
+    """Return metadata with every shared schema field present as a string."""
+    normalized = {field: _as_text(metadata.get(field)) for field in METADATA_FIELDS}
+    for key, value in metadata.items():
+        if key not in normalized:
+            normalized[key] = value
+    return normalized
+
+
+def document_id(doc):
+    """
+    Stable id for a Q&A row. CSV IDs are only unique within a file, so prefix the source.
+    Chunks of a long answer (see chunking.py) get "#<chunk_index>" appended.
+    """
+    metadata = doc.metadata
+    row_id = f"{metadata.get('source_file', '')}:{metadata.get('index', '')}"
+    if int(metadata.get("chunk_count") or 1) > 1:
+        return f"{row_id}#{metadata['chunk_index']}"
+    return row_id
+
+
+def make_document(row_id, question, answer, category="", source_file=""):
+    """Build a Document that follows the shared schema."""
+    return Document(
+        page_content=str(answer),
+        metadata=normalize_metadata({
+            "index": row_id,
+            "question": question,
+            "category": category,
+            "source_file": source_file,
+        })
+    )
+
+
+def directory_size(path):
+    """Total size in bytes of all files under path."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class VectorBackend:
+    """
+    Common build/load/search/upsert/delete API over a persisted vector store.
+
+    Subclasses implement the _build/_load/... hooks; this class handles the shared
+    metadata schema, the manifest that records which embedding model built the store,
+    and the category/source inverted index used for filtered search.
+    """
+
+    name = None
+
+    def __init__(self, path, embeddings, embedding_model_name=None):
+        self.path = path
+        self.embeddings = embeddings
+        self.embedding_model_name = embedding_model_name or getattr(embeddings, "model_name", "")
+        self.store = None
+        self.inverted_index = None
+        self._batching = False
+
+    def build(self, documents):
+        """Create the store from scratch, replacing anything already at path."""
+        documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                     for doc in documents]
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        self._build(documents, [document_id(doc) for doc in documents])
+        self._refresh_inverted_index()
+        self._write_manifest(len(documents))
+        return self
+
+    def build_batches(self, batches):
+        """
+        Create the store from an iterable of Document lists, embedding one batch at a time.
+
+        The inverted index and manifest are written once at the end rather than per batch.
+        Raises ValueError, before anything at path is touched, when there are no documents.
+        """
+        batches = iter(batches)
+        first = next((documents for documents in batches if documents), None)
+        if first is None:
+            raise ValueError(f"No documents to build the {self.name} store {self.path} from.")
+        self.build(first)
+        self._batching = True
+        try:
+            for documents in batches:
+                documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                             for doc in documents]
+                self._upsert(documents, [document_id(doc) for doc in documents])
+        finally:
+            self._batching = False
+        self._persist()
+        self._refresh_inverted_index()
+        self._write_manifest(self.count())
+        return self
+
+    def load(self):
+        """Load a previously built store."""
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"Vector store {self.path} does not exist.")
+        manifest = self.read_manifest()
+        if manifest:
+            if manifest.get("backend") != self.name:
+                raise ValueError(f"{self.path} was built with the {manifest.get('backend')} backend, not {self.name}.")
+            built_with = manifest.get("embedding_model")
+            if built_with and self.embedding_model_name and built_with != self.embedding_model_name:
+                print(f"Warning: {self.path} was built with {built_with} but is being queried with {self.embedding_model_name}.")
+        self._load()
+        self.inverted_index = load_inverted_index(self.path)
+        if self.inverted_index is None:
+            # Stores built before filtering existed: derive the index from the docstore
+            self._refresh_inverted_index(save=False)
+        self._index_positions()
+        return self
+
+    def search(self, query, k=3, filter=None):
+        """
+        Return the k most similar Documents for a query string.
+
+        filter restricts the search to matching rows inside the index, e.g.
+        {"category": "雷射"} or "category=雷射,皮秒;source_file=laser.csv".
+        """
+        return self.search_by_vector(self.embeddings.embed_query(query), k=k, filter=filter)
+
+    def search_by_vector(self, vector, k=3, filter=None):
+        """Return the k most similar Documents for an already embedded query."""
+        search_filter = normalize_filter(filter)
+        if search_filter is None:
+            return self._search_by_vector(vector, k, None, None)
+        ids = select_ids(self.inverted_index, search_filter)
+        if not ids:
+            return []
+        return self._search_by_vector(vector, k, search_filter, ids)
+
+    def search_with_vectors(self, query, k=20, filter=None):
+        """
+        Top-k for a query string with the stored vectors of the results.
+
+        Returns (query vector, Documents, float32 matrix with one row per Document), so
+        results can be re-scored (e.g. for MMR) without embedding them again.
+        """
+        vector = self.embeddings.embed_query(query)
+        search_filter = normalize_filter(filter)
+        ids = None
+        if search_filter is not None:
+            ids = select_ids(self.inverted_index, search_filter)
+            if not ids:
+                return vector, [], np.empty((0, len(vector)), dtype=np.float32)
+        documents, vectors = self._search_with_vectors(vector, k, search_filter, ids)
+        return vector, documents, vectors
+
+    def mmr_search(self, query, k=3, fetch_k=20, lambda_mult=0.5, filter=None):
+        """
+        Diversified top-k: fetch fetch_k candidates and pick k by maximal marginal relevance.
+        lambda_mult=1 reproduces search(); lower values trade similarity for diversity.
+        """
+        vector, candidates, vectors = self.search_with_vectors(query, k=max(k, fetch_k), filter=filter)
+        return [candidates[row] for row in mmr_select(vector, vectors, k, lambda_mult)]
+
+    def upsert(self, documents):
+        """Insert documents, replacing any existing rows with the same id."""
+        documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                     for doc in documents]
+        self._upsert(documents, [document_id(doc) for doc in documents])
+        self._refresh_inverted_index()
+        self._write_manifest(self.count())
+
+    def delete(self, ids):
+        """Delete rows by document id; unknown ids are ignored."""
+        self._delete(list(ids))
+        self._refresh_inverted_index()
+        self._write_manifest(self.count())
+
+    def count(self):
+        raise NotImplementedError
+
+    def get(self, ids):
+        """Documents for the given ids, in order; unknown ids are skipped."""
+        raise NotImplementedError
+
+    def disk_size(self):
+        return directory_size(self.path)
+
+    def filter_values(self, field):
+        """Distinct values of a filterable field with their row counts."""
+        postings = (self.inverted_index or {}).get(field, {})
+        return {value: len(ids) for value, ids in postings.items()}
+
+    # LangChain-compatible alias so existing call sites keep working
+    def similarity_search(self, query, k=3, filter=None):
+        return self.search(query, k=k, filter=filter)
+
+    def read_manifest(self):
+        manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, count):
+        manifest = {
+            "backend": self.name,
+            "schema_version": SCHEMA_VERSION,
+            "metadata_fields": list(METADATA_FIELDS),
+            "embedding_model": self.embedding_model_name,
+            "count": count,
+        }
+        manifest.update(self._manifest_fields())
+        # Written aside and renamed, so a concurrent reader (ShardedBackend.reload) or a
+        # crash never sees a truncated manifest
+        manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def _manifest_fields(self):
+        """Hook for backend-specific manifest entries."""
+        return {}
+
+    def similarity_scores(self, vector, vectors):
+        """
+        Score stored vectors against a query, higher is more similar, in the order this
+        backend ranks them. LangChain FAISS and Chroma default to L2 distance.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return -np.square(vectors - np.asarray(vector, dtype=np.float32)).sum(axis=1)
+
+    def _refresh_inverted_index(self, save=True):
+        self.inverted_index = build_inverted_index(self._iter_metadata())
+        if save:
+            save_inverted_index(self.path, self.inverted_index)
+        self._index_positions()
+
+    def _index_positions(self):
+        """Hook for backends that map document ids to internal row positions."""
+
+    def _iter_metadata(self):
+        """Yield (doc_id, metadata) for every stored row."""
+        raise NotImplementedError
+
+    def export_rows(self):
+        """Return (ids, documents, float32 vectors) for every stored row, in row order."""
+        raise NotImplementedError
+
+    def _build(self, documents, ids):
+        raise NotImplementedError
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _search_by_vector(self, vector, k, search_filter, ids):
+        """search_filter/ids are None for an unfiltered search, else the normalized filter and matching ids."""
+        raise NotImplementedError
+
+    def _search_with_vectors(self, vector, k, search_filter, ids):
+        """Like _search_by_vector, but returns (Documents, float32 vectors of those rows)."""
+        raise NotImplementedError
+
+    def _upsert(self, documents, ids):
+        raise NotImplementedError
+
+    def _delete(self, ids):
+        raise NotImplementedError
+
+    def _persist(self):
+        """Write in-memory changes to disk; skipped while build_batches is adding batches."""
+
+
+class FaissBackend(VectorBackend):
+    """
+    LangChain FAISS index plus pickled docstore (the format deployed to GCS).
+
+    Filtered searches pass an IDSelectorBatch of the matching FAISS rows to the index,
+    so only those rows are scored instead of over-fetching and discarding.
+    """
+
+    name = "faiss"
+
+    def __init__(self, path, embeddings, embedding_model_name=None):
+        super().__init__(path, embeddings, embedding_model_name)
+        self._positions = {}
+
+    def _build(self, documents, ids):
+        from langchain_community.vectorstores import FAISS
+        self.store = FAISS.from_documents(documents=documents, embedding=self.embeddings, ids=ids)
+        self.store.save_local(self.path)
+
+    def _load(self):
+        from langchain_community.vectorstores import FAISS
+        self.store = FAISS.load_local(
+            folder_path=self.path,
+            embeddings=self.embeddings,
+            allow_dangerous_deserialization=True
+        )
+
+    def _iter_metadata(self):
+        for doc_id in self.store.index_to_docstore_id.values():
+            yield doc_id, self.store.docstore.search(doc_id).metadata
+
+    def _index_positions(self):
+        self._positions = {doc_id: row for row, doc_id in self.store.index_to_docstore_id.items()}
+
+    def get(self, ids):
+        return [self.store.docstore.search(doc_id) for doc_id in ids if doc_id in self._positions]
+
+    def export_rows(self):
+        total = self.store.index.ntotal
+        ids = [self.store.index_to_docstore_id[row] for row in range(total)]
+        documents = [self.store.docstore.search(doc_id) for doc_id in ids]
+        return ids, documents, self.store.index.reconstruct_n(0, total)
+
+    def _search_rows(self, vector, k, ids):
+        """FAISS row numbers of the top-k, restricted to ids when given."""
+        import faiss
+        params = None
+        total = self.store.index.ntotal
+        if ids is not None:
+            rows = np.fromiter((self._positions[doc_id] for doc_id in ids if doc_id in self._positions),
+                               dtype=np.int64)
+            if len(rows) == 0:
+                return []
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(rows))
+            total = len(rows)
+        query = np.asarray([vector], dtype=np.float32)
+        if self.store._normalize_L2:
+            faiss.normalize_L2(query)
+        _, indices = self.store.index.search(query, min(k, total), params=params)
+        return [int(row) for row in indices[0] if row != -1]
+
+    def _search_by_vector(self, vector, k, _search_filter, ids):
+        if ids is None:
+            return self.store.similarity_search_by_vector(vector, k=k)
+        return [self.store.docstore.search(self.store.index_to_docstore_id[row])
+                for row in self._search_rows(vector, k, ids)]
+
+    def _search_with_vectors(self, vector, k, _search_filter, ids):
+        rows = self._search_rows(vector, k, ids)
+        if not rows:
+            return [], np.empty((0, self.store.index.d), dtype=np.float32)
+        documents = [self.store.docstore.search(self.store.index_to_docstore_id[row]) for row in rows]
+        return documents, self.store.index.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+
+    def _persist(self):
+        if not self._batching:
+            self.store.save_local(self.path)
+
+    def similarity_scores(self, vector, vectors):
+        if self.store._normalize_L2:
+            vector = normalize_rows(vector)
+        return super().similarity_scores(vector, vectors)
+
+    def _existing_ids(self, ids):
+        return [doc_id for doc_id in ids if doc_id in self._positions]
+
+    def _upsert(self, documents, ids):
+        existing = self._existing_ids(ids)
+        if existing:
+            self.store.delete(existing)
+        self.store.add_documents(documents, ids=ids)
+        # Deleting renumbers the FAISS rows, so the id -> row map is rebuilt
+        self._index_positions()
+        self._persist()
+
+    def _delete(self, ids):
+        existing = self._existing_ids(ids)
+        if existing:
+            self.store.delete(existing)
+            self.store.save_local(self.path)
+
+    def count(self):
+        return self.store.index.ntotal
+
+
+class ChromaBackend(VectorBackend):
+    """Persistent Chroma collection. Filters become a metadata where-clause evaluated by Chroma."""
+
+    name = "chroma"
+
+    def _build(self, documents, ids):
+        from langchain_chroma import Chroma
+        self.store = Chroma.from_documents(
+            documents=documents,
+            embedding=self.embeddings,
+            ids=ids,
+            persist_directory=self.path
+        )
+
+    def _load(self):
+        from langchain_chroma import Chroma
+        self.store = Chroma(persist_directory=self.path, embedding_function=self.embeddings)
+
+    def _iter_metadata(self):
+        data = self.store.get(include=["metadatas"])
+        return zip(data["ids"], data["metadatas"], strict=True)
+
+    def get(self, ids):
+        data = self.store.get(ids=list(ids), include=["documents", "metadatas"])
+        found = {doc_id: Document(page_content=text, metadata=metadata)
+                 for doc_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"], strict=True)}
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+
+    def export_rows(self):
+        data = self.store.get(include=["embeddings", "documents", "metadatas"])
+        documents = [Document(page_content=text, metadata=metadata)
+                     for text, metadata in zip(data["documents"], data["metadatas"], strict=True)]
+        return list(data["ids"]), documents, np.asarray(data["embeddings"], dtype=np.float32)
+
+    @staticmethod
+    def _where(search_filter):
+        clauses = [{field: {"$in": values}} for field, values in search_filter.items()]
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def _search_by_vector(self, vector, k, search_filter, ids):
+        where = self._where(search_filter) if search_filter else None
+        return self.store.similarity_search_by_vector(vector, k=min(k, len(ids)) if ids else k, filter=where)
+
+    def _search_with_vectors(self, vector, k, search_filter, ids):
+        result = self.store._collection.query(
+            query_embeddings=[vector],
+            n_results=min(k, len(ids)) if ids else k,
+            where=self._where(search_filter) if search_filter else None,
+            include=["documents", "metadatas", "embeddings"]
+        )
+        documents = [Document(page_content=text, metadata=metadata)
+                     for text, metadata in zip(result["documents"][0], result["metadatas"][0], strict=True)]
+        vectors = np.asarray(result["embeddings"][0], dtype=np.float32).reshape(len(documents), -1)
+        return documents, vectors
+
+    def _upsert(self, documents, ids):
+        # langchain_chroma adds through collection.upsert, so existing ids are replaced
+        self.store.add_documents(documents, ids=ids)
+
+    def _delete(self, ids):
+        if ids:
+            self.store.delete(ids=ids)
+
+    def count(self):
+        return self.store._collection.count()
+
+
+class NumpyBackend(VectorBackend):
+    """
+    Brute-force search over a single memory-mapped embedding matrix.
+
+    The corpus is small enough that an exact blocked matrix product beats loading an
+    ANN index through LangChain. Vectors are stored as float16 (default), float32 or
+    int8 with per-row scales (see numpy_index.py) and the docstore as plain JSON.
+    Filtered searches score only the rows selected by the inverted index.
+    """
+
+    name = "numpy"
+    DOCSTORE_NAME = "docstore.json"
+
+    def __init__(self, path, embeddings, embedding_model_name=None, dtype=None):
+        super().__init__(path, embeddings, embedding_model_name)
+        self.dtype = dtype or os.getenv("NUMPY_INDEX_DTYPE", "float16")
+        self.index = None
+        self.ids = []
+        self.documents = []
+        self._positions = {}
+
+    def _embed_documents(self, documents):
+        return self.embeddings.embed_documents([doc.page_content for doc in documents])
+
+    def _build(self, documents, ids):
+        self.index = NumpyIndex.from_vectors(self._embed_documents(documents), dtype=self.dtype)
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self._save()
+
+    def _persist(self):
+        if not self._batching:
+            self._save()
+
+    def _save(self):
+        self.index.save(self.path)
+        docstore = [{"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata}
+                    for doc_id, doc in zip(self.ids, self.documents, strict=True)]
+        with open(os.path.join(self.path, self.DOCSTORE_NAME), "w", encoding="utf-8") as f:
+            json.dump(docstore, f, ensure_ascii=False)
+
+    def _load(self):
+        self.index = NumpyIndex.load(self.path, mmap=True)
+        self.dtype = self.index.dtype
+        with open(os.path.join(self.path, self.DOCSTORE_NAME), "r", encoding="utf-8") as f:
+            docstore = json.load(f)
+        self.ids = [entry["id"] for entry in docstore]
+        self.documents = [Document(page_content=entry["page_content"], metadata=entry["metadata"])
+                          for entry in docstore]
+
+    def _iter_metadata(self):
+        return ((doc_id, doc.metadata) for doc_id, doc in zip(self.ids, self.documents, strict=True))
+
+    def _index_positions(self):
+        self._positions = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+    def get(self, ids):
+        return [self.documents[self._positions[doc_id]] for doc_id in ids if doc_id in self._positions]
+
+    def export_rows(self):
+        vectors = np.asarray(self.index.vectors, dtype=np.float32)
+        if self.index.scales is not None:
+            vectors = vectors * self.index.scales[:, None]
+        return list(self.ids), list(self.documents), vectors
+
+    def filter_rows(self, filter):
+        """Sorted row indices matching a filter, or None when the filter is empty."""
+        search_filter = normalize_filter(filter)
+        if search_filter is None:
+            return None
+        ids = select_ids(self.inverted_index, search_filter)
+        return np.sort(np.fromiter((self._positions[doc_id] for doc_id in ids if doc_id in self._positions),
+                                   dtype=np.int64))
+
+    def similarity_scores(self, vector, vectors):
+        # Cosine similarity, like NumpyIndex.search
+        return normalize_rows(vectors) @ normalize_rows(vector)
+
+    def search_rows(self, vectors, k=3, filter=None):
+        """Batched top-k over query vectors. Returns (scores, rows) arrays, best first."""
+        return self.index.search(vectors, k=k, rows=self.filter_rows(filter))
+
+    def _search_by_vector(self, vector, k, search_filter, _ids):
+        _, rows = self.index.search(vector, k=k, rows=self.filter_rows(search_filter))
+        return [self.documents[row] for row in rows[0]]
+
+    def _search_with_vectors(self, vector, k, search_filter, _ids):
+        _, rows = self.index.search(vector, k=k, rows=self.filter_rows(search_filter))
+        return [self.documents[row] for row in rows[0]], self.index.reconstruct(rows[0])
+
+    def _upsert(self, documents, ids):
+        # Rows are written into the index in place and _positions kept current, so a
+        # streamed build costs O(rows) overall rather than a matrix copy per batch
+        vectors = np.asarray(self._embed_documents(documents), dtype=np.float32)
+        replaced_rows, replaced_vectors, appended_vectors = [], [], []
+        for doc_id, doc, vector in zip(ids, documents, vectors, strict=True):
+            row = self._positions.get(doc_id)
+            if row is None:
+                self._positions[doc_id] = len(self.ids)
+                self.ids.append(doc_id)
+                self.documents.append(doc)
+                appended_vectors.append(vector)
+            else:
+                self.documents[row] = doc
+                replaced_rows.append(row)
+                replaced_vectors.append(vector)
+        # Appended first: a repeated id within the batch replaces a row appended just now
+        if appended_vectors:
+            self.index.extend(appended_vectors)
+        if replaced_rows:
+            self.index.update(replaced_rows, replaced_vectors)
+        self._persist()
+
+    def _delete(self, ids):
+        drop = set(ids)
+        keep = [row for row, doc_id in enumerate(self.ids) if doc_id not in drop]
+        if len(keep) == len(self.ids):
+            return
+        self.index = self.index.take(keep)
+        self.ids = [self.ids[row] for row in keep]
+        self.documents = [self.documents[row] for row in keep]
+        self._save()
+
+    def count(self):
+        return len(self.ids)
+
+
+class ArtifactBackend(NumpyBackend):
+    """
+    Read-only NumpyBackend served from a single artifact file (see artifact.py).
+
+    path is the artifact file. The vectors are memory-mapped straight from it, ids and
+    the inverted index are decoded at load, and the docstore is only decompressed by
+    the first search. Unlike the directory backends, an embedding-model mismatch is
+    an error rather than a warning. Produce artifacts with export_artifact().
+    """
+
+    name = "artifact"
+
+    def __init__(self, path, embeddings, embedding_model_name=None, dtype=None, verify=True):
+        super().__init__(path, embeddings, embedding_model_name, dtype)
+        self.verify = verify
+        self.artifact = None
+        self._documents = None
+
+    @property
+    def documents(self):
+        if self._documents is None and self.artifact is not None:
+            self._documents = [Document(page_content=entry["page_content"], metadata=entry["metadata"])
+                               for entry in self.artifact.docstore()]
+        return self._documents if self._documents is not None else []
+
+    @documents.setter
+    def documents(self, value):
+        self._documents = value
+
+    def build(self, documents):
+        documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                     for doc in documents]
+        index = NumpyIndex.from_vectors(self._embed_documents(documents), dtype=self.dtype)
+        ids = [document_id(doc) for doc in documents]
+        write_artifact(self.path, index, ids, documents, self.embedding_model_name,
+                       build_inverted_index((doc_id, doc.metadata) for doc_id, doc in zip(ids, documents, strict=True)))
+        return self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"Vector store artifact {self.path} does not exist.")
+        self.artifact = VectorArtifact(self.path, verify=self.verify)
+        self.artifact.check_embedding_model(self.embedding_model_name)
+        self.index = NumpyIndex(self.artifact.vectors(), self.artifact.scales())
+        self.dtype = self.index.dtype
+        self.ids = self.artifact.ids()
+        self._documents = None
+        self.inverted_index = self.artifact.inverted_index()
+        if self.inverted_index is None:
+            self._refresh_inverted_index(save=False)
+        self._index_positions()
+        return self
+
+    def read_manifest(self):
+        return self.artifact.manifest if self.artifact is not None else VectorArtifact(self.path).manifest
+
+    def _upsert(self, documents, ids):
+        raise NotImplementedError("Artifacts are immutable; update the source store and export a new artifact.")
+
+    def _delete(self, ids):
+        raise NotImplementedError("Artifacts are immutable; update the source store and export a new artifact.")
+
+
+def shard_dir_name(name):
+    """Directory name for a shard value (file names and categories may hold any character)."""
+    return re.sub(r"[^\w.-]", "_", name) or "_empty"
+
+
+class ShardedBackend(VectorBackend):
+    """
+    One sub-store per source CSV (or per category, shard_by="category") under
+    <path>/shards/, each of the shard_backend type.
+
+    Shards are built in parallel and searched in parallel on a thread pool (FAISS and
+    the NumPy matrix product release the GIL); every shard returns its own top-k with the
+    stored vectors, which are re-scored with the shard backend's metric and merged with
+    a heap. A filter on the shard_by field only searches the matching shards.
+
+    rebuild_shard() replaces one shard without touching the others, and reload() picks up
+    shards rebuilt by another process (a deploy or vector_n_embed.py with REBUILD_SHARD);
+    with reload_seconds set, searches check for rebuilt shards at most that often.
+    """
+
+    name = "sharded"
+    SHARDS_DIR = "shards"
+
+    def __init__(self, path, embeddings, embedding_model_name=None, shard_backend=None, shard_by=None,
+                 workers=None, reload_seconds=None, **shard_options):
+        super().__init__(path, embeddings, embedding_model_name)
+        self.shard_backend = shard_backend or os.getenv("SHARD_BACKEND", "faiss")
+        self.shard_by = shard_by or os.getenv("SHARD_BY", "source_file")
+        if self.shard_backend == self.name:
+            raise ValueError("Shards cannot themselves be sharded.")
+        if self.shard_by not in METADATA_FIELDS:
+            raise ValueError(f"Cannot shard by '{self.shard_by}'. Choose from {METADATA_FIELDS}.")
+        self.workers = int(workers or os.getenv("SHARD_WORKERS", "0")) or min(8, os.cpu_count() or 1)
+        self.reload_seconds = float(reload_seconds if reload_seconds is not None
+                                    else os.getenv("SHARD_RELOAD_SECONDS", "0"))
+        self.shard_options = shard_options
+        self.shards = {}
+        self.versions = {}
+        self._pool = None
+        self._lock = threading.Lock()
+        self._checked_at = time.monotonic()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="shard")
+        return self._pool
+
+    def _shard_path(self, name, suffix=""):
+        return os.path.join(self.path, self.SHARDS_DIR, shard_dir_name(name) + suffix)
+
+    def _new_shard(self, name, path=None):
+        return get_backend(self.shard_backend, path or self._shard_path(name), self.embeddings,
+                           self.embedding_model_name, **self.shard_options)
+
+    def _group(self, documents):
+        groups = {}
+        for doc in documents:
+            groups.setdefault(_as_text(doc.metadata.get(self.shard_by)), []).append(doc)
+        return groups
+
+    def _manifest_fields(self):
+        return {
+            "shard_backend": self.shard_backend,
+            "shard_by": self.shard_by,
+            "shards": {name: {"dir": shard_dir_name(name), "count": shard.count(),
+                              "version": self.versions.get(name)}
+                       for name, shard in sorted(self.shards.items())},
+        }
+
+    def _build(self, documents, _ids):
+        def build_shard(item):
+            name, group = item
+            return name, self._new_shard(name).build(group)
+
+        self.shards = dict(self.pool.map(build_shard, self._group(documents).items()))
+        self.versions = {name: time.time() for name in self.shards}
+
+    def build_batches(self, batches):
+        """
+        Stream batches into the shards: each batch's rows go to their shard's builder on
+        the pool while the next batch is read. Rows of one shard are added in order, and
+        at most 2 * workers batch groups are in flight so memory stays bounded.
+        Raises ValueError, before anything at path is touched, when there are no documents.
+        """
+        batches = iter(batches)
+        first = next((documents for documents in batches if documents), None)
+        if first is None:
+            raise ValueError(f"No documents to build the {self.name} store {self.path} from.")
+        batches = itertools.chain([first], batches)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        self.shards, self.versions = {}, {}
+        last, in_flight = {}, deque()
+        for documents in batches:
+            documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                         for doc in documents]
+            for name, group in self._group(documents).items():
+                last[name] = self.pool.submit(self._add_to_shard, name, group, last.get(name))
+                in_flight.append(last[name])
+            while len(in_flight) > 2 * self.workers:
+                in_flight.popleft().result()
+        for future in in_flight:
+            future.result()
+        list(self.pool.map(self._finish_shard, self.shards.values()))
+        self.versions = {name: time.time() for name in self.shards}
+        self._refresh_inverted_index()
+        self._write_manifest(self.count())
+        return self
+
+    def _add_to_shard(self, name, documents, previous):
+        # Submitted in order, so the previous group of this shard has already started
+        if previous is not None:
+            previous.result()
+        shard = self.shards.get(name)
+        if shard is None:
+            shard = self._new_shard(name).build(documents)
+            shard._batching = True
+            with self._lock:
+                self.shards[name] = shard
+        else:
+            shard._upsert(documents, [document_id(doc) for doc in documents])
+
+    @staticmethod
+    def _finish_shard(shard):
+        shard._batching = False
+        shard._persist()
+        shard._refresh_inverted_index()
+        shard._write_manifest(shard.count())
+
+    def _load(self):
+        manifest = self.read_manifest() or {}
+        self.shard_backend = manifest.get("shard_backend", self.shard_backend)
+        self.shard_by = manifest.get("shard_by", self.shard_by)
+        entries = manifest.get("shards", {})
+
+        def load_shard(name):
+            return name, self._new_shard(name).load()
+
+        self.shards = dict(self.pool.map(load_shard, entries))
+        self.versions = {name: entry.get("version") for name, entry in entries.items()}
+        self._checked_at = time.monotonic()
+
+    def reload(self):
+        """
+        Load shards whose manifest version changed since they were loaded and drop removed
+        ones. A shard that fails to load (e.g. mid-swap) keeps serving its old copy and is
+        retried on the next reload, and so is an unreadable manifest. Never raises, since it
+        runs on the search path. Returns the names of the shards that changed.
+        """
+        try:
+            manifest = self.read_manifest() or {}
+        except (OSError, ValueError) as e:
+            print(f"Could not read the manifest of {self.path}; keeping the loaded shards: {e}")
+            return []
+        entries = manifest.get("shards", {})
+        changed = [name for name, entry in entries.items() if entry.get("version") != self.versions.get(name)]
+        removed = [name for name in self.shards if name not in entries]
+        loaded = {}
+        for name in changed:
+            try:
+                loaded[name] = self._new_shard(name).load()
+            except Exception as e:
+                # Anything a half-swapped shard directory raises; the old copy keeps serving
+                print(f"Could not reload shard {name}, keeping the loaded copy: {e}")
+        with self._lock:
+            shards = dict(self.shards)
+            for name in removed:
+                shards.pop(name, None)
+                self.versions.pop(name, None)
+            for name, shard in loaded.items():
+                shards[name] = shard
+                self.versions[name] = entries[name].get("version")
+            # Searches iterate over a snapshot, so swapping the dict is enough
+            self.shards = shards
+            if loaded or removed:
+                self._refresh_inverted_index(save=False)
+            self._checked_at = time.monotonic()
+        if loaded or removed:
+            print(f"Reloaded shards {sorted(loaded)}, removed {removed}")
+        return sorted(loaded) + removed
+
+    def _maybe_reload(self):
+        if self.reload_seconds and time.monotonic() - self._checked_at >= self.reload_seconds:
+            self._checked_at = time.monotonic()
+            try:
+                self.reload()
+            except Exception as e:
+                # A failed reload must not fail the user's search
+                print(f"Shard reload of {self.path} failed, serving the loaded shards: {e}")
+
+    def rebuild_shard(self, name, documents):
+        """
+        Rebuild a single shard from documents (all rows of one CSV, when sharding by
+        source_file) and leave the rest untouched. The new shard is built next to the old
+        one and swapped in, then the manifest version is bumped so other processes reload
+        it. An empty documents list removes the shard.
+        """
+        documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                     for doc in documents]
+        others = [doc for doc in documents if _as_text(doc.metadata.get(self.shard_by)) != name]
+        if others:
+            raise ValueError(f"{len(others)} documents do not belong to shard {name!r} ({self.shard_by}).")
+        path, staging, retired = self._shard_path(name), self._shard_path(name, ".new"), self._shard_path(name, ".old")
+        for leftover in (staging, retired):
+            if os.path.exists(leftover):
+                shutil.rmtree(leftover)
+        if documents:
+            self._new_shard(name, staging).build(documents)
+        if os.path.exists(path):
+            os.rename(path, retired)
+        if documents:
+            os.rename(staging, path)
+            shard = self._new_shard(name).load()
+        with self._lock:
+            shards = dict(self.shards)
+            if documents:
+                shards[name] = shard
+                self.versions[name] = time.time()
+            else:
+                shards.pop(name, None)
+                self.versions.pop(name, None)
+            self.shards = shards
+            self._refresh_inverted_index()
+            self._write_manifest(self.count())
+        if os.path.exists(retired):
+            shutil.rmtree(retired)
+        return shard if documents else None
+
+    def _selected_shards(self, search_filter):
+        self._maybe_reload()
+        shards = self.shards
+        values = (search_filter or {}).get(self.shard_by)
+        if values is None:
+            return list(shards.values())
+        return [shards[value] for value in values if value in shards]
+
+    @staticmethod
+    def _shard_search(shard, vector, k, search_filter):
+        ids = None
+        if search_filter is not None:
+            ids = select_ids(shard.inverted_index, search_filter)
+            if not ids:
+                return []
+        documents, vectors = shard._search_with_vectors(vector, k, search_filter, ids)
+        if not documents:
+            return []
+        scores = shard.similarity_scores(vector, vectors)
+        return sorted(zip(scores.tolist(), documents, vectors, strict=True), key=lambda hit: -hit[0])
+
+    def _merged_search(self, vector, k, search_filter):
+        """Top-k (score, Document, vector) over the selected shards, best first."""
+        shards = self._selected_shards(search_filter)
+        if len(shards) == 1:
+            results = [self._shard_search(shards[0], vector, k, search_filter)]
+        else:
+            results = list(self.pool.map(lambda shard: self._shard_search(shard, vector, k, search_filter),
+                                         shards))
+        merged = heapq.merge(*[[(-score, position, number, doc, row)
+                                for position, (score, doc, row) in enumerate(hits)]
+                               for number, hits in enumerate(results)])
+        return [(doc, row) for _, _, _, doc, row in itertools.islice(merged, k)]
+
+    def search_by_vector(self, vector, k=3, filter=None):
+        # Each shard applies the filter with its own inverted index
+        return [doc for doc, _ in self._merged_search(vector, k, normalize_filter(filter))]
+
+    def search_with_vectors(self, query, k=20, filter=None):
+        vector = self.embeddings.embed_query(query)
+        hits = self._merged_search(vector, k, normalize_filter(filter))
+        if not hits:
+            return vector, [], np.empty((0, len(vector)), dtype=np.float32)
+        return vector, [doc for doc, _ in hits], np.vstack([row for _, row in hits]).astype(np.float32)
+
+    def _upsert(self, documents, _ids):
+        for name, group in self._group(documents).items():
+            shard = self.shards.get(name)
+            if shard is None:
+                self.shards[name] = self._new_shard(name).build(group)
+            else:
+                shard.upsert(group)
+            self.versions[name] = time.time()
+
+    def _delete(self, ids):
+        ids = set(ids)
+        for name, shard in self.shards.items():
+            existing = [doc_id for doc_id, _ in shard._iter_metadata() if doc_id in ids]
+            if existing:
+                shard.delete(existing)
+                self.versions[name] = time.time()
+
+    def _iter_metadata(self):
+        for shard in list(self.shards.values()):
+            yield from shard._iter_metadata()
+
+    def get(self, ids):
+        found = {}
+        for shard in list(self.shards.values()):
+            for doc in shard.get(ids):
+                found[document_id(doc)] = doc
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+
+    def export_rows(self):
+        ids, documents, vectors = [], [], []
+        for shard in list(self.shards.values()):
+            shard_ids, shard_documents, shard_vectors = shard.export_rows()
+            ids.extend(shard_ids)
+            documents.extend(shard_documents)
+            vectors.append(np.asarray(shard_vectors, dtype=np.float32))
+        return ids, documents, np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def count(self):
+        return sum(shard.count() for shard in list(self.shards.values()))
+
+    def shard_counts(self):
+        return {name: shard.count() for name, shard in sorted(self.shards.items())}
+
+
+BACKENDS = {
+    FaissBackend.name: FaissBackend,
+    ChromaBackend.name: ChromaBackend,
+    NumpyBackend.name: NumpyBackend,
+    ArtifactBackend.name: ArtifactBackend,
+    ShardedBackend.name: ShardedBackend,
+}
+
+
+def get_backend(name, path, embeddings, embedding_model_name=None, **options):
+    """Instantiate a backend by name ("faiss", "chroma", "numpy", "artifact" or "sharded") without loading it."""
+    try:
+        backend_cls = BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown vector backend '{name}'. Choose from {sorted(BACKENDS)}.") from None
+    return backend_cls(path, embeddings, embedding_model_name, **options)
+
+
+def load_backend(name, path, embeddings, embedding_model_name=None, **options):
+    """Instantiate and load a backend in one call."""
+    return get_backend(name, path, embeddings, embedding_model_name, **options).load()
+
+
+def export_artifact(backend, path, dtype="float16", compress_vectors=False):
+    """Write a loaded backend's rows as a single-file artifact readable by ArtifactBackend."""
+    if isinstance(backend, NumpyBackend) and backend.index.dtype == dtype:
+        ids, documents, index = list(backend.ids), list(backend.documents), backend.index
+    else:
+        ids, documents, vectors = backend.export_rows()
+        index = NumpyIndex.from_vectors(vectors, dtype=dtype)
+    documents = [Document(page_content=doc.page_content, metadata=normalize_metadata(doc.metadata))
+                 for doc in documents]
+    inverted_index = build_inverted_index((doc_id, doc.metadata) for doc_id, doc in zip(ids, documents, strict=True))
+    write_artifact(path, index, ids, documents, backend.embedding_model_name, inverted_index,
+                   compress_vectors=compress_vectors)
+    return path
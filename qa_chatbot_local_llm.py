@@ -1,94 +1,36 @@
-import pandas as pd
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
+import os
 
-# Initialize HuggingFace embeddings
-embedding_model_name = "sentence-transformers/all-MiniLM-L6-v2"
-embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
+from bty_chtbt.pipeline import build_pipeline
 
-# Load the Chroma vector store
-vector_store_path = "./db/hugging_face_chroma_with_metadata"  # Path to the Chroma vector store
-vector_store = Chroma(persist_directory=vector_store_path, embedding_function=embeddings)
+# Embeddings, vector store (Chroma), prompt and the local model come from the "local" profile
+# in pipelines.toml. The fixed prompt prefix's KV cache is computed once at startup and
+# reused, so each request only runs the context and question through the model.
+# On CPU the Linear layers are quantized to int8 (LOCAL_LLM_QUANTIZE=0 to disable) and
+# concurrent requests are batched up to LOCAL_LLM_BATCH_SIZE; LOCAL_LLM_PATH points at the
+# model saved by hugging_face_download.py.
+pipeline = build_pipeline(os.getenv("PIPELINE_PROFILE", "local"))
+embeddings = pipeline.embeddings
+vector_store = pipeline.vector_store
+generator = pipeline.llm.client
+tokenizer = generator.tokenizer
+PROMPT_PREFIX = pipeline.prompt.prefix
 
-# Initialize HuggingFace model and tokenizer
-persistent_directory = "/Users/wsun/Programming/local_llm/qwen1_5_0_5b_local"
-tokenizer = AutoTokenizer.from_pretrained(persistent_directory)
-model = AutoModelForCausalLM.from_pretrained(persistent_directory)
-
-# Disable Sliding Window Attention to avoid SDPA warning
-model.config.sliding_window = None  # Disable SWA
-model.config.attention_dropout = 0.0  # Optional: Ensure no dropout for consistency
-
-# Set pad_token to eos_token and ensure proper padding
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "left"  # Use left padding for generation
-
-# Move model to MPS device if available（for MacOS with M1/M2 chips）
-device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-model.to(device)
+# Conversation history with a constant token footprint (summary of older turns + latest turn)
+chat_history = pipeline.history.new()
 
 # Function to retrieve relevant documents
-def retrieve_documents(query, k=3):
-    results = vector_store.similarity_search(query, k=k)
-    return results
+def retrieve_documents(query, k=None, timings=None):
+    return pipeline.retrieve(query, k=k, timings=timings)
 
 # Function to generate QA prompt
-def generate_qa_prompt(query, retrieved_docs):
-    context = "\n".join([f"Q: {doc.metadata['question']}\nA: {doc.page_content}" for doc in retrieved_docs])
-    prompt = f"""你是一個繁體中文問答聊天機器人。請根據以下上下文或你的知識回答使用者的問題。如果上下文無相關資訊，根據你的知識提供答案；若仍不知道，說不知道。
-
-    
-Context:
-{context}
-
-User Question: {query}
-
-Answer: """
-    return prompt
+def generate_qa_prompt(query, retrieved_docs, timings=None):
+    """Variable part of the prompt; PROMPT_PREFIX is prepended by the generator."""
+    return pipeline.build_prompt(query, retrieved_docs, chat_history, timings=timings)
 
 # Function to generate answer
-def generate_answer(prompt):
-    inputs = tokenizer(
-        prompt,
-        return_tensors="pt",
-        truncation=True,
-        max_length=768,  # Increased to handle longer prompts
-        padding=True,
-        return_attention_mask=True
-    ).to(device)
-    # Debug: Print input details
-    input_length = inputs["input_ids"].shape[1]
-    input_text = tokenizer.decode(inputs["input_ids"][0], skip_special_tokens=True)
-    print(f"Input length: {input_length} tokens")
-    print(f"Input text: {input_text}")
-    
-    # Check if input + max_new_tokens exceeds model limit (1024 tokens)
-    max_new_tokens = 300  # Increased to allow more output
-    if input_length + max_new_tokens > 1024:
-        max_new_tokens = 1024 - input_length
-        print(f"Adjusted max_new_tokens to {max_new_tokens} to stay within 1024-token limit")
-    
-    outputs = model.generate(
-        input_ids=inputs["input_ids"],
-        attention_mask=inputs["attention_mask"],
-        max_new_tokens=max_new_tokens,
-        num_return_sequences=1,
-        no_repeat_ngram_size=2,
-        temperature=0.9,
-        do_sample=True,
-        pad_token_id=tokenizer.eos_token_id
-    )
-    # Debug: Print raw output details
-    output_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    print(f"Raw output length: {len(outputs[0])} tokens")
-    print(f"Raw output text: {output_text}")
-    
-    # Extract answer, handling short outputs
-    answer = output_text[len(prompt):].strip() if len(output_text) > len(prompt) else output_text.strip()
-    # Debug: Print extracted answer
+def generate_answer(prompt, channel="cli", timings=None):
+    # Only the generated tokens are decoded (sliced by input token length)
+    answer = pipeline.generate(prompt, channel=channel, timings=timings)
     print(f"Extracted answer: {answer}")
     return answer
 
@@ -103,26 +45,37 @@ def qa_chatbot():
         if not query:
             print("Please enter a valid question.")
             continue
-        
+
         # Retrieve relevant documents
-        retrieved_docs = retrieve_documents(query)
+        timings = {}
+        retrieved_docs = retrieve_documents(query, timings=timings)
         # Debug: Print retrieved documents
         print("Retrieved documents:")
         for doc in retrieved_docs:
             print(f"Metadata: {doc.metadata}, Content: {doc.page_content}")
-        
+
         # Generate QA prompt
-        prompt = generate_qa_prompt(query, retrieved_docs)
+        prompt = generate_qa_prompt(query, retrieved_docs, timings=timings)
         # Debug: Print prompt details
-        prompt_tokens = len(tokenizer.encode(prompt))
+        prompt_tokens = len(tokenizer.encode(PROMPT_PREFIX + prompt))
         print(f"Prompt length: {prompt_tokens} tokens")
         print(f"Prompt text: {prompt}")
-        
-        # Generate answer
-        answer = generate_answer(prompt)
+
+        # Stream the answer as it is generated; the generation policy's token budget, sentence
+        # limit and deadline for the cli channel stop it, as they do for generate_answer
         print(f"Query: {query}")
-        print(f"Answer: {answer}\n")
+        print("Answer: ", end="", flush=True)
+        parts = []
+        with pipeline.timer.stage("generate", timings):
+            for text in pipeline.llm.stream(prompt, channel="cli"):
+                parts.append(text)
+                print(text, end="", flush=True)
+        print("\n")
+        print(f"Stage timings (ms): {timings}\n")
+
+        # Save to chat history
+        chat_history.add_turn(query, "".join(parts).strip())
 
 # Run the chatbot
 if __name__ == "__main__":
-    qa_chatbot()
\ No newline at end of file
+    qa_chatbot()
@@ -0,0 +1,187 @@
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+from flask import Flask, abort, jsonify, request
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import (
+    ApiClient,
+    Configuration,
+    MessagingApi,
+    PushMessageRequest,
+    ReplyMessageRequest,
+    TextMessage,
+)
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+import qa_chatbot
+from bty_chtbt.admission import Overloaded, admission_from_env
+from bty_chtbt.line_queue import (
+    EventDeduplicator,
+    InMemoryJobQueue,
+    QueueFull,
+    SQLiteJobQueue,
+    WorkerPool,
+)
+from bty_chtbt.profiling import apply_admin_settings, get_profiler
+from qa_chatbot import initialize_components, memory_governor, qa_line_chatbot
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Line channel credentials
+LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+if not LINE_CHANNEL_SECRET or not LINE_CHANNEL_ACCESS_TOKEN:
+    raise ValueError("LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN must be set in environment variables.")
+
+# Queue configuration: "memory" (default) or "sqlite" to survive restarts
+LINE_QUEUE_BACKEND = os.getenv("LINE_QUEUE_BACKEND", "memory")
+LINE_QUEUE_PATH = os.getenv("LINE_QUEUE_PATH", "/tmp/line_jobs.sqlite3")
+LINE_QUEUE_MAXSIZE = int(os.getenv("LINE_QUEUE_MAXSIZE", "100"))
+LINE_WORKERS = int(os.getenv("LINE_WORKERS", "2"))
+# Reply tokens expire about a minute after the event; after that fall back to the push API
+REPLY_TOKEN_TTL = float(os.getenv("LINE_REPLY_TOKEN_TTL", "50"))
+
+BUSY_MESSAGE = "目前詢問人數較多，請稍後再試。"
+
+# Admission control in front of retrieval + generation at the "line" priority: at most
+# ADMISSION_MAX_CONCURRENT workers answer at once (LINE_WORKERS may be higher), and a job
+# whose expected wait exceeds ADMISSION_TARGET_QUEUE_MS gets the busy message while its
+# reply token is still valid instead of a late answer
+admission, _, _ = admission_from_env()
+
+# Sampling profiler for the worker hot path: PROFILE_SAMPLE_RATE, toggled with SIGUSR2 or /api/admin/profiling
+profiler = get_profiler()
+profiler.install_signal_handler()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+app = Flask(__name__)
+
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+line_configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+deduplicator = EventDeduplicator(ttl=600)
+
+if LINE_QUEUE_BACKEND == "sqlite":
+    job_queue = SQLiteJobQueue(LINE_QUEUE_PATH, maxsize=LINE_QUEUE_MAXSIZE)
+else:
+    job_queue = InMemoryJobQueue(maxsize=LINE_QUEUE_MAXSIZE)
+
+def send_text(job, text):
+    """Reply with the event's reply token while it is still valid, otherwise push to the user."""
+    with ApiClient(line_configuration) as api_client:
+        messaging_api = MessagingApi(api_client)
+        if job.get("reply_token") and time.time() - job["received_at"] < REPLY_TOKEN_TTL:
+            try:
+                messaging_api.reply_message(ReplyMessageRequest(
+                    reply_token=job["reply_token"],
+                    messages=[TextMessage(text=text)]
+                ))
+                return
+            except Exception as e:
+                logger.warning(f"Reply failed for event {job['event_id']}, falling back to push: {e}")
+        messaging_api.push_message(PushMessageRequest(
+            to=job["to"],
+            messages=[TextMessage(text=text)]
+        ))
+
+def handle_job(job):
+    """Worker: answer the question and send the result back to the user."""
+    started = time.time()
+    try:
+        with admission.admit("line"), profiler.request("line"):
+            answer = qa_line_chatbot(job["text"], session=job["to"])
+    except Overloaded as e:
+        logger.warning(f"{e}; shedding event {job['event_id']}")
+        answer = BUSY_MESSAGE
+    send_text(job, answer)
+    logger.info(f"Answered event {job['event_id']} in {time.time() - started:.2f}s "
+                f"(queued {started - job['received_at']:.2f}s)")
+
+worker_pool = WorkerPool(job_queue, handle_job, workers=LINE_WORKERS)
+
+def event_target(event):
+    """User, group or room id to push the answer to."""
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or source.user_id
+
+@app.route("/callback", methods=["POST"])
+def callback():
+    """Line webhook: validate, enqueue and acknowledge immediately."""
+    signature = request.headers.get("X-Line-Signature", "")
+    body = request.get_data(as_text=True)
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        abort(400)
+
+    for event in events:
+        if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessageContent):
+            continue
+        event_id = event.webhook_event_id
+        # Redelivered events carry the same webhook event id; do not answer twice
+        if deduplicator.seen(event_id):
+            logger.info(f"Dropping duplicate Line event {event_id}")
+            continue
+        job = {
+            "event_id": event_id,
+            "to": event_target(event),
+            "text": event.message.text.strip(),
+            "reply_token": event.reply_token,
+            "received_at": time.time(),
+        }
+        try:
+            job_queue.put(job)
+        except QueueFull as e:
+            logger.warning(f"{e}; shedding event {event_id}")
+            send_text(job, BUSY_MESSAGE)
+
+    return "OK"
+
+@app.route("/api/health", methods=["GET"])
+def health_check():
+    """Health check endpoint with queue statistics."""
+    return jsonify({
+        "status": "OK",
+        "queue_backend": LINE_QUEUE_BACKEND,
+        "queue_depth": job_queue.depth(),
+        "workers": LINE_WORKERS,
+        "processed": worker_pool.processed,
+        "failed": worker_pool.failed,
+        "admission": admission.stats(),
+        "warmup": qa_chatbot.warmup_report,
+        "pipeline": qa_chatbot.pipeline.stats(),
+        "traffic_recording": qa_chatbot.traffic_recorder.stats() if qa_chatbot.traffic_recorder is not None else None,
+        "memory": memory_governor.stats()
+    })
+
+@app.route("/api/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    """Inspect or change profiling at runtime. Disabled unless ADMIN_TOKEN is set."""
+    if not ADMIN_TOKEN:
+        abort(404)
+    if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        abort(403)
+    if request.method == "GET":
+        return jsonify(profiler.status())
+    try:
+        return jsonify(apply_admin_settings(profiler, request.get_json() or {}))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+# Load the vector store and client before accepting traffic, then start the workers.
+# On Cloud Run, enable "CPU always allocated" so workers keep running after the 200 is sent.
+initialize_components()
+worker_pool.start()
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8080))
+    host = os.environ.get("HOST", "0.0.0.0")
+    logger.info(f"Starting Line webhook server on {host}:{port}")
+    app.run(host=host, port=port, debug=False)
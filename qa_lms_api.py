@@ -1,18 +1,32 @@
+import logging
 import os
-from flask import Flask, request, jsonify, session
-from flask_cors import CORS
+
 from dotenv import load_dotenv
-import logging
+from flask import Flask, jsonify, request, session
+from flask_cors import CORS
 
-# Import functions from qa_lms_chatbot.py
+from bty_chtbt.admission import Overloaded, RecentAnswers, admission_from_env
+from bty_chtbt.coalesce import SingleFlight, coalesce_key
+from bty_chtbt.filters import infer_filter
+from bty_chtbt.model_bundle import get_bundle
+from bty_chtbt.pipeline import EMPTY_ANSWER, ERROR_ANSWER, SLOW_ANSWER
+from bty_chtbt.profiling import apply_admin_settings, get_profiler
+from bty_chtbt.query_rewrite import QueryRewriter, llm_rewriter
+from bty_chtbt.traffic import get_recorder
+
+# Import the pipeline stages from qa_lms_chatbot.py
 from qa_lms_chatbot import (
-    vector_store,
-    count_tokens,
-    truncate_content,
-    retrieve_documents,
+    HISTORY_TOKEN_BUDGET,
     generate_answer,
+    generation_policy,
+    memory_governor,
+    model_name,
     openai_client,
-    model_name
+    pipeline,
+    prompt_cache_stats,
+    reranker,
+    retrieve_documents,
+    vector_store,
 )
 
 # Set up logging
@@ -35,9 +49,68 @@ CORS(app, resources={
     }
 })
 
-# Initialize chat history storage (in-memory, per session)
-# In production, consider using Redis or database for persistence
-chat_histories = {}
+# Sampling profiler for the chat path: PROFILE_SAMPLE_RATE, toggled with SIGUSR2 or /api/admin/profiling
+profiler = get_profiler()
+profiler.install_signal_handler()
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+@app.before_request
+def start_profiling():
+    if request.endpoint == 'chat' and request.method == 'POST':
+        profiler.begin('chat')
+
+@app.teardown_request
+def stop_profiling(_exc):
+    profiler.end()
+
+# Per-session chat histories (in-memory; the pipeline's history store drops the least
+# recently used sessions under memory pressure). In production, consider Redis or a database.
+chat_histories = pipeline.history
+
+# Follow-ups ("那價格呢？") are condensed into standalone queries before retrieval.
+# Optional: QUERY_REWRITE=off (default) | rules | llm; the llm mode uses QUERY_REWRITE_MODEL.
+query_rewriter = QueryRewriter(
+    rewrite_fn=llm_rewriter(openai_client, os.getenv('QUERY_REWRITE_MODEL', model_name))
+)
+# Identical questions arriving together (campaign spikes) share one upstream generation
+single_flight = SingleFlight()
+# Fallback messages are shown to the user but never cached or added to the history
+FALLBACK_ANSWERS = {SLOW_ANSWER, ERROR_ANSWER, EMPTY_ANSWER}
+
+# Admission control: per-session and per-IP token buckets, a bounded priority queue in front
+# of retrieval + generation, and load shedding once the queue wait would exceed its target
+admission, session_limiter, ip_limiter = admission_from_env()
+# Answers served instead of a 503 when a request is shed
+recent_answers = RecentAnswers()
+memory_governor.register_shrinker('recent_answers', recent_answers.clear)
+BUSY_MESSAGE = '目前詢問人數較多，請稍後再試。'
+# Behind ngrok or the NAS reverse proxy every request comes from the proxy's address
+TRUST_FORWARDED_FOR = os.getenv('TRUST_FORWARDED_FOR', '0') == '1'
+
+# Opt-in recording of anonymized requests for replay (TRAFFIC_RECORD_DIR, see bty_chtbt/traffic.py)
+traffic_recorder = get_recorder()
+
+# Documents per answer; set RETRIEVAL_K=2 to trade recall for a shorter prompt
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', '3'))
+
+def client_ip():
+    if TRUST_FORWARDED_FOR and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr
+
+def rate_limited():
+    """Retry-After seconds if this session or client IP is over its rate, else 0."""
+    retry_after = 0.0
+    if session_limiter is not None and session.get('session_id'):
+        retry_after = session_limiter.check(session['session_id'])
+    if not retry_after and ip_limiter is not None:
+        retry_after = ip_limiter.check(client_ip())
+    return retry_after
+
+def busy_response(error, retry_after):
+    response = jsonify({'error': error})
+    response.headers['Retry-After'] = str(max(1, int(round(retry_after))))
+    return response
 
 def get_chat_history():
     """Get or create chat history for current session."""
@@ -47,61 +120,10 @@ def get_chat_history():
         session_id = str(uuid.uuid4())
         session['session_id'] = session_id
     
-    if session_id not in chat_histories:
-        chat_histories[session_id] = []
-    
-    return chat_histories[session_id]
-
-def generate_qa_prompt_with_history(query, retrieved_docs, chat_history):
-    """Generate QA prompt with provided chat history (modified from qa_lms_chatbot.py)."""
-    # Base prompt template without content
-    base_prompt = f"""你是一個繁體中文問答聊天機器人。請根據以下上下文、對話歷史或你的知識回答使用者的問題。如果上下文和歷史無相關資訊，根據你的知識提供答案；若仍不知道，說不知道。
-
-Context:
-{{context}}
-
-Chat History:
-{{history_context}}
+    return chat_histories.get(session_id)
 
-User Question: {query}
-
-Answer: """
-    
-    # Format retrieved documents
-    context = "\n".join([f"Q: {doc.metadata['question']}\nA: {doc.page_content}" for doc in retrieved_docs])
-    
-    # Format recent chat history (limit to last 3 interactions)
-    history_context = ""
-    for past_query, past_answer in chat_history[-3:]:
-        history_context += f"Previous Q: {past_query}\nPrevious A: {past_answer}\n"
-    
-    # Calculate token counts
-    base_tokens = count_tokens(base_prompt.format(context="", history_context=""))
-    query_tokens = count_tokens(query)
-    context_tokens = count_tokens(context)
-    history_tokens = count_tokens(history_context)
-    
-    # Target max tokens for content (leaving buffer for base prompt and query)
-    max_content_tokens = 900 - base_tokens - query_tokens
-    
-    # Truncate if necessary
-    if context_tokens + history_tokens > max_content_tokens:
-        # Allocate half to context, half to history
-        target_context_tokens = max_content_tokens // 2
-        target_history_tokens = max_content_tokens - target_context_tokens
-        
-        context = truncate_content(context, target_context_tokens, keep_start=True)
-        history_context = truncate_content(history_context, target_history_tokens, keep_start=False)
-    
-    # Generate final prompt
-    prompt = base_prompt.format(context=context, history_context=history_context)
-    
-    prompt_tokens = count_tokens(prompt)
-    logger.info(f"QA Prompt token count: {prompt_tokens}")
-    if prompt_tokens > 1000:
-        logger.warning("Prompt still exceeds 1000 tokens after truncation.")
-    
-    return prompt
+# Warm up embedding, search, tokenizer and prompt building before gunicorn starts serving
+warmup_report = pipeline.warm_up()
 
 @app.route('/api/chat', methods=['POST', 'OPTIONS'])
 def chat():
@@ -116,6 +138,8 @@ def chat():
             return jsonify({'error': 'Invalid JSON data'}), 400
         
         query = data.get('message', '').strip()
+        # Retrieval and generation share one request deadline
+        deadline = generation_policy.deadline('web')
         
         if not query:
             return jsonify({'error': 'Message cannot be empty'}), 400
@@ -123,20 +147,74 @@ def chat():
         # Get chat history for this session
         chat_history = get_chat_history()
         
-        # Retrieve relevant documents
-        retrieved_docs = retrieve_documents(query, k=3)
-        logger.info(f"Retrieved {len(retrieved_docs)} documents for query: {query}")
+        retry_after = rate_limited()
+        if retry_after:
+            return busy_response('請求過於頻繁，請稍後再試。', retry_after), 429
         
-        # Generate QA prompt with chat history
-        prompt = generate_qa_prompt_with_history(query, retrieved_docs, chat_history)
+        # Batch clients (replays, evaluations) can ask to be served after interactive traffic
+        priority = 'batch' if request.headers.get('X-Priority') == 'batch' else 'web'
         
-        # Generate answer
-        answer = generate_answer(prompt)
+        # Retrieval filter: configured web/page rules, overridden by an explicit filter or category
+        try:
+            search_filter = infer_filter(
+                channel='web',
+                page=data.get('page'),
+                explicit=data.get('filter') or ({'category': data['category']} if data.get('category') else None)
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Save to chat history (limit to last 10 conversations)
-        chat_history.append((query, answer))
-        if len(chat_history) > 10:
-            chat_history.pop(0)
+        try:
+            with admission.admit(priority) as queued:
+                timings = {'queue': round(queued * 1000, 1)}
+                # Retrieve on the standalone form of the question
+                search_query = query_rewriter.rewrite(query, chat_history)
+                if search_query != query:
+                    logger.info(f"Rewrote follow-up '{query}' as '{search_query}'")
+                retrieved_docs = retrieve_documents(search_query, k=RETRIEVAL_K, filter=search_filter,
+                                                    deadline=deadline, timings=timings)
+                logger.info(f"Retrieved {len(retrieved_docs)} documents for query: {search_query} (filter: {search_filter})")
+        
+                # Generate QA prompt with chat history
+                prompt = pipeline.build_prompt(query, retrieved_docs, chat_history, timings=timings)
+        
+                # Generate answer; concurrent requests with the same question, documents and history
+                # wait for the first one's generation instead of calling the model again
+                key = coalesce_key(query, retrieved_docs, chat_history.render(HISTORY_TOKEN_BUDGET))
+                try:
+                    answer = single_flight.do(
+                        key,
+                        lambda: generate_answer(prompt, channel='web', deadline=deadline, timings=timings),
+                        timeout=deadline.remaining()
+                    )
+                except TimeoutError as e:
+                    logger.warning(f"{e}: {query}")
+                    answer = SLOW_ANSWER
+        
+                # Save real answers to chat history; older turns are summarized in the background
+                if answer not in FALLBACK_ANSWERS:
+                    chat_history.add_turn(query, answer)
+                logger.info(f"Stage timings (ms): {timings}")
+                if traffic_recorder is not None:
+                    traffic_recorder.record(
+                        'web', query, retrieved_docs, timings,
+                        prompt_tokens=pipeline.prompt.prefix_tokens + pipeline.tokens.count(prompt),
+                        answer_tokens=pipeline.tokens.count(answer),
+                        session=session.get('session_id'),
+                        search_query=search_query,
+                        filter=search_filter,
+                        k=RETRIEVAL_K,
+                        profile=pipeline.name
+                    )
+        except Overloaded as e:
+            # Shed: answer from recent answers when possible, otherwise a fast 503
+            logger.warning(f"{e} (priority {priority}): {query}")
+            cached = recent_answers.get(query)
+            if cached is None:
+                return busy_response(BUSY_MESSAGE, e.retry_after), 503
+            return jsonify({'response': cached, 'query': query, 'cached': True})
+        if answer not in FALLBACK_ANSWERS:
+            recent_answers.put(query, answer)
         
         return jsonify({
             'response': answer,
@@ -148,6 +226,10 @@ def chat():
         import traceback
         traceback.print_exc()
         return jsonify({'error': '抱歉，無法處理您的請求，請稍後再試。'}), 500
+    finally:
+        # Collect or shrink caches only when RSS crosses the configured watermarks,
+        # on the shed and error paths too
+        memory_governor.check()
 
 @app.route('/api/clear', methods=['POST', 'OPTIONS'])
 def clear_history():
@@ -158,8 +240,8 @@ def clear_history():
     
     try:
         session_id = session.get('session_id')
-        if session_id and session_id in chat_histories:
-            chat_histories[session_id] = []
+        if session_id:
+            chat_histories.clear(session_id)
         return jsonify({'status': 'success'})
     except Exception as e:
         logger.error(f"Error clearing history: {e}")
@@ -173,12 +255,41 @@ def health_check():
         return jsonify({
             'status': 'OK',
             'model': model_name,
-            'vector_store_loaded': vector_store is not None
+            'vector_store_loaded': vector_store is not None,
+            'query_rewrite': query_rewriter.stats(),
+            'coalescing': single_flight.stats(),
+            'admission': admission.stats(),
+            'rate_limits': {
+                'session': session_limiter.stats() if session_limiter is not None else None,
+                'ip': ip_limiter.stats() if ip_limiter is not None else None
+            },
+            'recent_answers': recent_answers.stats(),
+            'reranker': reranker.stats() if reranker is not None else None,
+            'prompt_cache': prompt_cache_stats.stats(),
+            'pipeline': pipeline.stats(),
+            'traffic_recording': traffic_recorder.stats() if traffic_recorder is not None else None,
+            'warmup': warmup_report,
+            'model_bundle': get_bundle().stats() if get_bundle() is not None else None,
+            'memory': memory_governor.stats()
         })
     except Exception as e:
         logger.error(f"Health check failed: {e}")
         return jsonify({'status': 'ERROR', 'error': str(e)}), 500
 
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+def admin_profiling():
+    """Inspect or change profiling at runtime. Disabled unless ADMIN_TOKEN is set."""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'GET':
+        return jsonify(profiler.status())
+    try:
+        return jsonify(apply_admin_settings(profiler, request.get_json() or {}))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/', methods=['GET'])
 def root():
     """Root endpoint - API info."""
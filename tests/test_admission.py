@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+
+from bty_chtbt.admission import (
+    AdmissionController,
+    Overloaded,
+    RateLimiter,
+    RecentAnswers,
+    TokenBucket,
+)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.001)
+
+
+class Waiter(threading.Thread):
+    """Runs controller.acquire(priority) in the background and records the outcome."""
+
+    def __init__(self, controller, priority):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.priority = priority
+        self.outcome = None
+
+    def run(self):
+        try:
+            self.controller.acquire(self.priority)
+            self.outcome = "admitted"
+        except Overloaded as e:
+            self.outcome = e.reason
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+        self.assertEqual([bucket.take(now) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.take(now), 0.5)
+        self.assertEqual(bucket.take(now + 0.5), 0.0)
+        self.assertGreater(bucket.take(now + 0.5), 0.0)
+
+    def test_rate_limiter_keys_are_independent_and_bounded(self):
+        limiter = RateLimiter(rate=0.001, burst=1, max_keys=2)
+        self.assertEqual(limiter.check("a"), 0.0)
+        self.assertGreater(limiter.check("a"), 0.0)
+        self.assertEqual(limiter.check("b"), 0.0)
+        self.assertEqual(limiter.check("c"), 0.0)
+        self.assertEqual(limiter.stats()["keys"], 2)
+        self.assertEqual(limiter.limited, 1)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_admits_up_to_max_concurrent_without_waiting(self):
+        controller = AdmissionController(max_concurrent=2, max_queue=4, target_queue_seconds=1)
+        self.assertEqual(controller.acquire("web"), 0.0)
+        self.assertEqual(controller.acquire("line"), 0.0)
+        self.assertEqual(controller.stats()["running"], 2)
+
+    def test_released_slot_goes_to_the_highest_priority_waiter(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=4, target_queue_seconds=5)
+        controller.acquire("web")
+        batch, line = Waiter(controller, "batch"), Waiter(controller, "line")
+        batch.start()
+        wait_for(lambda: controller.stats()["queue_depth"] == 1)
+        line.start()
+        wait_for(lambda: controller.stats()["queue_depth"] == 2)
+        controller._release(0.01)
+        line.join(5)
+        self.assertEqual(line.outcome, "admitted")
+        self.assertIsNone(batch.outcome)
+        controller._release(0.01)
+        batch.join(5)
+        self.assertEqual(batch.outcome, "admitted")
+
+    def test_full_queue_evicts_lower_priority_or_sheds(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=1, target_queue_seconds=5)
+        controller.acquire("web")
+        batch = Waiter(controller, "batch")
+        batch.start()
+        wait_for(lambda: controller.stats()["queue_depth"] == 1)
+        line = Waiter(controller, "line")
+        line.start()
+        batch.join(5)
+        self.assertEqual(batch.outcome, "evicted")
+        wait_for(lambda: controller.stats()["queue_depth_by_priority"]["line"] == 1)
+        # Nothing of lower priority than "web" is queued any more
+        with self.assertRaises(Overloaded) as shed:
+            controller.acquire("web")
+        self.assertEqual(shed.exception.reason, "queue_full")
+        controller._release(0.01)
+        line.join(5)
+        self.assertEqual(line.outcome, "admitted")
+        self.assertEqual(controller.stats()["shed"]["evicted"], 1)
+
+    def test_expected_wait_over_target_is_shed_immediately(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, target_queue_seconds=0.5)
+        with controller.admit("web"):
+            time.sleep(0.01)
+        controller._service_seconds = 1.0  # recent requests took a second each
+        controller.acquire("web")
+        with self.assertRaises(Overloaded) as shed:
+            controller.acquire("web")
+        self.assertEqual(shed.exception.reason, "expected_wait")
+        self.assertGreaterEqual(shed.exception.retry_after, 1.0)
+
+    def test_queue_timeout(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=8, target_queue_seconds=0.05)
+        controller.acquire("web")
+        with self.assertRaises(Overloaded) as shed:
+            controller.acquire("web")
+        self.assertEqual(shed.exception.reason, "queue_timeout")
+        self.assertEqual(controller.stats()["queue_depth"], 0)
+
+    def test_admit_releases_the_slot_on_error(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=1, target_queue_seconds=1)
+        with self.assertRaises(RuntimeError), controller.admit("line"):
+            raise RuntimeError("generation failed")
+        stats = controller.stats()
+        self.assertEqual((stats["running"], stats["admitted"], stats["completed"]), (0, 1, 1))
+
+
+class RecentAnswersTest(unittest.TestCase):
+    def test_normalized_lookup_and_ttl(self):
+        answers = RecentAnswers(max_entries=2, ttl=60)
+        answers.put("皮秒 多少錢？", "約一萬元。")
+        self.assertEqual(answers.get(" 皮秒  多少錢？"), "約一萬元。")
+        answers.put("b", "2")
+        answers.put("c", "3")
+        self.assertIsNone(answers.get("皮秒 多少錢？"))
+        answers.ttl = 0
+        self.assertIsNone(answers.get("c"))
+
+
+if __name__ == "__main__":
+    unittest.main()
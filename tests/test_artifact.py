@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from bty_chtbt.artifact import VectorArtifact, write_artifact
+from bty_chtbt.filters import build_inverted_index
+from bty_chtbt.numpy_index import NumpyIndex
+from bty_chtbt.vector_backend import export_artifact, get_backend, load_backend
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic pseudo-embeddings: identical text gives identical vectors."""
+
+    model_name = "test/hash-embeddings"
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int.from_bytes(text.encode("utf-8")[:8].ljust(8, b"\0"), "little") + len(text)
+        return np.random.default_rng(seed).normal(size=16).tolist()
+
+
+DOCUMENTS = [
+    Document(page_content=f"Question: q{i}\nAnswer: answer {i}",
+             metadata={"source_file": "a.csv" if i % 2 else "b.csv", "index": i, "category": f"c{i % 3}"})
+    for i in range(12)
+]
+
+
+class ArtifactFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "store.artifact")
+        self.vectors = np.random.default_rng(0).normal(size=(12, 16)).astype(np.float32)
+        self.ids = [f"id{i}" for i in range(12)]
+
+    def write(self, dtype, **options):
+        index = NumpyIndex.from_vectors(self.vectors, dtype=dtype)
+        inverted_index = build_inverted_index((doc_id, doc.metadata) for doc_id, doc in zip(self.ids, DOCUMENTS, strict=True))
+        write_artifact(self.path, index, self.ids, DOCUMENTS, "model-a", inverted_index, **options)
+        return index, inverted_index
+
+    def test_round_trip(self):
+        for dtype, options in (("float16", {}), ("int8", {"codec": "zlib", "compress_vectors": True})):
+            index, inverted_index = self.write(dtype, **options)
+            artifact = VectorArtifact(self.path)
+            self.assertEqual(artifact.embedding_model, "model-a")
+            self.assertEqual(artifact.manifest["count"], 12)
+            np.testing.assert_array_equal(artifact.vectors(), index.vectors)
+            if dtype == "int8":
+                np.testing.assert_allclose(artifact.scales(), index.scales)
+            else:
+                self.assertIsNone(artifact.scales())
+            self.assertEqual(artifact.ids(), self.ids)
+            self.assertEqual([entry["page_content"] for entry in artifact.docstore()],
+                             [doc.page_content for doc in DOCUMENTS])
+            self.assertEqual(artifact.inverted_index(), inverted_index)
+            self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+    def test_uncompressed_vectors_are_aligned_for_mmap(self):
+        self.write("float32")
+        artifact = VectorArtifact(self.path, verify=False)
+        self.assertIsInstance(artifact.vectors(), np.memmap)
+        self.assertEqual(artifact.data_start % 4096, 0)
+
+    def test_corruption_is_detected(self):
+        self.write("float16", codec="zlib")
+        artifact = VectorArtifact(self.path)
+        section = artifact.manifest["sections"]["ids"]
+        with open(self.path, "r+b") as f:
+            f.seek(artifact.data_start + section["offset"])
+            f.write(b"\xff")
+        with self.assertRaises(ValueError):
+            VectorArtifact(self.path).ids()
+
+    def test_not_an_artifact(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not an artifact")
+        with self.assertRaises(ValueError):
+            VectorArtifact(self.path)
+
+    def test_embedding_model_mismatch_is_rejected(self):
+        self.write("float16")
+        artifact = VectorArtifact(self.path)
+        artifact.check_embedding_model("model-a")
+        with self.assertRaises(ValueError):
+            artifact.check_embedding_model("model-b")
+
+
+class ArtifactBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.embeddings = HashEmbeddings()
+        self.source = get_backend("numpy", os.path.join(self.dir.name, "numpy_store"), self.embeddings)
+        self.source.build(DOCUMENTS)
+        self.path = export_artifact(self.source, os.path.join(self.dir.name, "store.artifact"))
+
+    def test_exported_artifact_searches_like_its_source(self):
+        backend = load_backend("artifact", self.path, self.embeddings)
+        self.assertEqual(backend.artifact.embedding_model, HashEmbeddings.model_name)
+        for query in ("q3", "answer 7"):
+            self.assertEqual([doc.page_content for doc in backend.search(query, k=3)],
+                             [doc.page_content for doc in self.source.search(query, k=3)])
+        filtered = backend.search("q1", k=12, filter={"source_file": "a.csv"})
+        self.assertTrue(filtered)
+        self.assertTrue(all(doc.metadata["source_file"] == "a.csv" for doc in filtered))
+
+    def test_load_with_another_embedding_model_fails(self):
+        with self.assertRaises(ValueError):
+            load_backend("artifact", self.path, self.embeddings, "sentence-transformers/another-model")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from bty_chtbt.chunking import (
+    CHUNK_SEPARATORS,
+    chunk_ids,
+    expand_to_parents,
+    merge_chunks,
+    split_long_answers,
+)
+from bty_chtbt.vector_backend import document_id
+
+ANSWER = "".join(f"第{i}句說明術後照護的注意事項。" for i in range(20))
+
+
+def chunk(start, content, **metadata):
+    return Document(page_content=content, metadata=dict(metadata, start_index=start))
+
+
+class FakeStore:
+    """Just the get(ids) lookup expand_to_parents needs."""
+
+    def __init__(self, documents):
+        self.by_id = {document_id(doc): doc for doc in documents}
+
+    def get(self, ids):
+        return [self.by_id[doc_id] for doc_id in ids if doc_id in self.by_id]
+
+
+class MergeChunksTest(unittest.TestCase):
+    def test_overlapping_chunks_rebuild_the_text(self):
+        chunks = [chunk(6, "ghijkl"), chunk(0, "abcdefgh"), chunk(10, "klmnop")]
+        self.assertEqual(merge_chunks(chunks), "abcdefghijklmnop")
+
+    def test_gaps_are_marked(self):
+        self.assertEqual(merge_chunks([chunk(0, "abc"), chunk(10, "klm")]), "abc…klm")
+
+    def test_contained_chunk_adds_nothing(self):
+        self.assertEqual(merge_chunks([chunk(0, "abcdef"), chunk(2, "cd")]), "abcdef")
+
+
+class SplitAndExpandTest(unittest.TestCase):
+    def setUp(self):
+        splitter = RecursiveCharacterTextSplitter(chunk_size=60, chunk_overlap=15, separators=CHUNK_SEPARATORS,
+                                                  keep_separator="end", add_start_index=True)
+        self.parent = Document(page_content=ANSWER, metadata={"source_file": "care.csv", "index": 7,
+                                                              "category": "術後"})
+        self.short = Document(page_content="短答案。", metadata={"source_file": "care.csv", "index": 8})
+        self.chunks = split_long_answers([self.parent, self.short], splitter)
+
+    def test_long_answers_are_split_and_short_ones_kept(self):
+        self.assertIs(self.chunks[-1], self.short)
+        pieces = self.chunks[:-1]
+        self.assertGreater(len(pieces), 1)
+        parent_id = document_id(self.parent)
+        self.assertEqual([document_id(doc) for doc in pieces], chunk_ids(parent_id, len(pieces)))
+        self.assertTrue(all(doc.metadata["category"] == "術後" for doc in pieces))
+
+    def test_chunks_merge_back_into_the_parent(self):
+        self.assertEqual(merge_chunks(self.chunks[:-1]), ANSWER)
+
+    def test_expand_to_parents_within_budget(self):
+        store = FakeStore(self.chunks)
+        matched = [self.chunks[2], self.short, self.chunks[0]]
+        results = expand_to_parents(matched, store, len, budget_tokens=10000)
+        self.assertEqual([doc.page_content for doc in results], [ANSWER, self.short.page_content])
+        self.assertNotIn("parent_id", results[0].metadata)
+        self.assertEqual(results[0].metadata["index"], 7)
+
+    def test_expand_to_parents_keeps_matched_chunks_over_budget(self):
+        store = FakeStore(self.chunks)
+        results = expand_to_parents([self.chunks[2], self.chunks[0]], store, len, budget_tokens=50)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].page_content, merge_chunks([self.chunks[0], self.chunks[2]]))
+        self.assertLess(len(results[0].page_content), len(ANSWER))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+
+from langchain_core.documents import Document
+
+from bty_chtbt.coalesce import SingleFlight, coalesce_key
+
+
+def run_concurrently(single_flight, key, fn, callers, timeout=5):
+    results = [None] * callers
+    errors = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = single_flight.do(key, fn, timeout=timeout)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_callers_share_one_call(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "answer"
+
+        threads, results, errors = run_concurrently(single_flight, "k", fn, 4)
+        # Wait until every follower has joined the in-flight call before letting it finish
+        while single_flight.shared < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["answer"] * 4)
+        self.assertEqual(errors, [None] * 4)
+        self.assertEqual(single_flight.stats(), {"in_flight": 0, "leaders": 1, "shared": 3})
+
+    def test_exception_is_shared_and_not_cached(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError("upstream down")
+
+        threads, _, errors = run_concurrently(single_flight, "k", fail, 2)
+        while single_flight.shared < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(error, ValueError) for error in errors))
+        self.assertEqual(single_flight.do("k", lambda: "recovered"), "recovered")
+
+    def test_follower_times_out_while_leader_continues(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        threads, results, _ = run_concurrently(single_flight, "k", lambda: release.wait(5) and "slow", 1)
+        while single_flight.in_flight() < 1:
+            time.sleep(0.001)
+        with self.assertRaises(TimeoutError):
+            single_flight.do("k", lambda: "unused", timeout=0.01)
+        release.set()
+        threads[0].join()
+        self.assertEqual(results, ["slow"])
+
+    def test_different_keys_run_independently(self):
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do("a", lambda: 1), 1)
+        self.assertEqual(single_flight.do("b", lambda: 2), 2)
+        self.assertEqual(single_flight.leaders, 2)
+
+
+class CoalesceKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.docs = [Document(page_content="a", metadata={"source_file": "x.csv", "index": 1}),
+                     Document(page_content="b", metadata={"source_file": "x.csv", "index": 2})]
+
+    def test_normalized_question_shares_a_key(self):
+        self.assertEqual(coalesce_key("皮秒 多少錢？", self.docs), coalesce_key(" 皮秒  多少錢？ ", self.docs))
+        self.assertEqual(coalesce_key("Pico price", self.docs), coalesce_key("pico PRICE", self.docs))
+
+    def test_documents_and_history_are_part_of_the_key(self):
+        key = coalesce_key("q", self.docs, "Q: a\nA: b")
+        self.assertNotEqual(key, coalesce_key("q", self.docs[::-1], "Q: a\nA: b"))
+        self.assertNotEqual(key, coalesce_key("q", self.docs, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
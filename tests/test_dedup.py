@@ -0,0 +1,128 @@
+import csv
+import os
+import tempfile
+import unittest
+
+from langchain_core.documents import Document
+
+from bty_chtbt.dedup import (
+    Deduplicator,
+    MinHasher,
+    NearDuplicateIndex,
+    collapse_duplicates,
+    shingles,
+)
+from bty_chtbt.pipeline.stages import Retriever
+from bty_chtbt.vector_backend import get_backend
+from tests.test_artifact import HashEmbeddings
+
+ANSWER = "皮秒雷射術後一週內請加強保濕與防曬，避免去角質產品，如有紅腫請回診。"
+
+
+def qa(index, question, answer=ANSWER, category="雷射", source_file="laser.csv"):
+    return Document(page_content=f"Question: {question}\nAnswer: {answer}",
+                    metadata={"index": index, "question": question, "category": category,
+                              "source_file": source_file})
+
+
+class MinHashTest(unittest.TestCase):
+    def test_shingles_ignore_punctuation_case_and_width(self):
+        self.assertEqual(shingles("皮秒 雷射？"), shingles("皮秒雷射"))
+        self.assertEqual(shingles("ＰＩＣＯ laser!"), shingles("picolaser"))
+        self.assertEqual(shingles("a"), {"a"})
+        self.assertEqual(shingles("？"), set())
+
+    def test_signature_estimates_jaccard_similarity(self):
+        hasher = MinHasher(num_perm=256)
+        first, second = shingles("abcdefghijklmnopqrst"), shingles("abcdefghijklmnopqxyz")
+        jaccard = len(first & second) / len(first | second)
+        estimate = (hasher.signature(first) == hasher.signature(second)).mean()
+        self.assertAlmostEqual(estimate, jaccard, delta=0.1)
+        self.assertEqual((hasher.signature(first) == hasher.signature(set(first))).mean(), 1.0)
+
+    def test_index_keeps_the_first_copy(self):
+        index = NearDuplicateIndex(threshold=0.7)
+        self.assertIsNone(index.add("a", f"皮秒雷射術後多久可以化妝？\n{ANSWER}"))
+        self.assertEqual(index.add("b", f"皮秒雷射術後多久可以化妝？\n{ANSWER}")[0], "a")
+        kept, similarity = index.add("c", f"皮秒雷射術後多久可以化妝呢\n{ANSWER}")
+        self.assertEqual(kept, "a")
+        self.assertGreaterEqual(similarity, 0.7)
+        self.assertIsNone(index.add("d", "玻尿酸注射可以維持多久？效果約六到十二個月。"))
+
+    def test_bands_must_divide_permutations(self):
+        with self.assertRaises(ValueError):
+            NearDuplicateIndex(num_perm=64, bands=10)
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.documents = [
+            qa(1, "皮秒雷射術後多久可以化妝？"),
+            qa(2, "皮秒雷射術後多久可以化妝呢"),  # same scope: merged in merge mode
+            qa(3, "皮秒雷射術後多久可以化妝？", category="皮秒"),  # other category: always kept
+            qa(4, "玻尿酸注射可以維持多久？", answer="約六到十二個月。", category="玻尿酸"),
+        ]
+
+    def test_flag_mode_keeps_everything(self):
+        deduplicator = Deduplicator()
+        kept = list(deduplicator.filter(self.documents))
+        self.assertEqual(len(kept), 4)
+        self.assertEqual([doc.metadata.get("duplicate_of") for doc in kept],
+                         [None, "laser.csv:1", "laser.csv:1", None])
+        self.assertEqual({match["action"] for match in deduplicator.matches}, {"flagged"})
+
+    def test_merge_mode_drops_only_within_category_and_source_file(self):
+        deduplicator = Deduplicator(mode="merge")
+        kept = list(deduplicator.filter(self.documents))
+        self.assertEqual([doc.metadata["index"] for doc in kept], [1, 3, 4])
+        self.assertEqual(kept[1].metadata["duplicate_of"], "laser.csv:1")
+        self.assertEqual([match["action"] for match in deduplicator.matches], ["dropped", "flagged"])
+        self.assertIn("1 dropped, 1 flagged", str(deduplicator))
+
+    def test_report(self):
+        deduplicator = Deduplicator(mode="merge")
+        list(deduplicator.filter(self.documents))
+        with tempfile.TemporaryDirectory() as path:
+            report_path = deduplicator.write_report(os.path.join(path, "report.csv"))
+            with open(report_path, encoding="utf-8") as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["kept_question"], "皮秒雷射術後多久可以化妝？")
+        self.assertGreaterEqual(float(rows[0]["similarity"]), float(rows[1]["similarity"]))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Deduplicator(mode="drop")
+
+
+class CollapseDuplicatesTest(unittest.TestCase):
+    def test_cross_file_near_duplicates_are_one_retrieval_result(self):
+        documents = list(Deduplicator().filter([
+            qa(1, "皮秒雷射術後多久可以化妝？"),
+            qa(7, "皮秒雷射術後多久可以化妝呢", category="皮秒", source_file="faq.csv"),
+            qa(2, "玻尿酸注射可以維持多久？", answer="約六到十二個月。", category="玻尿酸"),
+        ]))
+        self.assertEqual(documents[1].metadata["duplicate_of"], "laser.csv:1")
+        with tempfile.TemporaryDirectory() as directory:
+            store = get_backend("numpy", os.path.join(directory, "store"), HashEmbeddings())
+            store.build(documents)
+            query = documents[1].page_content
+            self.assertEqual(len(store.search(query, k=3)), 3)
+            results = Retriever(store, len, k=2).search(query, 2)
+            self.assertEqual(len(results), 2)
+            self.assertEqual(sum("皮秒" in doc.metadata["question"] for doc in results), 1)
+            self.assertIn("玻尿酸注射可以維持多久？", [doc.metadata["question"] for doc in results])
+            self.assertEqual(len(Retriever(store, len, k=2, collapse_duplicates=False).search(query, 2)), 2)
+
+    def test_chunks_of_one_answer_are_kept(self):
+        chunks = [Document(page_content=f"part {i}", metadata={"source_file": "a.csv", "index": 1, "parent_id": "a.csv:1",
+                                                                "chunk_index": i, "chunk_count": 2})
+                  for i in range(2)]
+        duplicate = qa(2, "q", source_file="b.csv")
+        duplicate.metadata["duplicate_of"] = "a.csv:1"
+        self.assertEqual(collapse_duplicates([chunks[0], duplicate, chunks[1]]), chunks)
+        self.assertEqual(collapse_duplicates([duplicate, chunks[0]], k=1), [duplicate])
+
+
+if __name__ == "__main__":
+    unittest.main()
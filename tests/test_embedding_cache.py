@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from bty_chtbt.embedding_cache import CachedEmbeddings, EmbeddingCache, cache_key
+
+MODEL = "test/model"
+
+
+def keys(*texts):
+    return [cache_key(MODEL, text) for text in texts]
+
+
+def vectors(*values):
+    return np.array([[value] * 4 for value in values], dtype=np.float32)
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text))] * 4 for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def make_cache(self, capacity=3):
+        cache = EmbeddingCache(self.dir.name, MODEL, capacity=capacity, dtype="float32", flush_interval=0)
+        self.addCleanup(cache.flush)
+        return cache
+
+    def test_hit_and_miss(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.get_many(keys("a")), [None])
+        cache.put_many(keys("a", "b"), vectors(1, 2))
+        a, missing, b = cache.get_many(keys("a", "c", "b"))
+        np.testing.assert_array_equal(a, vectors(1)[0])
+        np.testing.assert_array_equal(b, vectors(2)[0])
+        self.assertIsNone(missing)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self.make_cache(capacity=3)
+        cache.put_many(keys("a", "b", "c"), vectors(1, 2, 3))
+        cache.get_many(keys("a"))
+        cache.put_many(keys("d"), vectors(4))
+        self.assertEqual([vector is not None for vector in cache.get_many(keys("a", "b", "c", "d"))],
+                         [True, False, True, True])
+        self.assertEqual(len(cache), 3)
+
+    def test_slot_reused_by_another_worker_is_a_miss(self):
+        first, second = self.make_cache(capacity=2), self.make_cache(capacity=2)
+        first.put_many(keys("a", "b"), vectors(1, 2))
+        # The second worker has not seen the first one's index and holds no entries, so it
+        # takes slots round-robin and overwrites "a"
+        second.put_many(keys("c"), vectors(3))
+        a, b = first.get_many(keys("a", "b"))
+        self.assertIsNone(a)
+        np.testing.assert_array_equal(b, vectors(2)[0])
+        self.assertEqual(first.collisions, 1)
+        np.testing.assert_array_equal(second.get_many(keys("c"))[0], vectors(3)[0])
+
+    def test_index_survives_a_restart(self):
+        cache = self.make_cache()
+        cache.put_many(keys("a", "b"), vectors(1, 2))
+        cache.flush()
+        self.assertTrue(os.path.exists(cache.index_path))
+        reopened = self.make_cache()
+        self.assertEqual(len(reopened), 2)
+        np.testing.assert_array_equal(reopened.get_many(keys("b"))[0], vectors(2)[0])
+
+    def test_shrink_keeps_the_most_recent_entries(self):
+        cache = self.make_cache(capacity=4)
+        cache.put_many(keys("a", "b", "c", "d"), vectors(1, 2, 3, 4))
+        cache.get_many(keys("a"))
+        self.assertEqual(cache.shrink(keep=0.5), 2)
+        self.assertEqual([vector is not None for vector in cache.get_many(keys("a", "b", "c", "d"))],
+                         [True, False, False, True])
+        self.assertEqual(cache.stats()["shrinks"], 1)
+        # The freed slots are reused before any remaining entry is evicted
+        cache.put_many(keys("e", "f"), vectors(5, 6))
+        self.assertTrue(all(vector is not None for vector in cache.get_many(keys("a", "d", "e", "f"))))
+
+
+class CachedEmbeddingsTest(unittest.TestCase):
+    def test_only_unseen_text_is_embedded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            model = CountingEmbeddings()
+            embeddings = CachedEmbeddings(model, MODEL, directory, capacity=8, dtype="float32")
+            embeddings.cache.flush_interval = 0
+            self.assertEqual(embeddings.embed_documents(["ab", "abc", "ab"]), [[2.0] * 4, [3.0] * 4, [2.0] * 4])
+            self.assertEqual(embeddings.embed_documents(["abc", " ab "]), [[3.0] * 4, [2.0] * 4])
+            embeddings.embed_query("ab")
+            self.assertEqual(model.calls, [["ab", "abc"], ["ab"]])
+            embeddings.cache.flush()
+
+
+if __name__ == "__main__":
+    unittest.main()
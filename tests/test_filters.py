@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bty_chtbt import filters
+from bty_chtbt.filters import (
+    build_inverted_index,
+    load_inverted_index,
+    matches,
+    normalize_filter,
+    parse_filter,
+    save_inverted_index,
+    select_ids,
+)
+
+DOCS = [
+    ("a", {"category": "雷射", "source_file": "laser.csv"}),
+    ("b", {"category": "雷射", "source_file": "pico.csv"}),
+    ("c", {"category": "玻尿酸", "source_file": "filler.csv"}),
+    ("d", {"category": "皮秒", "source_file": "pico.csv"}),
+]
+
+
+class FilterParsingTest(unittest.TestCase):
+    def test_parse_filter(self):
+        self.assertEqual(parse_filter("category=雷射,皮秒; source_file=laser.csv"),
+                         {"category": ["雷射", "皮秒"], "source_file": ["laser.csv"]})
+        with self.assertRaises(ValueError):
+            parse_filter("category")
+
+    def test_normalize_filter(self):
+        self.assertIsNone(normalize_filter(None))
+        self.assertIsNone(normalize_filter({"category": ["", None]}))
+        self.assertEqual(normalize_filter({"category": "雷射"}), {"category": ["雷射"]})
+        with self.assertRaises(ValueError):
+            normalize_filter({"price": "100"})
+
+    def test_matches(self):
+        search_filter = normalize_filter({"category": ["雷射", "皮秒"], "source_file": "pico.csv"})
+        self.assertEqual([doc_id for doc_id, metadata in DOCS if matches(metadata, search_filter)], ["b", "d"])
+        self.assertTrue(matches({}, None))
+
+
+class InvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = build_inverted_index(DOCS)
+
+    def test_select_ids_unions_values_and_intersects_fields(self):
+        self.assertEqual(select_ids(self.index, {"category": ["雷射", "皮秒"]}), {"a", "b", "d"})
+        self.assertEqual(select_ids(self.index, {"category": ["雷射"], "source_file": ["pico.csv"]}), {"b"})
+        self.assertEqual(select_ids(self.index, {"category": ["雷射"], "source_file": ["filler.csv"]}), set())
+        self.assertEqual(select_ids(self.index, {"category": ["unknown"]}), set())
+
+    def test_select_ids_agrees_with_matches(self):
+        search_filter = {"source_file": ["pico.csv", "filler.csv"]}
+        expected = {doc_id for doc_id, metadata in DOCS if matches(metadata, search_filter)}
+        self.assertEqual(select_ids(self.index, search_filter), expected)
+
+    def test_save_and_load_round_trip(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.assertIsNone(load_inverted_index(path))
+            save_inverted_index(path, self.index)
+            self.assertEqual(load_inverted_index(path), self.index)
+            self.assertEqual(os.listdir(path), [filters.INVERTED_INDEX_NAME])
+
+
+class InferFilterTest(unittest.TestCase):
+    def setUp(self):
+        rules = {"channels": {"line": "category=雷射"},
+                 "pages": {"/laser": {"category": ["皮秒"]}, "/laser/pico": "source_file=pico.csv"}}
+        patcher = mock.patch.dict(os.environ, {"RETRIEVAL_FILTERS": json.dumps(rules)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        filters._filter_rules = None
+        self.addCleanup(setattr, filters, "_filter_rules", None)
+
+    def test_later_sources_win_per_field(self):
+        self.assertEqual(filters.infer_filter(channel="line"), {"category": ["雷射"]})
+        self.assertEqual(filters.infer_filter(channel="line", page="/laser/x"), {"category": ["皮秒"]})
+        self.assertEqual(filters.infer_filter(channel="line", page="/laser/pico/1"),
+                         {"category": ["雷射"], "source_file": ["pico.csv"]})
+        self.assertEqual(filters.infer_filter(channel="line", explicit="category=玻尿酸"), {"category": ["玻尿酸"]})
+        self.assertIsNone(filters.infer_filter(channel="web"))
+
+
+if __name__ == "__main__":
+    unittest.main()
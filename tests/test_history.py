@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+from bty_chtbt.history import RollingHistory, extractive_summary
+
+
+def count_chars(text):
+    return len(text)
+
+
+def truncate_chars(content, max_tokens, keep_start=True):
+    if len(content) <= max_tokens:
+        return content
+    return content[:max_tokens] if keep_start else (content[-max_tokens:] if max_tokens else "")
+
+
+def make_history(**options):
+    options.setdefault("background", False)
+    return RollingHistory(count_chars, truncate_chars, **options)
+
+
+class ExtractiveSummaryTest(unittest.TestCase):
+    def test_keeps_question_and_first_sentence(self):
+        summary = extractive_summary("Q: 舊問題 A: 舊答案。", [("皮秒多少錢？", "約一萬元。術後需保濕。")])
+        self.assertEqual(summary, "Q: 舊問題 A: 舊答案。\nQ: 皮秒多少錢？ A: 約一萬元。")
+
+
+class RollingHistoryTest(unittest.TestCase):
+    def test_older_turns_are_summarized(self):
+        history = make_history(keep_recent=1)
+        history.add_turn("q1", "a1。more")
+        history.add_turn("q2", "a2。")
+        self.assertEqual(history.turns, [("q2", "a2。")])
+        self.assertEqual(history.summary, "Q: q1 A: a1。")
+        self.assertEqual(history.recent_queries(), ["q2"])
+        rendered = history.render(500)
+        self.assertEqual(rendered, "Conversation summary:\nQ: q1 A: a1。\nPrevious Q: q2\nPrevious A: a2。\n")
+
+    def test_render_always_fits_the_budget(self):
+        history = make_history(keep_recent=2, summary_tokens=60)
+        for i in range(30):
+            history.add_turn(f"question {i}", f"answer {i} " * 20 + "。")
+            for budget in (0, 40, 120, 400):
+                self.assertLessEqual(len(history.render(budget)), budget)
+        self.assertLessEqual(len(history.summary), 60)
+        # The newest turn survives; the oldest parts of the summary are dropped first
+        self.assertIn("Previous Q: question 29", history.render(400))
+        self.assertTrue(history.summary.endswith("answer 27 。"))
+        self.assertNotIn("question 0 ", history.render(400))
+
+    def test_pending_turns_render_before_the_summary_is_ready(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_summary(previous, turns):
+            started.set()
+            release.wait(5)
+            return extractive_summary(previous, turns)
+
+        history = make_history(keep_recent=1, summarize_fn=slow_summary, background=True)
+        history.add_turn("q1", "a1。")
+        history.add_turn("q2", "a2。")
+        started.wait(5)
+        self.assertEqual(len(history), 2)
+        self.assertIn("Q: q1 A: a1。", history.render(500))
+        release.set()
+        for _ in range(500):
+            if not history._pending:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(history.summary, "Q: q1 A: a1。")
+        self.assertEqual(len(history), 1)
+
+    def test_keep_recent_zero_summarizes_everything(self):
+        history = make_history(keep_recent=0)
+        history.add_turn("q1", "a1。")
+        self.assertEqual(history.turns, [])
+        self.assertEqual(history.render(500), "Conversation summary:\nQ: q1 A: a1。\n")
+
+    def test_clear(self):
+        history = make_history()
+        history.add_turn("q1", "a1。")
+        history.add_turn("q2", "a2。")
+        history.clear()
+        self.assertEqual((len(history), history.render(100)), (0, ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+from bty_chtbt.mmr import mmr_select
+
+
+class MMRSelectTest(unittest.TestCase):
+    def setUp(self):
+        self.query = np.array([1.0, 0.0, 0.0])
+        # 0 and 1 are near-duplicates closest to the query; 2 is less relevant but different
+        self.candidates = np.array([
+            [0.95, 0.31, 0.0],
+            [0.94, 0.34, 0.0],
+            [0.80, 0.0, 0.60],
+            [-1.0, 0.0, 0.0],
+        ])
+
+    def test_lambda_one_is_top_k_by_similarity(self):
+        self.assertEqual(mmr_select(self.query, self.candidates, 3, lambda_mult=1.0), [0, 1, 2])
+
+    def test_diversity_skips_near_duplicates(self):
+        self.assertEqual(mmr_select(self.query, self.candidates, 2, lambda_mult=0.5), [0, 2])
+
+    def test_selection_is_unique_and_capped(self):
+        selected = mmr_select(self.query, self.candidates, 10, lambda_mult=0.3)
+        self.assertEqual(sorted(selected), [0, 1, 2, 3])
+        self.assertEqual(selected[0], 0)
+
+    def test_matches_a_direct_implementation(self):
+        rng = np.random.default_rng(1)
+        candidates = rng.normal(size=(40, 8))
+        query = rng.normal(size=8)
+        unit = candidates / np.linalg.norm(candidates, axis=1, keepdims=True)
+        relevance = unit @ (query / np.linalg.norm(query))
+        expected = [int(np.argmax(relevance))]
+        while len(expected) < 6:
+            remaining = [i for i in range(len(unit)) if i not in expected]
+            scores = [0.6 * relevance[i] - 0.4 * max(unit[i] @ unit[j] for j in expected) for i in remaining]
+            expected.append(remaining[int(np.argmax(scores))])
+        self.assertEqual(mmr_select(query, candidates, 6, lambda_mult=0.6), expected)
+
+    def test_empty_pool(self):
+        self.assertEqual(mmr_select(self.query, np.empty((0, 3)), 3), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
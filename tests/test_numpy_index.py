@@ -0,0 +1,98 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from bty_chtbt.numpy_index import NumpyIndex, normalize_rows
+
+
+def brute_force(vectors, query, k):
+    scores = normalize_rows(vectors) @ normalize_rows(query)
+    order = np.argsort(-scores)[:k]
+    return scores[order], order
+
+
+class NumpyIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(500, 32)).astype(np.float32)
+        self.queries = rng.normal(size=(5, 32)).astype(np.float32)
+
+    def test_float32_top_k_matches_brute_force_across_blocks(self):
+        index = NumpyIndex.from_vectors(self.vectors, dtype="float32")
+        index.block_size = 64  # several blocks, so the running top-k merge is exercised
+        scores, rows = index.search(self.queries, k=10)
+        for query, query_scores, query_rows in zip(self.queries, scores, rows, strict=True):
+            expected_scores, expected_rows = brute_force(self.vectors, query, 10)
+            np.testing.assert_array_equal(query_rows, expected_rows)
+            np.testing.assert_allclose(query_scores, expected_scores, rtol=1e-5, atol=1e-6)
+
+    def test_quantized_scores_stay_close(self):
+        for dtype, atol in (("float16", 2e-3), ("int8", 2e-2)):
+            index = NumpyIndex.from_vectors(self.vectors, dtype=dtype)
+            scores, rows = index.search(self.queries[0], k=10)
+            exact = normalize_rows(self.vectors)[rows[0]] @ normalize_rows(self.queries[0])
+            np.testing.assert_allclose(scores[0], exact, atol=atol, err_msg=dtype)
+            self.assertTrue(np.all(np.diff(scores[0]) <= 0), dtype)
+
+    def test_rows_restrict_the_search(self):
+        index = NumpyIndex.from_vectors(self.vectors, dtype="float32")
+        allowed = np.arange(0, 500, 7)
+        _, rows = index.search(self.queries[0], k=5, rows=allowed)
+        _, expected = brute_force(self.vectors[allowed], self.queries[0], 5)
+        np.testing.assert_array_equal(rows[0], allowed[expected])
+
+    def test_k_is_capped_by_the_candidates(self):
+        index = NumpyIndex.from_vectors(self.vectors[:3], dtype="float32")
+        scores, rows = index.search(self.queries[0], k=10)
+        self.assertEqual(rows.shape, (1, 3))
+        scores, rows = index.search(self.queries[0], k=3, rows=np.array([], dtype=np.int64))
+        self.assertEqual(rows.shape, (1, 0))
+
+    def test_save_and_load_round_trip(self):
+        index = NumpyIndex.from_vectors(self.vectors, dtype="int8")
+        with tempfile.TemporaryDirectory() as path:
+            index.save(path)
+            loaded = NumpyIndex.load(path)
+            self.assertEqual(loaded.dtype, "int8")
+            self.assertEqual(len(loaded), len(index))
+            np.testing.assert_array_equal(loaded.search(self.queries, k=5)[1], index.search(self.queries, k=5)[1])
+            del loaded  # release the memory map before the directory is removed
+
+    def test_append_and_replace(self):
+        index = NumpyIndex.from_vectors(self.vectors[:10], dtype="float32")
+        appended = index.append(self.vectors[10:20])
+        self.assertEqual(len(appended), 20)
+        _, rows = appended.search(self.vectors[15], k=1)
+        self.assertEqual(rows[0, 0], 15)
+        replaced = appended.replace([0], self.vectors[15:16])
+        np.testing.assert_allclose(replaced.reconstruct([0]), replaced.reconstruct([15]))
+
+    def test_extend_and_update_in_place(self):
+        for dtype in ("float32", "int8"):
+            index = NumpyIndex.from_vectors(self.vectors[:10], dtype=dtype)
+            index.extend(self.vectors[10:80])
+            buffer = index._buffer
+            for start in range(80, 500, 70):
+                index.extend(self.vectors[start:start + 70])
+            expected = NumpyIndex.from_vectors(self.vectors, dtype=dtype)
+            self.assertEqual(len(index), 500)
+            np.testing.assert_array_equal(index.vectors, expected.vectors)
+            self.assertEqual(index.scales is None, dtype == "float32")
+            # The first extend reserved room for the later batches
+            self.assertIs(index._buffer, buffer)
+            index.update([0, 499], self.vectors[[7, 8]])
+            np.testing.assert_allclose(index.reconstruct([0, 499]), expected.reconstruct([7, 8]))
+
+    def test_extend_copies_a_memory_map_once(self):
+        with tempfile.TemporaryDirectory() as path:
+            NumpyIndex.from_vectors(self.vectors[:10]).save(path)
+            loaded = NumpyIndex.load(path)
+            loaded.extend(self.vectors[10:12])
+            self.assertEqual(len(loaded), 12)
+            self.assertNotIsInstance(loaded.vectors, np.memmap)
+            del loaded
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+from langchain_core.documents import Document
+
+from bty_chtbt.pipeline import load_config
+from bty_chtbt.pipeline.core import Pipeline
+from bty_chtbt.pipeline.stages import HistoryStore, PromptBuilder, prompt_budget
+
+
+class CharTokens:
+    """One token per character."""
+
+    def count(self, text):
+        return len(text)
+
+    def truncate(self, content, max_tokens, keep_start=True):
+        if len(content) <= max_tokens:
+            return content
+        return content[:max_tokens] if keep_start else (content[-max_tokens:] if max_tokens else "")
+
+
+class FakeRetriever:
+    vector_store = object()
+    reranker = None
+    k = 1
+
+    def search(self, query, k, **_options):
+        return [Document(page_content="answer", metadata={"question": query})][:k]
+
+    def expand(self, results):
+        return results
+
+
+class BarrierLLM:
+    """Holds every call until `parties` requests are generating at once; records the prompts."""
+
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=5)
+        self.prompts = []
+
+    def generate(self, prompt, **_options):
+        self.prompts.append(prompt)
+        self.barrier.wait()
+        query = prompt.rsplit("User Question: ", 1)[1].split("\n")[0]
+        return f"answer to {query}"
+
+
+def make_pipeline(llm):
+    tokens = CharTokens()
+    return Pipeline("test", {}, tokens, None, FakeRetriever(), PromptBuilder("system", tokens, 4000), llm,
+                    HistoryStore(tokens, budget_tokens=500), policy=None)
+
+
+class SessionHistoryTest(unittest.TestCase):
+    def test_concurrent_sessions_do_not_share_history(self):
+        llm = BarrierLLM(parties=2)
+        pipeline = make_pipeline(llm)
+        questions = {"user-a": ["皮秒雷射多少錢？", "要做幾次？"], "user-b": ["玻尿酸可以維持多久？", "會痛嗎？"]}
+        errors = []
+
+        def chat(session, query):
+            try:
+                pipeline.answer(query, history=pipeline.history.get(session), channel="line", deadline=1)
+            except Exception as e:  # surfaced by the assertion below
+                errors.append(e)
+
+        for turn in range(2):
+            threads = [threading.Thread(target=chat, args=(session, queries[turn]))
+                       for session, queries in questions.items()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            self.assertEqual(errors, [])
+
+        follow_ups = {query: prompt for prompt in llm.prompts[2:]
+                      for query in ("要做幾次？", "會痛嗎？") if f"User Question: {query}" in prompt}
+        self.assertIn("皮秒雷射多少錢？", follow_ups["要做幾次？"])
+        self.assertNotIn("玻尿酸", follow_ups["要做幾次？"])
+        self.assertIn("玻尿酸可以維持多久？", follow_ups["會痛嗎？"])
+        self.assertNotIn("皮秒", follow_ups["會痛嗎？"])
+        for session, queries in questions.items():
+            self.assertEqual(pipeline.history.get(session).recent_queries()[-1], queries[1])
+        self.assertEqual(pipeline.history.stats()["sessions"], 2)
+
+
+class PromptBudgetTest(unittest.TestCase):
+    def test_window_minus_answer_and_reserve(self):
+        self.assertEqual(prompt_budget({"context_window": 4096}, {"reserve_tokens": 64}, 512), 3520)
+        # The local generator's max_length and max_new_tokens win over the window and channel budgets
+        self.assertEqual(prompt_budget({"context_window": 32768, "max_length": 2048, "max_new_tokens": 256},
+                                       {}, 512), 2048 - 256 - 64)
+
+    def test_max_prompt_tokens_caps_the_budget(self):
+        llm = {"context_window": 200000}
+        self.assertEqual(prompt_budget(llm, {"max_prompt_tokens": 3000}, 512), 3000)
+        self.assertEqual(prompt_budget({"context_window": 2048}, {"max_prompt_tokens": 3000}, 512), 2048 - 512 - 64)
+
+    def test_no_room_for_the_prompt(self):
+        with self.assertRaises(ValueError):
+            prompt_budget({"context_window": 512}, {}, 512)
+        with self.assertRaises(ValueError):
+            prompt_budget({"model": "unknown"}, {}, 512)
+
+    def test_line_profile_sets_an_explicit_budget(self):
+        with mock.patch.dict(os.environ):
+            for variable in ("MAX_PROMPT_TOKENS", "CONTEXT_WINDOW", "PIPELINE_CONFIG"):
+                os.environ.pop(variable, None)
+            config = load_config("line")
+        self.assertGreaterEqual(config["llm"]["context_window"], 100000)
+        self.assertEqual(prompt_budget(config["llm"], config["prompt"], 1024), config["prompt"]["max_prompt_tokens"])
+        self.assertLessEqual(config["prompt"]["max_prompt_tokens"], 8000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from bty_chtbt.history import RollingHistory
+from bty_chtbt.query_rewrite import (
+    QueryRewriter,
+    extract_topic,
+    is_follow_up,
+    llm_rewriter,
+    rule_rewrite,
+)
+
+
+def make_history():
+    return RollingHistory(len, lambda content, *_args, **_kwargs: content, background=False)
+
+
+class FakeOpenAI:
+    """Records with_options() and create() calls; create() fails when error is set."""
+
+    def __init__(self, content="皮秒雷射多少錢？\n", error=None):
+        self.content = content
+        self.error = error
+        self.options = []
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **options):
+        self.options.append(options)
+        return self
+
+    def create(self, **request):
+        self.requests.append(request)
+        if self.error is not None:
+            raise self.error
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))])
+
+
+class IsFollowUpTest(unittest.TestCase):
+    def test_follow_ups(self):
+        for query in ("那價格呢？", "還有其他療程嗎？", "它會痛嗎", "這個要做幾次？", "多少錢？", "要多久？",
+                      "術後呢", "what about recovery?"):
+            self.assertTrue(is_follow_up(query), query)
+
+    def test_standalone_questions_of_any_length(self):
+        for query in ("玻尿酸價格", "皮秒雷射", "皮秒雷射術後多久可以化妝？", "肉毒桿菌可以維持多久？"):
+            self.assertFalse(is_follow_up(query), query)
+
+
+class RuleRewriteTest(unittest.TestCase):
+    def test_extract_topic(self):
+        self.assertEqual(extract_topic("請問皮秒雷射有什麼效果？"), "皮秒雷射")
+        self.assertEqual(extract_topic("玻尿酸可以維持多久？"), "玻尿酸")
+
+    def test_references_openers_and_particles(self):
+        self.assertEqual(rule_rewrite("它會痛嗎？", "皮秒雷射"), "皮秒雷射會痛嗎？")
+        self.assertEqual(rule_rewrite("那價格呢？", "皮秒雷射"), "皮秒雷射價格？")
+        self.assertEqual(rule_rewrite("多少錢？", "皮秒雷射"), "皮秒雷射多少錢？")
+        self.assertEqual(rule_rewrite("多少錢？", ""), "多少錢？")
+
+
+class QueryRewriterTest(unittest.TestCase):
+    def test_off_by_default(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("QUERY_REWRITE", None)
+            rewriter = QueryRewriter(mode=None)
+        history = make_history()
+        history.add_turn("皮秒雷射有什麼效果？", "淡斑。")
+        self.assertEqual(rewriter.rewrite("多少錢？", history), "多少錢？")
+
+    def test_rules_use_the_topic_of_the_last_standalone_question(self):
+        rewriter = QueryRewriter(mode="rules")
+        history = make_history()
+        self.assertEqual(rewriter.rewrite("皮秒雷射有什麼效果？", history), "皮秒雷射有什麼效果？")
+        history.add_turn("皮秒雷射有什麼效果？", "淡斑。")
+        self.assertEqual(rewriter.rewrite("多少錢？", history), "皮秒雷射多少錢？")
+        history.add_turn("多少錢？", "約一萬元。")
+        self.assertEqual(rewriter.rewrite("那要做幾次呢？", history), "皮秒雷射要做幾次？")
+        history.add_turn("那要做幾次呢？", "三到五次。")
+        self.assertEqual(rewriter.rewrite("玻尿酸價格", history), "玻尿酸價格")
+        self.assertEqual(rewriter.rewrites, 2)
+
+    def test_llm_rewrite_with_fallback_and_cache(self):
+        calls = []
+
+        def rewrite_fn(query, previous, *_context):
+            calls.append((query, previous))
+            return None if query == "它會痛嗎？" else "皮秒雷射的價格是多少？"
+
+        rewriter = QueryRewriter(rewrite_fn=rewrite_fn, mode="llm", budget_seconds=1)
+        history = make_history()
+        rewriter.rewrite("皮秒雷射有什麼效果？", history)
+        history.add_turn("皮秒雷射有什麼效果？", "淡斑。")
+        self.assertEqual(rewriter.rewrite("多少錢？", history), "皮秒雷射的價格是多少？")
+        self.assertEqual(rewriter.rewrite("多少錢？", history), "皮秒雷射的價格是多少？")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(rewriter.cache_hits, 1)
+        self.assertEqual(rewriter.rewrite("它會痛嗎？", history), "皮秒雷射會痛嗎？")
+        self.assertEqual(rewriter.fallbacks, 1)
+
+    def test_sessions_are_independent(self):
+        rewriter = QueryRewriter(mode="rules")
+        first, second = make_history(), make_history()
+        rewriter.rewrite("皮秒雷射有什麼效果？", first)
+        first.add_turn("皮秒雷射有什麼效果？", "淡斑。")
+        rewriter.rewrite("玻尿酸有什麼效果？", second)
+        second.add_turn("玻尿酸有什麼效果？", "填補。")
+        self.assertEqual(rewriter.rewrite("多少錢？", first), "皮秒雷射多少錢？")
+        self.assertEqual(rewriter.rewrite("多少錢？", second), "玻尿酸多少錢？")
+
+
+class LLMRewriterTest(unittest.TestCase):
+    def test_single_attempt_within_the_timeout(self):
+        client = FakeOpenAI()
+        rewrite = llm_rewriter(client, "small-model")
+        self.assertEqual(rewrite("多少錢？", "皮秒雷射有什麼效果？", "", 0.4), "皮秒雷射多少錢？")
+        self.assertEqual(client.options, [{"max_retries": 0, "timeout": 0.4}])
+        self.assertEqual(client.requests[0]["model"], "small-model")
+
+    def test_failure_returns_none(self):
+        client = FakeOpenAI(error=TimeoutError("timed out"))
+        self.assertIsNone(llm_rewriter(client, "small-model")("多少錢？", "皮秒雷射", "", 0.4))
+        self.assertEqual(len(client.requests), 1)
+        self.assertIsNone(llm_rewriter(FakeOpenAI(content="  "), "small-model")("多少錢？", "皮秒雷射", "", 0.4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+from langchain_core.documents import Document
+
+from bty_chtbt.traffic import (
+    TrafficRecorder,
+    anonymize,
+    compare_runs,
+    read_records,
+    regressions,
+)
+
+
+def run(records):
+    return [dict({"timings_ms": {}, "doc_ids": []}, **record) for record in records]
+
+
+class AnonymizeTest(unittest.TestCase):
+    def test_personal_data_is_masked(self):
+        self.assertEqual(anonymize("我的電話 0912-345-678"), "我的電話 <number>")
+        self.assertEqual(anonymize("+886912345678 會員 12345678"), "<number> 會員 <number>")
+        self.assertEqual(anonymize("寄到 amy.lin+spa@example.com.tw"), "寄到 <email>")
+        self.assertEqual(anonymize("身分證 A123456789"), "身分證 <id>")
+        self.assertEqual(anonymize("看 https://example.com/a?b=1 的說明"), "看 <url> 的說明")
+
+    def test_prices_dosages_and_dates_stay_readable(self):
+        for text in ("皮秒 3000 5000 元", "玻尿酸 1cc 12000 元", "預約 2026-10-19 下午", "術後 7 天", "100-200 單位"):
+            self.assertEqual(anonymize(text), text)
+
+    def test_empty(self):
+        self.assertEqual(anonymize(""), "")
+        self.assertIsNone(anonymize(None))
+
+
+class CompareRunsTest(unittest.TestCase):
+    def setUp(self):
+        self.baseline = run([
+            {"id": "1", "query": "a", "doc_ids": ["x", "y"], "timings_ms": {"retrieve": 10, "generate": 100},
+             "prompt_tokens": 100, "answer_tokens": 20},
+            {"id": "2", "query": "b", "doc_ids": ["z", "w"], "timings_ms": {"retrieve": 20, "generate": 200},
+             "prompt_tokens": 200, "answer_tokens": 40},
+        ])
+
+    def test_identical_runs(self):
+        report = compare_runs(self.baseline, self.baseline)
+        self.assertEqual(report["requests"], 2)
+        self.assertEqual(report["retrieval"]["identical_rate"], 1.0)
+        self.assertEqual(report["retrieval"]["mean_overlap"], 1.0)
+        self.assertEqual([row["p95_change"] for row in report["latency"]], [0.0, 0.0])
+        self.assertEqual(report["tokens"]["baseline_prompt_tokens"], 150.0)
+        self.assertEqual(regressions(report), [])
+
+    def test_changes_are_reported(self):
+        candidate = run([
+            {"id": "1", "query": "a", "doc_ids": ["y", "x"], "timings_ms": {"retrieve": 30, "generate": 100}},
+            {"id": "2", "query": "b", "doc_ids": ["z", "v"], "timings_ms": {"retrieve": 40, "generate": 200}},
+            {"id": "3", "query": "c", "doc_ids": ["q"]},
+        ])
+        report = compare_runs(self.baseline, candidate)
+        self.assertEqual((report["requests"], report["unmatched"]), (2, 1))
+        retrieval = report["retrieval"]
+        self.assertEqual(retrieval["identical_rate"], 0.0)
+        self.assertEqual(retrieval["same_top1_rate"], 0.5)
+        self.assertAlmostEqual(retrieval["mean_overlap"], round((1.0 + 1 / 3) / 2, 3))
+        self.assertEqual(retrieval["examples"][0], {"query": "b", "overlap": 0.333, "removed": ["w"], "added": ["v"]})
+        latency = {row["stage"]: row for row in report["latency"]}
+        self.assertGreater(latency["retrieve"]["p95_change"], 0.2)
+        problems = regressions(report)
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(problems[0].startswith("retrieve p95"))
+        self.assertIn("retrieval overlap", problems[1])
+        self.assertEqual(regressions(report, min_overlap=0.5, ignore_stages=("retrieve",)), [])
+
+    def test_small_absolute_changes_are_noise(self):
+        candidate = run([dict(record, timings_ms={"retrieve": record["timings_ms"]["retrieve"] * 1.5,
+                                                   "generate": record["timings_ms"]["generate"]})
+                         for record in self.baseline])
+        self.assertEqual(regressions(compare_runs(self.baseline, candidate), min_delta_ms=50), [])
+
+
+class TrafficRecorderTest(unittest.TestCase):
+    def test_records_are_anonymized_and_rotated(self):
+        docs = [Document(page_content="a", metadata={"source_file": "laser.csv", "index": 3})]
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = TrafficRecorder(directory, max_bytes=600, backups=1, salt="s")
+            entry = recorder.record("web", "電話 0912345678 可以預約嗎", docs, {"retrieve": 1.5},
+                                    session="user-1", search_query="電話 0912345678 可以預約嗎")
+            self.assertEqual(entry["query"], "電話 <number> 可以預約嗎")
+            self.assertIsNone(entry["search_query"])
+            self.assertEqual(entry["doc_ids"], ["laser.csv:3"])
+            self.assertEqual(entry["session"], recorder.hash_id("user-1"))
+            with open(recorder.path, encoding="utf-8") as f:
+                self.assertNotIn("user-1", f.read())
+            for _ in range(10):
+                recorder.record("web", "皮秒多少錢", docs, {})
+            self.assertGreater(recorder.rotations, 0)
+            self.assertEqual(len(os.listdir(directory)), 2)  # the current file and one backup
+            records = read_records(directory)
+            self.assertTrue(records)
+            self.assertTrue(all("0912345678" not in record["query"] for record in records))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from langchain_core.documents import Document
+
+from bty_chtbt.vector_backend import get_backend
+from tests.test_artifact import DOCUMENTS, HashEmbeddings
+
+
+class BuildBatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "store")
+
+    def test_empty_corpus_fails_before_touching_the_store(self):
+        for name, options in (("numpy", {}), ("sharded", {"shard_backend": "numpy", "workers": 2})):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, "keep"), "w") as f:
+                f.write("previous store")
+            backend = get_backend(name, self.path, HashEmbeddings(), **options)
+            with self.assertRaises(ValueError):
+                backend.build_batches(iter([[], []]))
+            self.assertEqual(os.listdir(self.path), ["keep"])
+            os.remove(os.path.join(self.path, "keep"))
+            os.rmdir(self.path)
+            with self.assertRaises(ValueError):
+                backend.build_batches([])
+            self.assertFalse(os.path.exists(self.path))
+
+    def test_leading_empty_batches_are_skipped(self):
+        backend = get_backend("numpy", self.path, HashEmbeddings())
+        backend.build_batches([[], DOCUMENTS[:5], [], DOCUMENTS[5:]])
+        self.assertEqual(backend.count(), len(DOCUMENTS))
+
+    def test_batches_replace_repeated_ids(self):
+        updated = [Document(page_content=f"{doc.page_content} (updated)", metadata=dict(doc.metadata))
+                   for doc in DOCUMENTS[:3]]
+        backend = get_backend("numpy", self.path, HashEmbeddings())
+        backend.build_batches([DOCUMENTS[:6], DOCUMENTS[6:] + updated[:1], updated[1:] + updated[2:]])
+        self.assertEqual(backend.count(), len(DOCUMENTS))
+        self.assertEqual([doc.page_content for doc in backend.get(backend.ids[:4])],
+                         [doc.page_content for doc in updated] + [DOCUMENTS[3].page_content])
+        reference = get_backend("numpy", os.path.join(self.dir.name, "reference"), HashEmbeddings())
+        reference.build(updated + DOCUMENTS[3:])
+        np.testing.assert_array_equal(backend.index.vectors, reference.index.vectors)
+        reloaded = get_backend("numpy", self.path, HashEmbeddings()).load()
+        self.assertEqual(reloaded.ids, backend.ids)
+        self.assertEqual(reloaded.get(backend.ids[1:2])[0].page_content, updated[1].page_content)
+        np.testing.assert_array_equal(reloaded.index.vectors, reference.index.vectors)
+        del reloaded
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,83 +1,194 @@
-import os
 import glob
+import os
+
 import pandas as pd
-from langchain.docstore.document import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-# from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_chroma import Chroma
+
+from bty_chtbt.chunking import make_splitter, split_long_answers
+from bty_chtbt.dedup import Deduplicator
+from bty_chtbt.model_bundle import get_bundle
+from bty_chtbt.pipeline.config import load_config
+from bty_chtbt.pipeline.stages import build_embeddings
+from bty_chtbt.vector_backend import (
+    DEFAULT_STORE_NAMES,
+    ShardedBackend,
+    export_artifact,
+    get_backend,
+    load_backend,
+    make_document,
+)
 
 # Define the directory containing the text files and the persistent directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
 books_dir = os.path.join(current_dir, "books")
 db_dir = os.path.join(current_dir, "db")
-db_name = "hugging_face_chroma_with_metadata"
+# Serving profile in pipelines.toml the store is built for: its embedder model is the one the
+# chatbots query with (and the one recorded in artifacts), and its retriever backend is the default
+pipeline_profile = os.getenv("PIPELINE_PROFILE", "lms")
+pipeline_config = load_config(pipeline_profile)
+# Backend to build: "faiss", "chroma", "numpy" (NUMPY_INDEX_DTYPE: float16, float32 or int8) or
+# "sharded" (one SHARD_BACKEND store per CSV, built and searched in parallel); VECTOR_BACKEND overrides
+vector_backend = pipeline_config["retriever"]["backend"]
+db_name = DEFAULT_STORE_NAMES[vector_backend]
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR", os.path.join(db_dir, "embedding_cache"))
+# Optional single-file artifact for deploys (upload this one object instead of the store directory)
+artifact_path = os.getenv("VECTOR_ARTIFACT_PATH")
+# With the sharded backend, REBUILD_SHARD=<file>.csv re-embeds only that CSV into the existing
+# store (a missing file removes its shard); running servers pick it up on their next reload
+rebuild_shard_file = os.getenv("REBUILD_SHARD")
 
 print(f"Books directory: {books_dir}")
 print(f"DB directory: {db_dir}")
+print(f"Pipeline profile: {pipeline_profile} (embedder {pipeline_config['embedder']['model']}, backend {vector_backend})")
 
 # make embeddings a global variable
 # embeddings = None
 
-def load_csvs_to_documents(csv_directory):
+# Columns read from the CSVs (anything else is never parsed) and their dtypes.
+# Reading everything as str keeps IDs like "007" intact and avoids per-chunk type inference.
+CSV_COLUMNS = ["ID", "Question", "Answer", "Category"]
+REQUIRED_COLUMNS = ["ID", "Question", "Answer"]
+CSV_DTYPES = dict.fromkeys(CSV_COLUMNS, str)
+csv_chunksize = int(os.getenv("CSV_CHUNKSIZE", "5000"))
+embed_batch_size = int(os.getenv("EMBED_BATCH_SIZE", "1000"))
+# Answers longer than CHUNK_TOKENS are indexed as overlapping chunks that point back to their
+# parent answer (0 disables chunking)
+chunk_tokens = int(os.getenv("CHUNK_TOKENS", "256"))
+chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Near-duplicate Q&A rows: "flag" keeps all copies with duplicate_of metadata (retrieval
+# returns one per group, see retriever.collapse_duplicates), "merge" keeps only the first copy
+# of duplicates with the same category and source file (others are flagged), "off" disables
+# the stage. Matches go to DEDUP_REPORT.
+dedup_mode = os.getenv("DEDUP", "flag")
+dedup_threshold = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+dedup_report_path = os.getenv("DEDUP_REPORT", os.path.join(db_dir, "dedup_report.csv"))
+
+
+class LoadReport:
+    """Counts kept while streaming CSV rows, printed once loading finishes."""
+
+    def __init__(self):
+        self.files = 0
+        self.rows = 0
+        self.documents = 0
+        self.invalid_rows = 0
+        self.duplicates = 0
+        self.failed_files = []
+
+    def __str__(self):
+        return (f"{self.documents} documents from {self.files} CSV files ({self.rows} rows read, "
+                f"{self.invalid_rows} invalid rows skipped, {self.duplicates} duplicate IDs dropped, "
+                f"{len(self.failed_files)} files failed)")
+
+
+def iter_csv_documents(csv_directory, chunksize=None, dedup_scope="file", report=None, strict=False,
+                       pattern="*.csv"):
     """
-    Load multiple Q&A CSV files and convert them to LangChain Document objects.
+    Stream Q&A CSV files as LangChain Documents, one pandas chunk at a time.
+
+    Only CSV_COLUMNS are parsed, as strings. Each chunk is validated: a file without the
+    required columns or that fails to parse is reported (and raises with strict=True),
+    rows with an empty ID/Question/Answer are skipped and counted. Duplicate IDs are
+    dropped, keeping the first: dedup_scope="file" dedups on the store's document id
+    (source file + ID), "global" treats the same ID in different files as a duplicate.
+    pattern selects the files, e.g. a single file name to load one CSV.
     """
-    documents = []
-    # Get all CSV files in the directory
-    csv_files = glob.glob(os.path.join(csv_directory, "*.csv"))
-    
+    report = report if report is not None else LoadReport()
+    csv_files = sorted(glob.glob(os.path.join(csv_directory, pattern)))
     if not csv_files:
         raise ValueError(f"No CSV files found in {csv_directory}")
-    
+
+    seen_ids = set()
     for csv_file in csv_files:
+        source_file = os.path.basename(csv_file)
+        print(f"Processing {csv_file}...")
+        report.files += 1
         try:
-            print(f"Processing {csv_file}...")
-            # Load CSV
-            df = pd.read_csv(csv_file)
-            
-            # Validate required columns
-            required_columns = ["Question", "Answer"]
-            if not all(col in df.columns for col in required_columns):
-                print(f"Skipping {csv_file}: Missing required columns {required_columns}")
-                continue
-            
-            # Convert rows to Document objects
-            for _, row in df.iterrows():
-                doc = Document(
-                    page_content=str(row["Answer"]),  # Embed the answer
-                    metadata={
-                        "index": str(row["ID"]),  # Ensure ID is a string
-                        "question": str(row["Question"]),
-                        "category": str(row.get("Category", "")),  # Handle optional columns
-                        "source_file": os.path.basename(csv_file)  # Track source file
-                    }
-                )
-                documents.append(doc)
-        except Exception as e:
+            chunks = pd.read_csv(
+                csv_file,
+                usecols=lambda column: column in CSV_COLUMNS,
+                dtype=CSV_DTYPES,
+                chunksize=chunksize or csv_chunksize
+            )
+            for chunk in chunks:
+                missing = [column for column in REQUIRED_COLUMNS if column not in chunk.columns]
+                if missing:
+                    raise ValueError(f"missing required columns {missing}")
+                report.rows += len(chunk)
+                valid = chunk[REQUIRED_COLUMNS].notna().all(axis=1)
+                for column in REQUIRED_COLUMNS:
+                    valid &= chunk[column].fillna("").str.strip() != ""
+                report.invalid_rows += int((~valid).sum())
+                has_category = "Category" in chunk.columns
+                for row in chunk[valid].itertuples(index=False):
+                    row_id = row.ID.strip()
+                    key = row_id if dedup_scope == "global" else f"{source_file}:{row_id}"
+                    if key in seen_ids:
+                        report.duplicates += 1
+                        continue
+                    seen_ids.add(key)
+                    report.documents += 1
+                    yield make_document(
+                        row_id=row_id,
+                        question=row.Question,
+                        answer=row.Answer,  # Embed the answer
+                        category=row.Category if has_category else "",  # Handle optional columns
+                        source_file=source_file  # Track source file
+                    )
+        except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+            report.failed_files.append(source_file)
             print(f"Error processing {csv_file}: {e}")
-    
+            if strict:
+                raise
+
+
+def iter_document_batches(csv_directory, batch_size=None, splitter=None, deduplicator=None, **options):
+    """
+    Group streamed Documents into lists of batch_size for batch-by-batch embedding.
+    With a deduplicator, near-duplicate rows are dropped or flagged before embedding;
+    with a splitter, long answers in each batch are replaced by their chunks.
+    """
+    documents = iter_csv_documents(csv_directory, **options)
+    if deduplicator is not None:
+        documents = deduplicator.filter(documents)
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= (batch_size or embed_batch_size):
+            yield split_long_answers(batch, splitter) if splitter else batch
+            batch = []
+    if batch:
+        yield split_long_answers(batch, splitter) if splitter else batch
+
+
+def load_csvs_to_documents(csv_directory):
+    """
+    Load multiple Q&A CSV files and convert them to LangChain Document objects.
+    """
+    report = LoadReport()
+    documents = list(iter_csv_documents(csv_directory, report=report))
     if not documents:
         raise ValueError("No valid documents created from CSV files")
-    
-    print(f"Created {len(documents)} documents from {len(csv_files)} CSV files")
+    print(f"Created {report}")
     return documents
 
 # Function to create and persist vector store
-def create_vector_store(docs, store_name, embeddings):
+def create_vector_store(docs, store_name, embeddings, backend="faiss"):
+    """docs is a list of Documents or an iterable of Document batches (see iter_document_batches)."""
     if not os.path.exists(store_name):
-        print(f"\n--- Creating vector store {store_name} ---")
-
-        # Create vector store with FAISS
-        vector_store = FAISS.from_documents(
-        documents=docs,
-        embedding=embeddings
-        )
+        print(f"\n--- Creating {backend} vector store {store_name} ---")
 
-        # Save vector store to disk
-        vector_store.save_local(store_name)
+        # Build through the shared backend API so every backend writes the same schema
+        if isinstance(docs, list):
+            vector_store = get_backend(backend, store_name, embeddings).build(docs)
+        else:
+            # Streamed batches: only one batch of rows and embeddings is held at a time
+            vector_store = get_backend(backend, store_name, embeddings).build_batches(docs)
 
-        print(f"--- Finished creating vector store {store_name} ---")
+        print(f"--- Finished creating vector store {store_name} ({vector_store.count()} rows) ---")
+        # Per-category and per-source inverted ID lists are written next to the index for filtered search
+        print(f"Indexed {len(vector_store.filter_values('category'))} categories and "
+              f"{len(vector_store.filter_values('source_file'))} source files")
+        return vector_store
     else:
         print(
             f"Vector store {store_name} already exists. No need to initialize.")
@@ -87,53 +198,96 @@ def create_chroma_vector_store(docs, store_name, embeddings):
     Create and save a Chroma vector store from multiple Q&A CSV files.
     """
     try:
-        # Create Chroma vector store
-        vector_store = Chroma.from_documents(
-            documents=docs,
-            embedding=embeddings,
-            persist_directory=store_name
-        )
-        
-        # Persist the vector store
-        # vector_store.persist()
+        vector_store = get_backend("chroma", store_name, embeddings).build(docs)
         print(f"Chroma vector store saved to {store_name}")
-        # return vector_store
+        return vector_store
     except Exception as e:
         print(f"Error creating Chroma vector store: {e}")
         return None       
 
+def export_vector_artifact(persistent_directory, embeddings, path):
+    """Export the built store as a single versioned artifact file (see bty_chtbt/artifact.py)."""
+    vector_store = load_backend(vector_backend, persistent_directory, embeddings)
+    export_artifact(vector_store, path, dtype=os.getenv("ARTIFACT_DTYPE", "float16"))
+    print(f"Vector store artifact written to {path} ({os.path.getsize(path) / (1024 * 1024):.1f} MB)")
+
+def rebuild_csv_shard(persistent_directory, embeddings, source_file):
+    """
+    Replace the shard of one CSV in a sharded store, leaving every other shard as it is.
+
+    Near-duplicates are only detected within the file: rows that a full build would have
+    merged into another file's copy stay in this shard.
+    """
+    vector_store = load_backend(vector_backend, persistent_directory, embeddings)
+    if not isinstance(vector_store, ShardedBackend) or vector_store.shard_by != "source_file":
+        raise ValueError("REBUILD_SHARD needs a store built with VECTOR_BACKEND=sharded and SHARD_BY=source_file")
+    documents = []
+    if os.path.exists(os.path.join(books_dir, source_file)):
+        report = LoadReport()
+        splitter = make_splitter(chunk_tokens, chunk_overlap_tokens) if chunk_tokens else None
+        deduplicator = Deduplicator(dedup_mode, dedup_threshold) if dedup_mode != "off" else None
+        for batch in iter_document_batches(books_dir, splitter=splitter, deduplicator=deduplicator,
+                                           report=report, pattern=glob.escape(source_file)):
+            documents.extend(batch)
+        print(f"Loaded {report}")
+    vector_store.rebuild_shard(source_file, documents)
+    print(f"Shard {source_file}: {len(documents)} rows; store now {vector_store.count()} rows "
+          f"in {len(vector_store.shards)} shards")
+    return vector_store
+
+def make_embeddings():
+    # The profile's embedder, cached so a rebuild only embeds text that changed since the last run
+    return build_embeddings(pipeline_config, dict(pipeline_config["embedder"], cache_dir=embedding_cache_dir))
+
 def main():
-    # Check if the Chroma vector store already exists， if not, create it
+    # Check if the vector store already exists， if not, create it
     persistent_directory = os.path.join(db_dir, db_name)
+    embeddings = None
+    # Offline bundle (MODEL_BUNDLE_DIR) must be active before the splitter loads tiktoken
+    get_bundle()
 
     if not os.path.exists(persistent_directory):
         print("Persistent directory does not exist. Initializing vector store...")
 
-        # Step 1: Load and prepare CSV files
+        # Step 1: Stream the CSV files in chunks (nothing is read until the store pulls a batch)
         # Ensure the books directory exists
         if not os.path.exists(books_dir):
             raise FileNotFoundError(
                 f"The directory {books_dir} does not exist. Please check the path."
             )
-        else:
-            documents = load_csvs_to_documents(books_dir)
+        report = LoadReport()
+        splitter = make_splitter(chunk_tokens, chunk_overlap_tokens) if chunk_tokens else None
+        deduplicator = Deduplicator(dedup_mode, dedup_threshold) if dedup_mode != "off" else None
+        batches = iter_document_batches(books_dir, splitter=splitter, deduplicator=deduplicator, report=report)
 
         # Step 2: Initialize HuggingFaceEmbeddings
         print("\n--- Using Hugging Face Transformers ---")
-        embeddings = HuggingFaceEmbeddings(
-        model_name="all-MiniLM-L6-v2",  # Fast, effective for semantic similarity
-        model_kwargs={"device": "cpu"}   # Use GPU if available: "cuda"
-        )
+        embeddings = make_embeddings()
         print("\n--- Finished creating embeddings with Hugging Face.---")
         
         # Step 3: Create the vector store and persist it
-        # Use FAISS or Chroma based on your preference
-        # create_vector_store(documents, persistent_directory, embeddings)
-        create_chroma_vector_store(documents, persistent_directory, embeddings)
+        # Set VECTOR_BACKEND to choose between FAISS, Chroma and NumPy
+        create_vector_store(batches, persistent_directory, embeddings, backend=vector_backend)
+        print(f"Loaded {report}")
+        if not report.documents:
+            raise ValueError("No valid documents created from CSV files")
+        if deduplicator is not None:
+            print(f"Dedup: {deduplicator}; report written to {deduplicator.write_report(dedup_report_path)}")
+        embeddings.cache.flush()
+        print(f"Embedding cache: {embeddings.cache.stats()}")
+
+    elif rebuild_shard_file:
+        embeddings = make_embeddings()
+        rebuild_csv_shard(persistent_directory, embeddings, rebuild_shard_file)
+        embeddings.cache.flush()
 
     else:
         print("Vector store already exists. No need to initialize.")
 
+    # Step 4 (optional): package the store as one artifact file for deployment
+    if artifact_path:
+        export_vector_artifact(persistent_directory, embeddings or make_embeddings(), artifact_path)
+
 
 if __name__ == "__main__":
     main()        
\ No newline at end of file